@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from telegram import Update
+from telegram.ext import Application
+from flood import ALLOWED, FLOOD_WARNING_TEXT, WARN
+from locks import KeyedLock
+from metrics import finish_update, start_update, timed_callback
+from outbound import PRIORITY_REPLY
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Updates handled at once across all chats; see BotApplication
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+
+
+class BotApplication(Application):
+    """Application that filters redelivered updates and keeps per-chat order.
+
+    Install with ApplicationBuilder().application_class(BotApplication,
+    kwargs={...}). Both the webhook workers and run_polling go through
+    process_update, so in either mode:
+
+    - a resent webhook delivery or an update replayed after a restart is
+      dropped by the deduplicator;
+    - a message from a user who is over their flood_control limit is
+      dropped, with a warning the first time;
+    - every other update joins its chat's queue, and one task per chat
+      with queued updates handles them one at a time, in arrival order.
+      process_update returns once the update is queued, so a chat with a
+      backlog holds no run_polling slot or webhook worker and can't delay
+      other chats. At most concurrent_updates of those tasks (1 if it is
+      off) handle an update at any time; the rest wait their turn with
+      their queues intact. While handling an update the task holds its chat's lock
+      (peer shards take it too, see sharding.py) and then, if pair_key maps
+      the chat to a chat pair, that pair's lock, so /next and /stop from
+      the same user can't race, and neither can the two partners of a
+      chat. The pair key is read only once the chat lock is held, so it
+      reflects pairings made by earlier updates.
+
+    The deduplicator's local check runs when the update arrives; a shared
+    store, if any, is asked from the chat's task, so a slow store can't
+    reorder a chat's updates.
+
+    It also feeds metrics: every handler added is timed, and the Mongo
+    round-trips of each update are counted. With tracing enabled each
+    update is traced (and sometimes profiled) too, see tracing.py.
+
+    With a Startup, initialize() runs its warm-up phases concurrently with
+    the bot's own initialization, and start() reports the cold start.
+    """
+
+    def __init__(self, *, deduplicator=None, pair_key=None, startup=None, flood_control=None, **kwargs):
+        super().__init__(**kwargs)
+        self.deduplicator = deduplicator
+        self.flood_control = flood_control
+        self.pair_key = pair_key
+        self.startup = startup
+        self.chat_locks = KeyedLock()
+        self.pair_locks = KeyedLock()
+        # chat id -> updates waiting for that chat's task, with futures done once handled
+        self._chat_queues = {}
+        self._chat_tasks = set()
+        self._handling = asyncio.BoundedSemaphore(self.concurrent_updates or 1)
+
+    async def initialize(self):
+        if self.startup is None or self._initialized:
+            await super().initialize()
+        else:
+            await self.startup.warm_up(super().initialize())
+
+    async def start(self):
+        await super().start()
+        if self.startup is not None:
+            self.startup.ready()
+
+    async def stop(self):
+        # Finish what the chats' tasks have queued before stopping
+        if self._chat_tasks:
+            await asyncio.wait(set(self._chat_tasks))
+        await super().stop()
+
+    def pending(self):
+        """Updates queued or being handled by the chats' tasks."""
+        return sum(len(queue) for queue in self._chat_queues.values())
+
+    def add_handler(self, handler, group=0):
+        handler.callback = timed_callback(handler.callback)
+        super().add_handler(handler, group)
+
+    async def process_update(self, update):
+        await self.enqueue_update(update)
+
+    async def enqueue_update(self, update):
+        """Filter update and queue it behind earlier updates of its chat.
+
+        Returns a future that is done once the update has been handled, or
+        None if it was dropped or, having no chat, handled already.
+        """
+        if self.deduplicator is not None and self.deduplicator.seen(update.update_id):
+            return None
+        if self.flood_control and isinstance(update, Update):
+            verdict = self.flood_control.check_update(update)
+            if verdict != ALLOWED:
+                if verdict == WARN:
+                    await self.bot.send_message(chat_id=update.effective_chat.id, text=FLOOD_WARNING_TEXT,
+                                                rate_limit_args=PRIORITY_REPLY)
+                return None
+
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._handling:
+                await self._handle(update, None)
+            return None
+
+        done = asyncio.get_running_loop().create_future()
+        queue = self._chat_queues.get(chat.id)
+        if queue is None:
+            queue = self._chat_queues[chat.id] = deque()
+            task = asyncio.create_task(self._drain_chat(chat.id, queue))
+            self._chat_tasks.add(task)
+            task.add_done_callback(self._chat_tasks.discard)
+        queue.append((update, done))
+        return done
+
+    async def _drain_chat(self, chat_id, queue):
+        # No await between the last popleft() and dropping the queue, so
+        # enqueue_update either finds this queue or starts a new task
+        try:
+            while queue:
+                update, done = queue[0]
+                try:
+                    async with self._handling:
+                        await self._handle(update, chat_id)
+                except Exception:
+                    logger.exception("Processing update %s failed", update.update_id)
+                finally:
+                    queue.popleft()
+                    done.set_result(None)
+        finally:
+            for _, done in queue:
+                done.cancel()
+            del self._chat_queues[chat_id]
+
+    async def _handle(self, update, chat_id):
+        token = start_update()
+        try:
+            if tracer.enabled:
+                async with tracer.trace(getattr(update, "update_id", None)):
+                    await self._process_update(update, chat_id)
+            else:
+                await self._process_update(update, chat_id)
+        finally:
+            finish_update(token)
+
+    async def _process_update(self, update, chat_id):
+        if self.deduplicator is not None and await self.deduplicator.seen_shared(update.update_id):
+            return
+        if chat_id is None:
+            await super().process_update(update)
+            return
+
+        async with self.chat_locks.hold(chat_id):
+            pair = self.pair_key(chat_id) if self.pair_key else None
+            if pair is None:
+                await super().process_update(update)
+                return
+            async with self.pair_locks.hold(pair):
+                await super().process_update(update)
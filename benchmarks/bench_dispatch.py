@@ -0,0 +1,96 @@
+"""Throughput of BotApplication's ordered dispatch at different concurrency levels.
+
+Simulates run_polling: every update becomes a task gated by a semaphore of
+size CONCURRENT_UPDATES, as PTB does, held until the update is queued for
+its chat, and the application is built with the same concurrent_updates,
+which caps the handlers running at once; the run ends once every update is
+handled. Each handler call waits
+--latency seconds to stand in for a Bot API send. Users are paired up, so
+the pair lock is exercised too. Afterwards the handled order of each
+chat's updates is checked against their arrival order.
+
+    python benchmarks/bench_dispatch.py [--chats 200] [--messages 20] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Chat, Message, Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from application import BotApplication
+from pairings import PairingTable
+from storage import MemoryStorage
+
+
+def build_updates(chats, messages):
+    updates = []
+    update_id = 0
+    for seq in range(messages):
+        for chat_id in range(1, chats + 1):
+            update_id += 1
+            chat = Chat(chat_id, Chat.PRIVATE)
+            message = Message(seq, None, chat, text=str(seq))
+            updates.append(Update(update_id, message=message))
+    return updates
+
+
+async def run(concurrency, chats, messages, latency):
+    pairings = PairingTable(MemoryStorage())
+    for chat_id in range(1, chats + 1, 2):
+        pairings.pair(chat_id, chat_id + 1)
+
+    app = (
+        ApplicationBuilder()
+        .token("0:bench")
+        .concurrent_updates(concurrency)
+        .application_class(BotApplication, kwargs={"pair_key": pairings.pair_key})
+        .build()
+    )
+    # Skip initialize(), which would call getMe on the real Bot API
+    app._initialized = True
+
+    handled = {}
+
+    async def handler(update, context):
+        await asyncio.sleep(latency)
+        handled.setdefault(update.effective_chat.id, []).append(int(update.message.text))
+
+    app.add_handler(TypeHandler(Update, handler))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(update):
+        async with semaphore:
+            done = await app.enqueue_update(update)
+        if done is not None:
+            await done
+
+    updates = build_updates(chats, messages)
+    started = time.perf_counter()
+    await asyncio.gather(*(process(update) for update in updates))
+    elapsed = time.perf_counter() - started
+
+    for chat_id, seqs in handled.items():
+        assert seqs == sorted(seqs), f"chat {chat_id} handled out of order: {seqs}"
+    return len(updates) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64, 256])
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        rate = asyncio.run(run(concurrency, args.chats, args.messages, args.latency))
+        print(f"CONCURRENT_UPDATES={concurrency:<4} {rate:8,.0f} updates/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Benchmark per-user flood control with many users and a few spammers.
+
+Sends --updates updates through FloodControl.check(): most come from
+--users ordinary users, and --spam of them from --spammers users sending
+/next as fast as they can. Prints the cost per check, how many updates
+were dropped, and the memory held per bucket, measured on a separate
+--sample users (tracemalloc would slow the timed run down).
+
+    python benchmarks/bench_flood.py [--users 1000000] [--updates 2000000] [--spammers 100] [--spam 0.2]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flood import ALLOWED, FLOOD_LIMITS, FloodControl
+
+KINDS = ("relay", "relay", "relay", "next", "stop", "command")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--updates", type=int, default=2_000_000)
+    parser.add_argument("--spammers", type=int, default=100)
+    parser.add_argument("--spam", type=float, default=0.2, help="share of updates sent by spammers")
+    parser.add_argument("--limits", default=FLOOD_LIMITS)
+    parser.add_argument("--sample", type=int, default=100_000, help="users in the memory measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    traffic = [(rng.randrange(args.spammers), "next") if rng.random() < args.spam
+               else (args.spammers + rng.randrange(args.users), rng.choice(KINDS))
+               for _ in range(args.updates)]
+    flood = FloodControl(args.limits, max_size=args.users)
+
+    dropped = 0
+    started = time.perf_counter()
+    for user_id, kind in traffic:
+        dropped += flood.check(user_id, kind) != ALLOWED
+    elapsed = time.perf_counter() - started
+    print(f"check: {args.updates:,} updates in {elapsed:.2f}s, {elapsed / args.updates * 1e9:.0f} ns each, "
+          f"{dropped:,} dropped, {len(flood):,} buckets held")
+
+    sample = FloodControl(args.limits, max_size=args.sample)
+    tracemalloc.start()
+    for user_id in range(args.sample):
+        sample.check(user_id, "relay")
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"memory: {held / len(sample):.0f} bytes per bucket ({len(sample):,} sampled)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Micro-benchmarks for the chat handlers, compared against a saved baseline.
+
+Imports a polling entry point with MONGO_URI=memory:// and calls its
+handlers directly with synthetic Updates and a stub bot that answers every
+Bot API call at once, so what's measured is the handlers' own cost:
+matchmaking, pairing-table and storage work, and building the sends.
+
+For each handler it reports the time per call (best of --repeat runs), the transient memory
+peak of a call (tracemalloc) and the memory blocks a call leaves behind.
+Record a baseline on the machine you compare on, then rerun after a change:
+
+    python benchmarks/bench_handlers.py --save         write benchmarks/handler_baseline.json
+    python benchmarks/bench_handlers.py                compare; exits 1 on a regression
+    python benchmarks/bench_handlers.py --entry main --calls 50000 --tolerance 0.15
+"""
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Chat, Message, MessageEntity, Update, User
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "handler_baseline.json")
+# Calls traced one by one for the memory figures; tracing slows calls down a lot
+TRACED_CALLS = 200
+
+
+class StubBot:
+    """Answers the Bot API methods the handlers use without any I/O."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.calls += 1
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        self.calls += 1
+
+
+class Updates:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+        self.date = datetime.now(timezone.utc)
+
+    def make(self, user_id, text):
+        self.update_id += 1
+        entities = None
+        if text.startswith("/"):
+            entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))]
+        message = Message(self.update_id, self.date, Chat(user_id, Chat.PRIVATE),
+                          from_user=User(user_id, False, "Bench"), text=text, entities=entities)
+        message.set_bot(self.bot)
+        return Update(self.update_id, message=message)
+
+
+class Suite:
+    """Builds, per handler, a batch of updates from fresh users, and times it."""
+
+    def __init__(self, module, calls, repeat):
+        self.module = module
+        self.calls = calls
+        self.repeat = repeat
+        self.bot = StubBot()
+        self.context = SimpleNamespace(bot=self.bot, args=[])
+        self.updates = Updates(self.bot)
+        self._next_user = 1
+
+    def users(self, count):
+        first = self._next_user
+        self._next_user += count
+        return list(range(first, first + count))
+
+    def _paired(self, count):
+        users = self.users(count * 2)
+        for a, b in zip(users[::2], users[1::2]):
+            self.module.pairings.pair(a, b)
+        return users
+
+    def next_partner(self, count):
+        # Alternate callers wait and get paired, like a stream of /next
+        return [self.updates.make(user_id, "/next") for user_id in self.users(count)]
+
+    def stop_chat(self, count):
+        return [self.updates.make(user_id, "/stop") for user_id in self._paired(count)[::2]]
+
+    def relay_message(self, count):
+        users = self._paired(1)
+        return [self.updates.make(users[index % 2], f"hello {index}") for index in range(count)]
+
+    def report(self, count):
+        return [self.updates.make(user_id, "/report spamming links") for user_id in self.users(count)]
+
+    def reset(self):
+        # Drop what earlier runs queued for write-behind or stored, so runs don't skew each other
+        self.module.pairings._pending.clear()
+        self.module.pairings._touched.clear()
+        if hasattr(self.module.storage, "reports"):
+            self.module.storage.reports.clear()
+        if hasattr(self.module, "report_sink"):
+            self.module.report_sink._pending.clear()
+
+    async def measure(self, name):
+        handler = getattr(self.module, name)
+        context = self.context
+
+        # Best of several runs, which is far less noisy than a mean
+        ns_per_call = float("inf")
+        for _ in range(self.repeat):
+            self.reset()
+            updates = getattr(self, name)(self.calls)
+            gc.collect()
+            started = time.perf_counter_ns()
+            for update in updates:
+                await handler(update, context)
+            ns_per_call = min(ns_per_call, (time.perf_counter_ns() - started) / len(updates))
+
+        self.reset()
+        updates = getattr(self, name)(TRACED_CALLS)
+        gc.collect()
+        tracemalloc.start()
+        peak = 0
+        before = tracemalloc.take_snapshot()
+        for update in updates:
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await handler(update, context)
+            peak += tracemalloc.get_traced_memory()[1] - current
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        retained = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+        return {
+            "ns_per_call": ns_per_call,
+            "peak_bytes_per_call": peak / len(updates),
+            "blocks_retained_per_call": retained / len(updates),
+        }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'handler':<15} {'us/call':>9} {'base':>9} {'change':>8} {'peak B':>8} {'base':>8} {'blocks':>7} {'base':>7}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<15} {result['ns_per_call'] / 1000:>9.2f} {'-':>9} {'':>8} "
+                  f"{result['peak_bytes_per_call']:>8.0f} {'-':>8} {result['blocks_retained_per_call']:>7.2f} {'-':>7}")
+            continue
+        change = result["ns_per_call"] / base["ns_per_call"] - 1
+        flags = []
+        if change > tolerance:
+            flags.append("slower")
+        if result["peak_bytes_per_call"] > base["peak_bytes_per_call"] * (1 + tolerance):
+            flags.append("more memory")
+        if result["blocks_retained_per_call"] > base["blocks_retained_per_call"] + 0.5:
+            flags.append("retains more")
+        if flags:
+            regressions.append(name)
+        print(f"{name:<15} {result['ns_per_call'] / 1000:>9.2f} {base['ns_per_call'] / 1000:>9.2f} {change:>+8.1%} "
+              f"{result['peak_bytes_per_call']:>8.0f} {base['peak_bytes_per_call']:>8.0f} "
+              f"{result['blocks_retained_per_call']:>7.2f} {base['blocks_retained_per_call']:>7.2f}"
+              f"{'  <-- ' + ', '.join(flags) if flags else ''}")
+    return regressions
+
+
+async def main(args):
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    os.environ["MONGO_URI"] = "memory://"
+    # Journal writes are part of /report's cost, but keep them out of the tree
+    os.environ["REPORT_JOURNAL"] = os.path.join(tempfile.mkdtemp(), "reports_journal.jsonl")
+    module = importlib.import_module(args.entry)
+    suite = Suite(module, args.calls, args.repeat)
+
+    results = {}
+    for name in args.handlers:
+        if hasattr(module, name):
+            results[name] = await suite.measure(name)
+    # Let background typing indicators finish before the loop closes
+    await asyncio.sleep(0)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get(args.entry, {})
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        saved = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                saved = json.load(f)
+        saved[args.entry] = results
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not baseline:
+        print(f"No baseline for {args.entry} yet; rerun with --save to record one.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", default="new", choices=("new", "main"),
+                        help="polling entry point to load; webhook ones start a bot on import")
+    parser.add_argument("--handlers", nargs="+", default=["next_partner", "stop_chat", "relay_message", "report"])
+    parser.add_argument("--calls", type=int, default=20000, help="timed calls per handler")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per handler; the fastest counts")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before failing (0.2 = 20%%)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="store these results as the new baseline")
+    raise SystemExit(asyncio.run(main(parser.parse_args())))
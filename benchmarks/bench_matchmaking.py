@@ -0,0 +1,76 @@
+"""Benchmark Matchmaker.next() under concurrent /next traffic.
+
+Fires USERS concurrent /next calls (each user twice, to exercise the
+double-/next case), then checks that nobody was paired with themselves or
+with two people at once and reports /next calls per second.
+
+    python benchmarks/bench_matchmaking.py [--users 20000] [--mongo-uri URI]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchmaking import Matchmaker, PAIRED
+from pairings import PairingTable
+from storage import MemoryStorage, MongoStorage
+
+
+def check_pairings(pairings, results):
+    partners = {}
+    for user_id, match in results:
+        if match.status != PAIRED:
+            continue
+        assert match.partner_id != user_id, f"{user_id} paired with themselves"
+        for a, b in ((user_id, match.partner_id), (match.partner_id, user_id)):
+            assert partners.setdefault(a, b) == b, f"{a} paired with {partners[a]} and {b}"
+    for a, b in partners.items():
+        assert pairings.partner_of(a) == b
+
+
+async def run(storage, users):
+    pairings = PairingTable(storage)
+    matchmaker = Matchmaker(pairings, storage.waiting)
+    user_ids = list(range(1, users + 1)) * 2
+    random.shuffle(user_ids)
+
+    async def next_partner(user_id):
+        return user_id, await matchmaker.next(user_id)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(next_partner(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - started
+
+    check_pairings(pairings, results)
+    waiting = await storage.waiting.count()
+    print(f"{len(user_ids)} /next calls in {elapsed:.3f}s: {len(user_ids) / elapsed:,.0f}/s, "
+          f"{len(pairings)} chats, {waiting} waiting")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--mongo-uri", help="run against MongoWaitingQueue in a scratch database")
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        storage = MongoStorage(args.mongo_uri, db_name="bench_matchmaking")
+
+        async def run_mongo():
+            await storage.waiting_users.delete_many({})
+            try:
+                await run(storage, args.users)
+            finally:
+                await storage.client.drop_database("bench_matchmaking")
+
+        asyncio.run(run_mongo())
+    else:
+        asyncio.run(run(MemoryStorage(), args.users))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Benchmark preference matchmaking with a large waiting queue.
+
+Fills the queue with --waiting users (100k by default) whose language, age
+bracket and interests are drawn from skewed distributions, then measures:
+
+- enqueue: filing a waiting user under their buckets;
+- next: a newcomer's /next, which claims from their exact-match buckets
+  or joins the queue (p50/p99 per call);
+- relax: one sweep pairing users who have waited past each relaxation
+  step, with every backdated waiter due at once (the worst case); users
+  queued by the timed /next calls aren't due yet.
+
+Claims only look at the heads of a few buckets, so /next should cost the
+same at 1k and 100k waiting users; rerun with --waiting 1000 to compare.
+
+    python benchmarks/bench_preferences.py [--waiting 100000] [--calls 20000] [--mongo-uri URI]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchmaking import Matchmaker, PAIRED
+from pairings import PairingTable
+from preferences import AGE_BRACKETS, Preferences, PreferenceStore
+from storage import MemoryStorage, MongoStorage
+
+LANGUAGES = ("en", "hi", "es", "pt", "ru", "ar", "id", "fr", "de", "tr")
+INTERESTS = ("music", "movies", "games", "travel", "books", "sports", "anime", "tech", "art", "food",
+             "fitness", "memes", "science", "fashion", "pets", "cars", "cooking", "history", "poetry", "dance")
+
+
+def random_preferences(rng):
+    # Popular choices dominate, like real traffic; some users leave things unset
+    language = None if rng.random() < 0.2 else rng.choices(LANGUAGES, weights=range(len(LANGUAGES), 0, -1))[0]
+    age = None if rng.random() < 0.3 else rng.choice(AGE_BRACKETS)
+    interests = tuple(sorted(set(rng.choices(INTERESTS, k=rng.randint(0, 3)))))
+    return Preferences(language, age, interests)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+async def run(storage, waiting, calls, seed):
+    rng = random.Random(seed)
+    pairings = PairingTable(storage)
+    preferences = PreferenceStore(storage, cache_size=waiting + calls)
+    matchmaker = Matchmaker(pairings, storage.waiting, preferences=preferences)
+
+    users = waiting + calls
+    for user_id in range(1, users + 1):
+        prefs = random_preferences(rng)
+        preferences._remember(user_id, prefs)
+
+    # Queue everybody directly, backdated so the relax sweep finds all of them due
+    backdated = datetime.now(timezone.utc) - timedelta(hours=1)
+    started = time.perf_counter()
+    for user_id in range(1, waiting + 1):
+        levels = await preferences.buckets(user_id)
+        buckets = [bucket for level in levels[:-1] for bucket in level]
+        await storage.waiting.enqueue(user_id, buckets, {"nickname": f"Stranger{user_id}"}, backdated)
+    elapsed = time.perf_counter() - started
+    print(f"enqueue: {waiting:,} waiting users in {elapsed:.2f}s, {elapsed / waiting * 1e6:.1f} us each")
+
+    latencies = []
+    paired = 0
+    for user_id in range(waiting + 1, users + 1):
+        started = time.perf_counter()
+        match = await matchmaker.next(user_id)
+        latencies.append(time.perf_counter() - started)
+        paired += match.status == PAIRED
+    print(f"next:    {calls:,} calls, p50 {percentile(latencies, 0.5) * 1e6:.1f} us, "
+          f"p99 {percentile(latencies, 0.99) * 1e6:.1f} us, {paired / calls:.0%} matched exactly")
+
+    matchmaker._relaxed_until = backdated - timedelta(hours=1)
+    waiting_before = await storage.waiting.count()
+    started = time.perf_counter()
+    pairs = await matchmaker.relax()
+    elapsed = time.perf_counter() - started
+    print(f"relax:   {waiting_before:,} waiting, {len(pairs):,} pairs in {elapsed:.2f}s, "
+          f"{await storage.waiting.count():,} left waiting")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--waiting", type=int, default=100_000, help="users in the queue before /next calls start")
+    parser.add_argument("--calls", type=int, default=20_000, help="timed /next calls")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mongo-uri", help="run against MongoWaitingQueue in a scratch database")
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        storage = MongoStorage(args.mongo_uri, db_name="bench_preferences")
+
+        async def run_mongo():
+            from migrations import ensure_indexes
+
+            await storage.client.drop_database("bench_preferences")
+            await ensure_indexes(storage.db)
+            try:
+                await run(storage, args.waiting, args.calls, args.seed)
+            finally:
+                await storage.client.drop_database("bench_preferences")
+
+        asyncio.run(run_mongo())
+    else:
+        asyncio.run(run(MemoryStorage(), args.waiting, args.calls, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark the recent-partner memory with millions of distinct users.
+
+Records --pairs pairings between random users out of --users, then times
+lookups, and measures the memory held per remembered user on a separate
+--sample users (tracemalloc would slow the timed run down). Both costs
+should stay flat as --users grows; compare --users 100000 with --users 2000000.
+
+    python benchmarks/bench_recent_partners.py [--users 2000000] [--pairs 2000000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchmaking import RecentPartners
+
+
+def random_pairs(rng, users, count):
+    return [(rng.randrange(users), rng.randrange(users)) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2_000_000)
+    parser.add_argument("--pairs", type=int, default=2_000_000)
+    parser.add_argument("--size", type=int, default=3, help="partners remembered per user")
+    parser.add_argument("--sample", type=int, default=100_000, help="users in the memory measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pairs = random_pairs(rng, args.users, args.pairs)
+    lookups = [rng.randrange(args.users) for _ in range(1_000_000)]
+    recent = RecentPartners(size=args.size, ttl=3600, max_users=args.users)
+
+    started = time.perf_counter()
+    for user_id, partner_id in pairs:
+        recent.add(user_id, partner_id)
+    elapsed = time.perf_counter() - started
+    print(f"add: {args.pairs:,} pairings in {elapsed:.2f}s, {elapsed / args.pairs * 1e9:.0f} ns each, "
+          f"{len(recent):,} users remembered")
+
+    started = time.perf_counter()
+    for user_id in lookups:
+        recent.of(user_id)
+    elapsed = time.perf_counter() - started
+    print(f"of: {len(lookups):,} lookups, {elapsed / len(lookups) * 1e9:.0f} ns each")
+
+    # Enough pairings that most sampled users have a full set of partners
+    sample = RecentPartners(size=args.size, ttl=3600, max_users=args.sample)
+    sample_pairs = random_pairs(rng, args.sample, args.sample * args.size)
+    tracemalloc.start()
+    for user_id, partner_id in sample_pairs:
+        sample.add(user_id, partner_id)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"memory: {held / len(sample):.0f} bytes per remembered user ({len(sample):,} sampled)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Cold-start benchmark: from launching an entry point to its first reply.
+
+Starts a fake Bot API, then --runs times launches the entry point in a fresh
+interpreter, the way a scale-to-zero host does, and sends it /start: webhook
+entry points get it POSTed to /webhook as soon as they accept connections,
+polling ones (new, main) find it waiting in getUpdates. A run ends when the
+reply reaches the fake Bot API; for webhooks the time until the POST was
+answered is shown too, which is what --lazy (WEBHOOK_LAZY_START) shortens.
+Each run also prints the bot's own startup breakdown (see startup.py).
+
+--api-latency adds a delay to every Bot API call, like Telegram's
+round-trip; getMe is one of them. The command exits with status 1 if the
+median run misses --target (COLD_START_TARGET by default).
+
+    python benchmarks/bench_startup.py --entry ss [--runs 5] [--api-latency 0.05] [--lazy] [--mongo-uri URI]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotAPI
+from startup import COLD_START_TARGET
+
+# Runs the entry point as __main__ with the startup breakdown logged
+CHILD = """
+import logging, runpy, sys
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+logging.getLogger("startup").setLevel(logging.INFO)
+runpy.run_path(sys.argv[1], run_name="__main__")
+"""
+
+START_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Cold"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+POLLING = ("new", "main")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def post_until_accepted(url, deadline):
+    body = json.dumps(START_UPDATE).encode()
+    while time.monotonic() < deadline:
+        request = urllib.request.Request(url, body, {"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                if response.status == 200:
+                    return time.monotonic()
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError("the webhook never accepted the update")
+
+
+def run_once(args, api):
+    env = dict(os.environ, BOT_TOKEN="123456:COLDSTART", BOT_API_URL=api.base_url, MONGO_URI=args.mongo_uri,
+               PORT=str(free_port()), WEBHOOK_LAZY_START="1" if args.lazy else "0")
+    api.take_counts()
+    if args.entry in POLLING:
+        api.push_update(START_UPDATE)
+
+    started = time.monotonic()
+    deadline = started + args.timeout
+    child = subprocess.Popen([sys.executable, "-c", CHILD, os.path.join(ROOT, args.entry + ".py")],
+                             cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        accepted = None
+        if args.entry not in POLLING:
+            accepted = post_until_accepted(f"http://127.0.0.1:{env['PORT']}/webhook", deadline) - started
+        replied = False
+        while time.monotonic() < deadline and not replied:
+            replied = api.calls["sendMessage"] > 0
+            time.sleep(0.002)
+        if not replied:
+            raise TimeoutError("no reply to /start")
+        elapsed = time.monotonic() - started
+    finally:
+        child.terminate()
+        _, stderr = child.communicate(timeout=30)
+    breakdown = next((line for line in stderr.splitlines() if line.startswith("Ready in")), "no startup report")
+    return elapsed, accepted, breakdown
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", default="ss", help="entry point to launch (default: ss)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds each fake Bot API call takes")
+    parser.add_argument("--lazy", action="store_true", help="set WEBHOOK_LAZY_START=1")
+    parser.add_argument("--mongo-uri", default="memory://")
+    parser.add_argument("--target", type=float, default=COLD_START_TARGET, help="seconds to first reply")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.api_latency).start()
+    runs = []
+    try:
+        for run in range(1, args.runs + 1):
+            elapsed, accepted, breakdown = run_once(args, api)
+            runs.append(elapsed)
+            webhook = "" if accepted is None else f"webhook answered after {accepted:.2f}s, "
+            print(f"run {run}: {webhook}first reply after {elapsed:.2f}s; {breakdown}")
+    finally:
+        api.stop()
+
+    median = statistics.median(runs)
+    verdict = "within" if median <= args.target else "OVER"
+    print(f"{args.entry}: median {median:.2f}s, best {min(runs):.2f}s, {verdict} the {args.target:.2f}s target")
+    sys.exit(0 if median <= args.target else 1)
+
+
+if __name__ == "__main__":
+    main()
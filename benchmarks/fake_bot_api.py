@@ -0,0 +1,235 @@
+"""Local stand-in for the Telegram Bot API, for load tests.
+
+Point a bot at it with ApplicationBuilder().base_url(api.base_url), or set
+BOT_API_URL=<api.base_url> for the entry points. Every method succeeds
+after an optional artificial latency; sends are answered with a minimal
+Message, and getUpdates long-polls the updates queued with push_update(),
+so polling bots can be driven too. fail() injects faults: every call but
+getUpdates is answered with an HTTP error (502 Bad Gateway by default),
+for a number of calls or for a while, the way Telegram fails in an outage.
+
+Run standalone, it keeps its CPU off the bot under test; RemoteBotAPI
+then reaches push_update() and take_counts() over /_loadtest/ routes.
+
+    python benchmarks/fake_bot_api.py [--port 8081] [--latency 0.03]
+"""
+import argparse
+import itertools
+import json
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+def _decode(value):
+    # PTB form-encodes parameters with JSON-encoded values; plain text stays text
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # A bot that exits mid long-poll isn't worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class Fault(Exception):
+    """An injected failure, answered with HTTP status."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        # Calls answered with an injected fault, by method
+        self.faults = Counter()
+        # Text of every message sent, in order
+        self.texts = []
+        self._fail_count = 0
+        self._fail_until = 0.0
+        self._fail_status = 502
+        self._lock = threading.Lock()
+        self._updates = []
+        self._has_updates = threading.Condition(self._lock)
+        self._message_ids = itertools.count(1)
+        self._server = _Server((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update):
+        """Queue an update dict for the next getUpdates call."""
+        with self._has_updates:
+            self._updates.append(update)
+            self._has_updates.notify_all()
+
+    def push_updates(self, updates):
+        for update in updates:
+            self.push_update(update)
+
+    def take_counts(self):
+        """Return the per-method call counts so far and start counting afresh."""
+        with self._lock:
+            counts, self.calls = self.calls, Counter()
+        return counts
+
+    def fail(self, count=0, seconds=0.0, status=502):
+        """Answer the next count calls, and every call for the next seconds, with HTTP status."""
+        with self._lock:
+            self._fail_count = count
+            self._fail_until = time.monotonic() + seconds
+            self._fail_status = status
+
+    def _injected_fault(self):
+        # Called with the lock held
+        if self._fail_count:
+            self._fail_count -= 1
+            return True
+        return time.monotonic() < self._fail_until
+
+    def call(self, method, params):
+        with self._lock:
+            self.calls[method] += 1
+            if method != "getUpdates" and self._injected_fault():
+                self.faults[method] += 1
+                raise Fault(self._fail_status)
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if self.latency:
+            time.sleep(self.latency)
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            with self._lock:
+                self.texts.append(params.get("text"))
+        if method in ("sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendVoice", "sendSticker"):
+            return {"message_id": next(self._message_ids), "date": int(time.time()),
+                    "chat": {"id": params.get("chat_id"), "type": "private"}, "text": params.get("text")}
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        return True
+
+    def _get_updates(self, params):
+        offset = params.get("offset") or 0
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._has_updates:
+            # Updates below offset were confirmed by the bot
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._has_updates.wait(deadline - time.monotonic())
+            return self._updates[:int(params.get("limit") or 100)]
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = {key: _decode(value) for key, value in parse_qsl(body.decode())}
+
+                if self.path == "/_loadtest/push":
+                    for update in params:
+                        api.push_update(update)
+                    result = True
+                elif self.path == "/_loadtest/counts":
+                    result = api.take_counts()
+                elif self.path == "/_loadtest/fail":
+                    api.fail(**params)
+                    result = True
+                else:
+                    try:
+                        result = api.call(method, params)
+                    except Fault as fault:
+                        return self._reply(fault.status, {"ok": False, "error_code": fault.status,
+                                                          "description": HTTPStatus(fault.status).phrase})
+                self._reply(200, {"ok": True, "result": result})
+
+            def _reply(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class RemoteBotAPI:
+    """Client for a FakeBotAPI running in another process."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.base_url = self.url + "/bot"
+
+    def _post(self, path, data):
+        request = urllib.request.Request(self.url + path, json.dumps(data).encode(),
+                                         {"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)["result"]
+
+    def push_updates(self, updates):
+        self._post("/_loadtest/push", updates)
+
+    def take_counts(self):
+        return Counter(self._post("/_loadtest/counts", {}))
+
+    def fail(self, count=0, seconds=0.0, status=502):
+        self._post("/_loadtest/fail", {"count": count, "seconds": seconds, "status": status})
+
+    def stop(self):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call but getUpdates")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(port=args.port, latency=args.latency)
+    print(f"Fake Bot API listening, set BOT_API_URL={api.base_url} or pass --api-url to loadtest.py")
+    try:
+        api._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
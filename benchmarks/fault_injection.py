@@ -0,0 +1,204 @@
+"""Fault-injection run of the resilience layer against local stand-ins.
+
+Drives a polling entry point (new by default) through the fake Bot API,
+pairs --pairs couples of users, then ends their chats with /stop while
+the fake Bot API fails:
+
+    blip     the next --pairs/2 Bot API calls fail; retries with backoff
+             deliver most "partner has left" notices, and any held while
+             the circuit was briefly open go out once it closes
+    outage   every Bot API call fails for --outage seconds; the circuit
+             opens, notices are held and should all go out once it closes
+
+Replies to the users who left aren't held, so their failures are expected
+and not logged.
+
+With --mongo-uri pointing at a mongod started with
+--setParameter enableTestCommands=1, a mongo scenario also runs. It uses
+MongoDB's failCommand fail point to drop connections, first for two
+commands (retried) and then for every command (the circuit opens), and
+checks that reads work again once the fail point is off.
+
+    python benchmarks/fault_injection.py [--scenario blip outage] [--pairs 50] [--outage 3]
+"""
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI
+from loadtest import Traffic
+
+LEFT_TEXT = "Your partner has left the chat"
+
+
+class Bot:
+    """A polling entry point running against the fake Bot API."""
+
+    def __init__(self, entry):
+        self.module = importlib.import_module(entry)
+        self.processed = set()
+
+    async def start(self):
+        self.app = self.module.build_application()
+        enqueue_update = self.app.enqueue_update
+
+        async def counted(update):
+            done = None
+            try:
+                done = await enqueue_update(update)
+            finally:
+                if done is None:
+                    self.processed.add(update.update_id)
+                else:
+                    done.add_done_callback(lambda _: self.processed.add(update.update_id))
+
+        self.app.enqueue_update = counted
+        await self.app.initialize()
+        await self.app.post_init(self.app)
+        await self.app.updater.start_polling(poll_interval=0, timeout=1)
+        await self.app.start()
+
+    async def stop(self):
+        await self.app.updater.stop()
+        await self.app.stop()
+        await self.app.shutdown()
+        await self.app.post_shutdown(self.app)
+
+    async def send(self, api, wave, timeout=60):
+        api.push_updates(wave)
+        deadline = time.monotonic() + timeout
+        while any(update["update_id"] not in self.processed for update in wave):
+            if time.monotonic() > deadline:
+                raise TimeoutError("updates weren't processed in time")
+            await asyncio.sleep(0.01)
+
+
+def counters():
+    from metrics import CIRCUIT_TRANSITIONS, DEPENDENCY_RETRIES, NOTIFICATIONS_BUFFERED
+
+    return {
+        "retries": DEPENDENCY_RETRIES.value("bot_api"),
+        "opened": CIRCUIT_TRANSITIONS.value("bot_api", "open"),
+        "held": NOTIFICATIONS_BUFFERED.value("held"),
+        "delivered": NOTIFICATIONS_BUFFERED.value("delivered"),
+        "dropped": NOTIFICATIONS_BUFFERED.value("dropped"),
+    }
+
+
+def notices_sent(api, since):
+    return sum(1 for text in api.texts[since:] if LEFT_TEXT in text)
+
+
+async def run_scenario(name, bot, api, traffic, args):
+    users = traffic.users(args.pairs * 2)
+    await bot.send(api, traffic.wave(users, "/next"))
+    before = counters()
+    sent_before = len(api.texts)
+
+    if name == "blip":
+        api.fail(count=args.pairs // 2)
+    else:
+        api.fail(seconds=args.outage)
+    started = time.monotonic()
+    # One user of each pair leaves; their partner should hear about it
+    await bot.send(api, traffic.wave(users[::2], "/stop"))
+
+    sender = bot.module.sender
+    deadline = time.monotonic() + args.outage + 60
+    while (sender.stats()["held"] or notices_sent(api, sent_before) < args.pairs) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+
+    after = counters()
+    delta = {key: after[key] - before[key] for key in after}
+    delivered = notices_sent(api, sent_before)
+    print(f"{name:<7} notices {delivered}/{args.pairs} delivered in {elapsed:.1f}s; "
+          f"{delta['retries']} retries, circuit opened {delta['opened']}x, {delta['held']} held, "
+          f"{delta['delivered']} delivered late, {delta['dropped']} dropped")
+    return delivered == args.pairs
+
+
+async def run_mongo(uri):
+    from pymongo.errors import AutoReconnect
+    from resilience import DependencyUnavailable
+    from storage import MONGO, MongoStorage
+
+    storage = MongoStorage(uri, db_name="fault_injection")
+    admin = storage.client.admin
+
+    async def fail_point(mode):
+        await admin.command("configureFailPoint", "failCommand", mode=mode,
+                            data={"failCommands": ["find"], "closeConnection": True})
+
+    ok = True
+    try:
+        await storage.load_bans()
+        # pymongo retries a read once itself, so two failures reach our retries
+        await fail_point({"times": 2})
+        await storage.load_bans()
+        print(f"mongo   read retried through a blip; circuit {MONGO.breaker.state}")
+
+        await fail_point("alwaysOn")
+        failures = 0
+        for _ in range(MONGO.breaker.failure_threshold + 1):
+            try:
+                await storage.load_bans()
+            except AutoReconnect:
+                failures += 1
+            except DependencyUnavailable:
+                break
+        ok &= MONGO.breaker.state == "open"
+        print(f"mongo   circuit {MONGO.breaker.state} after {failures} failed reads")
+
+        await fail_point("off")
+        await asyncio.sleep(MONGO.breaker.retry_in())
+        await storage.load_bans()
+        ok &= MONGO.breaker.state == "closed"
+        print(f"mongo   circuit {MONGO.breaker.state} once the fail point was off")
+    finally:
+        await fail_point("off")
+        await storage.client.drop_database("fault_injection")
+    return ok
+
+
+async def main(args):
+    api = FakeBotAPI().start()
+    os.environ.update(BOT_TOKEN="123456:FAULTS", BOT_API_URL=api.base_url, MONGO_URI="memory://",
+                      SEND_GLOBAL_RATE="1e9", SEND_CHAT_RATE="1e9", SEND_CHAT_BURST="1e9",
+                      BREAKER_RESET_SECONDS=str(args.reset), RETRY_BASE_DELAY="0.05", NOTIFY_DRAIN_INTERVAL="0.2")
+
+    bot = Bot(args.entry)
+    await bot.start()
+    traffic = Traffic()
+    ok = True
+    try:
+        for name in args.scenario:
+            ok &= await run_scenario(name, bot, api, traffic, args)
+    finally:
+        await bot.stop()
+        api.stop()
+    if args.mongo_uri:
+        ok &= await run_mongo(args.mongo_uri)
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", default="new", help="polling entry point (default: new)")
+    parser.add_argument("--scenario", nargs="+", choices=("blip", "outage"), default=["blip", "outage"])
+    parser.add_argument("--pairs", type=int, default=50)
+    parser.add_argument("--outage", type=float, default=3, help="seconds the Bot API is down in outage")
+    parser.add_argument("--reset", type=float, default=1, help="BREAKER_RESET_SECONDS for the run")
+    parser.add_argument("--mongo-uri", help="mongod with test commands enabled, for the mongo scenario")
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    logging.getLogger("telegram.ext.Application").setLevel(logging.CRITICAL)
+    os.chdir(ROOT)
+    sys.exit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,283 @@
+"""End-to-end load test of an entry point against a fake Bot API.
+
+Starts benchmarks/fake_bot_api.py, imports the entry point pointed at it
+(BOT_API_URL) and replays synthetic traffic through the real delivery path:
+webhook entry points get POSTs on their Flask /webhook route, polling ones
+(new, main) fetch updates with getUpdates. Each scenario is a series of
+waves; every user sends one update per wave and a wave starts once the
+previous one has been processed.
+
+    next_burst  every user sends /next at once
+    long_chats  paired users exchange --messages messages each
+    stop_churn  --rounds of /next, one message, /stop
+    report      paired users send /report
+
+Latency is from sending an update until its chat's task has handled it. Mongo
+operations are counted with a pymongo command listener, so they're only
+non-zero with --mongo-uri pointing at a real server.
+
+    python benchmarks/loadtest.py --entry ss [--users 400] [--api-latency 0.03] [--mongo-uri URI]
+    python benchmarks/loadtest.py --entry new
+
+Everything runs in one process by default, which makes the harness compete
+with the bot for the GIL; for steadier numbers start the fake Bot API on its
+own and pass --api-url http://127.0.0.1:8081.
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from pymongo import monitoring
+
+from fake_bot_api import FakeBotAPI, RemoteBotAPI
+
+SCENARIOS = ("next_burst", "long_chats", "stop_churn", "report")
+WAVE_TIMEOUT = 60
+
+
+class MongoOpCounter(monitoring.CommandListener):
+    """Counts commands sent to MongoDB, ignoring connection housekeeping."""
+
+    IGNORED = {"hello", "ismaster", "isMaster", "ping", "endSessions", "buildInfo", "saslStart", "saslContinue"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def take_counts(self):
+        with self._lock:
+            counts, self.counts = self.counts, Counter()
+        return counts
+
+    def started(self, event):
+        if event.command_name not in self.IGNORED:
+            with self._lock:
+                self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class Traffic:
+    """Builds waves of synthetic updates for fresh users."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._user_ids = itertools.count(10_000)
+
+    def users(self, count):
+        return [next(self._user_ids) for _ in range(count)]
+
+    def update(self, chat_id, text):
+        update_id = next(self._update_ids)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def wave(self, users, text):
+        return [self.update(user_id, text.format(user=user_id)) for user_id in users]
+
+    def scenario(self, name, args):
+        """Return [(measured, wave), ...]; unmeasured waves set up or clean up."""
+        users = self.users(args.users)
+        if name == "next_burst":
+            return [(True, self.wave(users, "/next")), (False, self.wave(users, "/stop"))]
+        if name == "long_chats":
+            waves = [(False, self.wave(users, "/next"))]
+            waves += [(True, self.wave(users, f"message {index} from {{user}}")) for index in range(args.messages)]
+            return waves + [(False, self.wave(users, "/stop"))]
+        if name == "stop_churn":
+            waves = []
+            for _ in range(args.rounds):
+                waves += [(True, self.wave(users, "/next")), (True, self.wave(users, "hi from {user}")),
+                          (True, self.wave(users, "/stop"))]
+            return waves
+        if name == "report":
+            return [(False, self.wave(users, "/next")), (True, self.wave(users, "/report spam from {user}")),
+                    (False, self.wave(users, "/stop"))]
+        raise ValueError(name)
+
+
+class Harness:
+    def __init__(self, entry, api, args):
+        self.module = importlib.import_module(entry)
+        self.api = api
+        self.args = args
+        self.webhook = hasattr(self.module, "app")
+        self.sent = {}
+        self.finished = {}
+        self.rejected = set()
+
+    def _instrument(self, telegram_app):
+        enqueue_update = telegram_app.enqueue_update
+
+        def finish(update_id):
+            self.finished[update_id] = time.perf_counter()
+
+        async def timed(update):
+            done = None
+            try:
+                done = await enqueue_update(update)
+            finally:
+                if done is None:
+                    finish(update.update_id)
+                else:
+                    done.add_done_callback(lambda _: finish(update.update_id))
+
+        telegram_app.enqueue_update = timed
+
+    async def start(self):
+        if self.webhook:
+            from werkzeug.serving import make_server
+
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+            self.telegram_app = self.module.telegram_app
+            self._instrument(self.telegram_app)
+            self._flask = make_server("127.0.0.1", 0, self.module.app, threaded=True)
+            threading.Thread(target=self._flask.serve_forever, daemon=True).start()
+            self._client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{self._flask.server_port}",
+                                             limits=httpx.Limits(max_connections=self.args.clients))
+        else:
+            self.telegram_app = self.module.build_application()
+            self._instrument(self.telegram_app)
+            await self.telegram_app.initialize()
+            if self.telegram_app.post_init:
+                await self.telegram_app.post_init(self.telegram_app)
+            await self.telegram_app.updater.start_polling(poll_interval=0, timeout=1)
+            await self.telegram_app.start()
+
+    async def stop(self):
+        if self.webhook:
+            await self._client.aclose()
+            self._flask.shutdown()
+            self.module.app.extensions["webhook_server"].stop()
+        else:
+            await self.telegram_app.updater.stop()
+            await self.telegram_app.stop()
+            await self.telegram_app.shutdown()
+            if self.telegram_app.post_shutdown:
+                await self.telegram_app.post_shutdown(self.telegram_app)
+
+    async def _post(self, update, semaphore):
+        async with semaphore:
+            self.sent[update["update_id"]] = time.perf_counter()
+            response = await self._client.post("/webhook", json=update)
+            if response.status_code != 200:
+                self.rejected.add(update["update_id"])
+
+    async def send_wave(self, wave):
+        if self.webhook:
+            semaphore = asyncio.Semaphore(self.args.clients)
+            await asyncio.gather(*(self._post(update, semaphore) for update in wave))
+        else:
+            now = time.perf_counter()
+            self.sent.update((update["update_id"], now) for update in wave)
+            self.api.push_updates(wave)
+
+        pending = {update["update_id"] for update in wave} - self.rejected
+        deadline = time.monotonic() + WAVE_TIMEOUT
+        while pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.002)
+            pending = {update_id for update_id in pending if update_id not in self.finished}
+        return len(pending)
+
+    async def run_scenario(self, name, traffic, mongo_ops):
+        self.api.take_counts()
+        mongo_ops.take_counts()
+        latencies, lost, first, last = [], 0, None, None
+        for measured, wave in traffic.scenario(name, self.args):
+            started = time.perf_counter()
+            missing = await self.send_wave(wave)
+            if not measured:
+                continue
+            first = first or started
+            last = time.perf_counter()
+            lost += missing
+            latencies += [self.finished[u["update_id"]] - self.sent[u["update_id"]]
+                          for u in wave if u["update_id"] in self.finished]
+            lost += sum(1 for u in wave if u["update_id"] in self.rejected)
+        # Let write-behind flushes land so their Mongo ops are counted here
+        await asyncio.sleep(0.2)
+        return {
+            "scenario": name,
+            "updates": len(latencies),
+            "lost": lost,
+            "updates_per_s": len(latencies) / (last - first) if latencies else 0.0,
+            "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+            "p99_ms": statistics.quantiles(latencies, n=100)[98] * 1000 if len(latencies) > 1 else 0.0,
+            "api_calls": sum(self.api.take_counts().values()),
+            "mongo_ops": mongo_ops.take_counts(),
+        }
+
+
+def print_report(entry, mode, results):
+    print(f"\n{entry} ({mode})")
+    print(f"{'scenario':<12} {'updates':>8} {'lost':>5} {'upd/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'api':>7}  mongo ops")
+    for result in results:
+        ops = result["mongo_ops"]
+        mongo = f"{sum(ops.values())} ({', '.join(f'{k}={v}' for k, v in sorted(ops.items()))})" if ops else "0"
+        print(f"{result['scenario']:<12} {result['updates']:>8} {result['lost']:>5} {result['updates_per_s']:>9,.0f} "
+              f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['api_calls']:>7}  {mongo}")
+
+
+async def main(args):
+    api = RemoteBotAPI(args.api_url) if args.api_url else FakeBotAPI(latency=args.api_latency).start()
+    mongo_ops = MongoOpCounter()
+    # Registered before the entry point creates its client
+    monitoring.register(mongo_ops)
+
+    os.environ.update(BOT_TOKEN="123456:LOADTEST", BOT_API_URL=api.base_url, MONGO_URI=args.mongo_uri)
+    if not args.keep_rate_limits:
+        # Measure the bot, not Telegram's flood limits
+        os.environ.update(SEND_GLOBAL_RATE="1e9", SEND_CHAT_RATE="1e9", SEND_CHAT_BURST="1e9")
+
+    harness = Harness(args.entry, api, args)
+    await harness.start()
+    traffic = Traffic()
+    results = []
+    try:
+        for name in args.scenario:
+            results.append(await harness.run_scenario(name, traffic, mongo_ops))
+    finally:
+        await harness.stop()
+        api.stop()
+    print_report(args.entry, "webhook" if harness.webhook else "polling", results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", default="ss", help="entry point module to load (default: ss)")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--users", type=int, default=400, help="users per scenario (default: 400)")
+    parser.add_argument("--messages", type=int, default=10, help="messages per user in long_chats")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds of stop_churn")
+    parser.add_argument("--clients", type=int, default=64, help="concurrent webhook connections")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds each fake Bot API call takes")
+    parser.add_argument("--api-url", help="use a fake_bot_api.py already running at this URL")
+    parser.add_argument("--mongo-uri", default="memory://")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="keep SendScheduler's Telegram limits")
+    os.chdir(ROOT)
+    asyncio.run(main(parser.parse_args()))
@@ -1,27 +1,72 @@
+import functools
 import os
 import random
 import time
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from flask import Flask, request
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
-import asyncio
-
-bot_started = False
+from storage import create_storage
+from sharding import create_pairing_table
+from matchmaking import Matchmaker, PAIRED, ALREADY_CHATTING
+from outbound import SendScheduler, PRIORITY_NOTIFY, PRIORITY_RELAY
+from typing_indicator import TypingIndicator
+from relay import copy_to_partner
+from dedup import create_deduplicator
+from flood import FloodControl
+from reports import ReportSink
+from moderation import Moderation
+from preferences import PreferenceStore, describe
+from reaper import Reaper
+from startup import Startup
+from metrics import register_gauges
+from application import BotApplication
+from webhook import create_app
 
 # Load environment variables
 load_dotenv()
 
+# Times the cold start, phase by phase
+startup = Startup()
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Override to point the bot at a local stand-in, e.g. for load tests
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
 MONGO_URI = os.getenv("MONGO_URI")
 
 # MongoDB
-mongo_client = MongoClient(MONGO_URI)
-db = mongo_client["anonymous_chat_bot"]
-waiting_users_collection = db["waiting_users"]
-active_chats_collection = db["active_chats"]
-reports_collection = db["reports"]
+storage = create_storage(MONGO_URI)
+pairings = create_pairing_table(storage)
+# Banned users get no chats; reports feed the auto-ban counters
+moderation = Moderation(storage)
+# Language, age bracket and interests to match on
+preferences = PreferenceStore(storage)
+matchmaker = Matchmaker(pairings, storage.waiting, is_banned=moderation.is_banned, preferences=preferences)
+reaper = Reaper(matchmaker, pairings)
+
+# Drops webhook redeliveries and updates replayed after a restart
+deduplicator = create_deduplicator(storage)
+
+# Drops updates from users sending faster than FLOOD_LIMITS allows
+flood_control = FloodControl()
+
+# Paces all Bot API calls; partner notifications go ahead of relays
+sender = SendScheduler()
+
+# At most one "typing..." per partner every few seconds (TYPING_INDICATOR=0 disables it)
+typing_indicator = TypingIndicator()
+
+# /report submissions, journaled to disk and stored in batches
+report_sink = ReportSink(storage, on_stored=moderation.record)
+
+# Waiting users, active chats and queued sends for /metrics
+register_gauges(waiting=storage.waiting, pairings=pairings, sender=sender, flood=flood_control,
+                dedup=deduplicator)
+
+# Loaded while the bot initializes; chats wait for the schema migration
+startup.add("schema", storage.bootstrap)
+startup.add("chats", pairings.start, after=["schema"])
+startup.add("bans", moderation.start)
+startup.add("reports", report_sink.start)
 
 # Generate random nickname
 def generate_random_name():
@@ -44,71 +89,122 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/next - Find a new partner\n"
         "/stop - Stop chatting\n"
         "/report <reason> - Report bad behavior\n"
+        "/language <code> - Prefer partners who speak a language\n"
+        "/age <bracket> - Prefer partners in an age bracket\n"
+        "/interests <a, b> - Prefer partners who share an interest\n"
         "/help - Show this help message"
     )
 
 async def next_partner(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.chat_id
-    if active_chats_collection.find_one({"user_id": user_id}):
+    if moderation.is_banned(user_id):
+        await update.message.reply_text("🚫 You are banned from chatting.")
+        return
+    random_name = generate_random_name()
+    match = await matchmaker.next(user_id, nickname=random_name, start_time=time.time())
+    if match.status == ALREADY_CHATTING:
         await update.message.reply_text("❌ You are already chatting! Use /stop first.")
         return
-    waiting_user = waiting_users_collection.find_one()
-    if waiting_user:
-        partner_id = waiting_user['user_id']
-        random_name = generate_random_name()
-        active_chats_collection.insert_many([
-            {"user_id": user_id, "partner_id": partner_id, "nickname": random_name, "start_time": time.time()},
-            {"user_id": partner_id, "partner_id": user_id, "nickname": random_name, "start_time": time.time()}
-        ])
-        waiting_users_collection.delete_one({"user_id": partner_id})
-        await context.bot.send_message(chat_id=user_id, text=f"✅ Connected! You are now chatting with {random_name}.")
-        await context.bot.send_message(chat_id=partner_id, text=f"✅ Connected! You are now chatting with {random_name}.")
+    if match.status == PAIRED:
+        partner_id = match.partner_id
+        await context.bot.send_message(chat_id=user_id, text=f"✅ Connected! You are now chatting with {random_name}.", rate_limit_args=PRIORITY_NOTIFY)
+        await context.bot.send_message(chat_id=partner_id, text=f"✅ Connected! You are now chatting with {random_name}.", rate_limit_args=PRIORITY_NOTIFY)
     else:
-        waiting_users_collection.insert_one({"user_id": user_id})
         await update.message.reply_text("⏳ Waiting for a partner...")
 
 async def stop_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.chat_id
-    active_chat = active_chats_collection.find_one({"user_id": user_id})
-    if active_chat:
-        partner_id = active_chat['partner_id']
-        await context.bot.send_message(chat_id=partner_id, text="⚠️ Your partner has left the chat.")
-        active_chats_collection.delete_many({"user_id": {"$in": [user_id, partner_id]}})
+    partner_id = pairings.unpair(user_id)
+    if partner_id is not None:
+        await context.bot.send_message(chat_id=partner_id, text="⚠️ Your partner has left the chat.", rate_limit_args=PRIORITY_NOTIFY)
         await update.message.reply_text("✅ You left the chat.")
     else:
-        waiting_users_collection.delete_one({"user_id": user_id})
+        await matchmaker.cancel(user_id)
         await update.message.reply_text("❌ You are not chatting with anyone.")
 
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.chat_id
     text = update.message.text
     report_message = text.split("/report", 1)[1].strip() if len(text.split("/report", 1)) > 1 else "No reason given."
-    reports_collection.insert_one({
+    await report_sink.add({
         "user_id": user_id,
+        "reported_user_id": matchmaker.last_partner(user_id),
+        "nickname": pairings.nickname_of(user_id),
         "report": report_message,
         "timestamp": time.time()
     })
     await update.message.reply_text("✅ Report received. Thank you for helping us keep the community safe!")
 
+async def set_preference(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.chat_id
+    try:
+        choice = await preferences.set_from_command(user_id, update.message.text)
+    except ValueError as exc:
+        await update.message.reply_text(f"❌ {exc}")
+        return
+    await update.message.reply_text(f"✅ Matching on {describe(choice)}. This applies from your next /next.")
+
 async def relay_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.chat_id
+    if moderation.is_banned(user_id):
+        await update.message.reply_text("🚫 You are banned from chatting.")
+        return
     text = update.message.text
-    active_chat = active_chats_collection.find_one({"user_id": user_id})
-    if active_chat:
-        partner_id = active_chat['partner_id']
-        await context.bot.send_chat_action(chat_id=partner_id, action="typing")
-        await context.bot.send_message(chat_id=partner_id, text=text)
+    partner_id = pairings.partner_of(user_id)
+    if partner_id is not None:
+        pairings.touch(user_id)
+        typing_indicator.notify(context.bot, partner_id)
+        await context.bot.send_message(chat_id=partner_id, text=text, rate_limit_args=PRIORITY_RELAY)
+    else:
+        await update.message.reply_text("❗ You are not chatting with anyone. Use /next.")
+
+async def relay_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.chat_id
+    if moderation.is_banned(user_id):
+        await update.message.reply_text("🚫 You are banned from chatting.")
+        return
+    partner_id = pairings.partner_of(user_id)
+    if partner_id is not None:
+        pairings.touch(user_id)
+        await copy_to_partner(context.bot, update.message, partner_id)
     else:
         await update.message.reply_text("❗ You are not chatting with anyone. Use /next.")
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Unknown command.")
 
-# Flask app
-app = Flask(__name__)
+# Pairs made by relaxing preferences while both users were waiting
+async def announce_match(bot, user_id, partner_id):
+    nickname = pairings.nickname_of(user_id)
+    for chat_id in (user_id, partner_id):
+        await bot.send_message(chat_id=chat_id, text=f"✅ Connected! You are now chatting with {nickname}.", rate_limit_args=PRIORITY_NOTIFY)
+
+# Start matching relaxed preferences and reaping stale waiters and chats
+async def on_startup(application):
+    matchmaker.start(functools.partial(announce_match, application.bot))
+    reaper.start(application.bot)
+
+# Flush pending pairing changes and reports before exiting
+async def on_shutdown(application):
+    reaper.stop()
+    matchmaker.stop()
+    await pairings.stop()
+    await report_sink.stop()
+    await moderation.stop()
 
 # Telegram Application
-telegram_app = ApplicationBuilder().token(BOT_TOKEN).build()
+telegram_app = (
+    ApplicationBuilder()
+    .token(BOT_TOKEN)
+    .base_url(BOT_API_URL)
+    .application_class(BotApplication, kwargs={"deduplicator": deduplicator, "pair_key": pairings.pair_key,
+                                               "startup": startup, "flood_control": flood_control})
+    .rate_limiter(sender)
+    .concurrent_updates(True)
+    .post_init(on_startup)
+    .post_shutdown(on_shutdown)
+    .build()
+)
 
 # Add Handlers
 telegram_app.add_handler(CommandHandler("start", start))
@@ -116,20 +212,13 @@ telegram_app.add_handler(CommandHandler("help", help_command))
 telegram_app.add_handler(CommandHandler("next", next_partner))
 telegram_app.add_handler(CommandHandler("stop", stop_chat))
 telegram_app.add_handler(CommandHandler("report", report))
+telegram_app.add_handler(CommandHandler(["language", "age", "interests"], set_preference))
 telegram_app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), relay_message))
+telegram_app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & ~filters.TEXT & ~filters.StatusUpdate.ALL, relay_media))
 telegram_app.add_handler(MessageHandler(filters.COMMAND, unknown))
 
-@app.route('/')
-def home():
-    return 'Bot is running!'
-
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    if request.method == "POST":
-        update = Update.de_json(request.get_json(force=True), telegram_app.bot)
-        asyncio.run(telegram_app.process_update(update))
-    return "ok"
-
+# Flask app, serving home() and /webhook off one long-lived bot loop
+app = create_app(telegram_app, pairings)
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
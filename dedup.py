@@ -0,0 +1,113 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from metrics import DEDUP_CHECKS, DEDUP_FORGOTTEN
+from resilience import DependencyUnavailable
+
+logger = logging.getLogger(__name__)
+
+# How long an update_id is remembered; Telegram gives up redelivering well before this
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", 60 * 60))
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", 100_000))
+# Set DEDUP_SHARED=1 to also record update_ids in Mongo, so several
+# instances (or a restarted one) agree on what has been processed
+DEDUP_SHARED = os.getenv("DEDUP_SHARED", "0") == "1"
+
+
+class UpdateDeduplicator:
+    """Bounded, time-windowed record of processed update_ids.
+
+    The local cache is an OrderedDict in arrival order, so expiring old ids
+    and evicting the oldest when full are both O(1) per id. An optional
+    shared store is asked only when the local cache misses. If the store
+    can't be reached the update is let through: a missed duplicate is
+    cheaper than a lost update.
+
+    Checks are counted by outcome in bot_dedup_checks_total ("unchecked"
+    when the store failed), and ids leaving
+    the cache in bot_dedup_forgotten_total: "expired" once older than the
+    TTL, "evicted" when dropped early to stay within max_size. Evictions
+    mean the cache is too small to cover the TTL.
+    """
+
+    def __init__(self, max_size=DEDUP_MAX_SIZE, ttl=DEDUP_TTL_SECONDS, store=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self._seen = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def stats(self):
+        return {"size": len(self._seen), "hits": self.hits, "misses": self.misses, "expired": self.expired,
+                "evictions": self.evictions}
+
+    def _expire(self, now):
+        seen = self._seen
+        while seen:
+            update_id, seen_at = next(iter(seen.items()))
+            if now - seen_at >= self.ttl:
+                self.expired += 1
+                DEDUP_FORGOTTEN.inc("expired")
+            elif len(seen) >= self.max_size:
+                self.evictions += 1
+                DEDUP_FORGOTTEN.inc("evicted")
+            else:
+                break
+            del seen[update_id]
+
+    def _hit(self):
+        self.hits += 1
+        DEDUP_CHECKS.inc("duplicate")
+        return True
+
+    def _miss(self):
+        self.misses += 1
+        DEDUP_CHECKS.inc("new")
+        return False
+
+    def seen(self, update_id):
+        """Record update_id locally and return True if it had been seen before.
+
+        With a shared store, seen_shared() must be asked too before handling
+        the update; BotApplication does that in the update's chat order.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        if update_id in self._seen:
+            return self._hit()
+        self._seen[update_id] = now
+        if self.store is None:
+            return self._miss()
+        return False
+
+    async def seen_shared(self, update_id):
+        """Record update_id in the shared store and return True if it was there already."""
+        if self.store is None:
+            return False
+        try:
+            added = await self.store.add(update_id)
+        except DependencyUnavailable:
+            # The circuit breaker has logged the outage already
+            DEDUP_CHECKS.inc("unchecked")
+            return False
+        except Exception:
+            logger.warning("Shared dedup check of update %s failed, handling it anyway", update_id, exc_info=True)
+            DEDUP_CHECKS.inc("unchecked")
+            return False
+        return self._miss() if added else self._hit()
+
+    async def is_duplicate(self, update_id):
+        """Record update_id and return True if it had been seen before."""
+        return self.seen(update_id) or await self.seen_shared(update_id)
+
+
+def create_deduplicator(storage):
+    """Deduplicator for an entry point, sharing state through storage if DEDUP_SHARED is set."""
+    return UpdateDeduplicator(store=storage.seen_updates if DEDUP_SHARED else None)
@@ -0,0 +1,123 @@
+"""Per-user flood control, checked before any handler runs.
+
+Every user has a token bucket per kind of update: one kind per command
+named in FLOOD_LIMITS, "command" for the other commands, and "relay" for
+messages to a partner. An update that finds its bucket empty is dropped
+before it takes any lock or reaches a handler, so a user hammering /next
+costs one dict lookup per update instead of Mongo and Bot API calls. The
+first drop in a row gets FLOOD_WARNING_TEXT sent back; the rest are silent
+until the user's updates go through again. Drops are counted per kind in
+flood_dropped_updates_total.
+
+Buckets live in one LRU table, least recently used first, keyed by a
+single int per user and kind so no key tuple is built per update. A bucket
+untouched long enough to have refilled is the same as no bucket, so those
+are dropped from the front whenever a bucket is added, and
+FLOOD_TABLE_SIZE caps the table whatever the traffic.
+"""
+import os
+import time
+from collections import OrderedDict, namedtuple
+from metrics import FLOOD_DROPS
+
+# "kind=count/seconds": at most count updates of that kind per user in any
+# seconds-long window, bursts included; an empty value turns flood control off.
+# Relays are capped at the partner chat's send rate (SEND_CHAT_RATE, 1/s), or a
+# fast typist's backlog would grow without bound
+FLOOD_LIMITS = os.getenv("FLOOD_LIMITS", "next=20/60,stop=20/60,report=5/60,command=30/60,relay=10/10")
+FLOOD_TABLE_SIZE = int(os.getenv("FLOOD_TABLE_SIZE", 200_000))
+
+FLOOD_WARNING_TEXT = "🐢 Slow down! You're sending too fast, so your messages are being ignored for a moment."
+
+# Verdicts of FloodControl.check()
+ALLOWED = "allowed"
+WARN = "warn"
+DROPPED = "dropped"
+
+# rate in tokens per second, capacity in tokens
+Limit = namedtuple("Limit", ["rate", "capacity"])
+
+
+def parse_limits(spec):
+    """{kind: Limit} from a FLOOD_LIMITS value such as "next=20/60,relay=10/10"."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            kind, rule = item.split("=")
+            count, seconds = (float(value) for value in rule.split("/"))
+            limits[kind.strip().lstrip("/").lower()] = Limit(count / seconds, count)
+        except (ValueError, ZeroDivisionError):
+            raise ValueError(f"FLOOD_LIMITS entries look like next=20/60, not {item!r}") from None
+    return limits
+
+
+def kind_of(message, limits):
+    """The kind of update message is, for picking its limit."""
+    text = message.text
+    if text and text.startswith("/"):
+        command = text.split(maxsplit=1)[0][1:].split("@")[0].lower()
+        return command if command in limits else "command"
+    return "relay"
+
+
+class FloodControl:
+    def __init__(self, limits=FLOOD_LIMITS, max_size=FLOOD_TABLE_SIZE):
+        self.limits = parse_limits(limits) if isinstance(limits, str) else dict(limits)
+        self.max_size = max_size
+        # kind -> (its number in bucket keys, Limit)
+        self._kinds = {kind: (number, limit) for number, (kind, limit) in enumerate(self.limits.items())}
+        # user_id * len(kinds) + kind number -> [updated, tokens, warned], least recently used first
+        self._buckets = OrderedDict()
+        # Any bucket left alone this long is full again
+        self._refilled_after = max((limit.capacity / limit.rate for limit in self.limits.values()), default=0)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def __bool__(self):
+        return bool(self.limits)
+
+    def stats(self):
+        return {"buckets": len(self._buckets), "dropped": sum(FLOOD_DROPS.value(kind) for kind in self.limits)}
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            updated = next(iter(buckets.values()))[0]
+            if now - updated < self._refilled_after and len(buckets) <= self.max_size:
+                break
+            buckets.popitem(last=False)
+
+    def check(self, user_id, kind):
+        """Take a token for one update of kind from user_id: ALLOWED, WARN (dropped, tell
+        the user) or DROPPED."""
+        entry = self._kinds.get(kind)
+        if entry is None:
+            return ALLOWED
+        number, limit = entry
+        now = time.monotonic()
+        key = user_id * len(self._kinds) + number
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [now, limit.capacity, False]
+            self._expire(now)
+        else:
+            bucket[1] = min(limit.capacity, bucket[1] + (now - bucket[0]) * limit.rate)
+            bucket[0] = now
+            self._buckets.move_to_end(key)
+        if bucket[1] >= 1:
+            bucket[1] -= 1
+            bucket[2] = False
+            return ALLOWED
+        FLOOD_DROPS.inc(kind)
+        if bucket[2]:
+            return DROPPED
+        bucket[2] = True
+        return WARN
+
+    def check_update(self, update):
+        """check() for a message update; other updates are always ALLOWED."""
+        message = update.message
+        if message is None or update.effective_chat is None:
+            return ALLOWED
+        return self.check(update.effective_chat.id, kind_of(message, self.limits))
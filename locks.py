@@ -0,0 +1,31 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class KeyedLock:
+    """One asyncio.Lock per key, created on demand and dropped when unused."""
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key):
+        """Whether key's lock is held."""
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
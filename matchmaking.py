@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+from locks import KeyedLock
+from metrics import MATCHES, MATCH_WAIT_SECONDS
+from preferences import MATCH_RELAX_AFTER, level_buckets
+from storage import ANY_BUCKET
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of Matchmaker.next()
+PAIRED = "paired"
+WAITING = "waiting"
+ALREADY_WAITING = "already_waiting"
+ALREADY_CHATTING = "already_chatting"
+
+# How often waiting users are checked for a looser match
+MATCH_RELAX_INTERVAL = float(os.getenv("MATCH_RELAX_INTERVAL", 1))
+# Partners remembered per user (0 disables the check), and for how long
+RECENT_PARTNERS = int(os.getenv("RECENT_PARTNERS", 3))
+RECENT_PARTNER_SECONDS = float(os.getenv("RECENT_PARTNER_SECONDS", 600))
+# Users remembered at most; the least recently paired are forgotten first
+RECENT_PARTNER_USERS = int(os.getenv("RECENT_PARTNER_USERS", 1_000_000))
+
+Match = namedtuple("Match", ["status", "partner_id"])
+
+
+class RecentPartners:
+    """Each user's last few partners, so /next doesn't pair two people again right away.
+
+    A user's entry is a tuple of at most size partner ids, newest first,
+    which the waiting queue passes over when claiming for them; reading it
+    is one dict lookup and the queue looks at no more than size extra
+    users. Entries sit in an LRU ordered by when the user was last paired:
+    an entry not refreshed for ttl seconds has expired as a whole and is
+    dropped from the front, and max_users caps the total, so memory stays
+    bounded however many distinct users come through.
+    """
+
+    def __init__(self, size=RECENT_PARTNERS, ttl=RECENT_PARTNER_SECONDS, max_users=RECENT_PARTNER_USERS):
+        self.size = size
+        self.ttl = ttl
+        self.max_users = max_users
+        # user_id -> (last paired at, *partner ids), least recently paired first;
+        # one flat tuple per user keeps the per-user overhead to a minimum
+        self._recent = OrderedDict()
+
+    def __len__(self):
+        return len(self._recent)
+
+    def add(self, user_id, partner_id):
+        if not self.size:
+            return
+        now = time.monotonic()
+        for user, partner in ((user_id, partner_id), (partner_id, user_id)):
+            entry = self._recent.pop(user, None)
+            earlier = () if entry is None or now - entry[0] > self.ttl else entry[1:]
+            self._recent[user] = (now, partner, *[other for other in earlier if other != partner][:self.size - 1])
+        while self._recent:
+            paired_at = next(iter(self._recent.values()))[0]
+            if now - paired_at <= self.ttl and len(self._recent) <= self.max_users:
+                break
+            self._recent.popitem(last=False)
+
+    def of(self, user_id):
+        """Partners user_id shouldn't be matched with again yet."""
+        entry = self._recent.get(user_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return ()
+        return entry[1:]
+
+
+class Matchmaker:
+    """Claim-and-pair matchmaking for /next.
+
+    A claim takes the waiting user off the queue atomically (with
+    MongoWaitingQueue it is a find_one_and_delete), so concurrent /next
+    calls, in this process or another sharing the collection, can't hand the
+    same stranger to two users. What is left to guard is the caller: next(),
+    cancel() and relaxing a waiter hold a per-user lock, so one user's steps
+    never interleave, and the in-process pairings are checked again right
+    before a pair is recorded, with no await in between, so a user who got
+    paired meanwhile isn't paired twice (a claim never returns the caller,
+    which rules out self-matches). A user claimed while their own /next is
+    under way may get queued again by it, so the claimer removes any new
+    entry once the pair is recorded, and a /next that queued its user checks
+    for a pair afterwards and does the same. A claimed user who can't be
+    paired after all is only put back while no step of theirs is running. No
+    lock is waited on across users, so a slow Mongo round-trip or shard
+    offer only holds up its own /next. A sharded PairingTable uses
+    pair_claimed to confirm the pair with the shard that owns the claimed
+    user; if that fails without a clear answer, the claimed user goes back
+    to their old place in the queue and the caller is queued as if nobody
+    had been waiting. Claimed users for whom is_banned() is true are dropped
+    from the queue instead of paired, and the claim passes over the caller's
+    recent partners.
+
+    With a PreferenceStore, /next only takes a partner from the caller's
+    exact-match buckets; relax(), run every MATCH_RELAX_INTERVAL seconds
+    after start(), pairs users who have waited long enough for a looser
+    match and reports each pair to on_match.
+    """
+
+    def __init__(self, pairings, queue, is_banned=None, preferences=None, relax_after=MATCH_RELAX_AFTER,
+                 recent=None):
+        self.pairings = pairings
+        self.queue = queue
+        self.is_banned = is_banned
+        self.preferences = preferences
+        self.relax_after = relax_after
+        self.recent = RecentPartners() if recent is None else recent
+        self._locks = KeyedLock()
+        self._relaxed_until = None
+        self._relaxer = None
+
+    async def _claim(self, user_id, buckets, enqueued_before, fields, waiter=None):
+        """Pair user_id with waiter, or with a user claimed from buckets, skipping
+        anyone who can't be paired; returns the partner's Waiter or None."""
+        while True:
+            if waiter is None:
+                waiter = await self.queue.claim(user_id, buckets, enqueued_before, self.recent.of(user_id))
+                if waiter is None:
+                    return None
+            if self.pairings.get(user_id):
+                # user_id was paired by someone else meanwhile; the partner keeps their place
+                await self._put_back(waiter)
+                return None
+            # Drop banned users, and stale entries for users who got paired some other way
+            if not (self.is_banned and self.is_banned(waiter.user_id)):
+                try:
+                    paired = await self.pairings.pair_claimed(user_id, waiter.user_id, **fields)
+                except Exception as exc:
+                    logger.warning("Pairing %s with %s failed, putting %s back in the queue: %r",
+                                   user_id, waiter.user_id, waiter.user_id, exc)
+                    await self._put_back(waiter)
+                    return None
+                if paired:
+                    # A /next of theirs may have queued them again since the claim
+                    await self.queue.remove(waiter.user_id)
+                    self.recent.add(user_id, waiter.user_id)
+                    MATCH_WAIT_SECONDS.observe((datetime.now(timezone.utc) - waiter.enqueued_at).total_seconds())
+                    return waiter
+            waiter = None
+
+    async def next(self, user_id, **fields):
+        """Pair user_id with the longest-waiting compatible user, or queue them.
+
+        fields are stored on the chat record when a pair is made.
+        """
+        async with self._locks.hold(user_id):
+            if self.pairings.get(user_id):
+                return Match(ALREADY_CHATTING, None)
+            if await self.queue.contains(user_id):
+                return Match(ALREADY_WAITING, None)
+
+            levels = await self.preferences.buckets(user_id) if self.preferences else ((ANY_BUCKET,),)
+            waiter = await self._claim(user_id, levels[0], None, fields)
+            if waiter is not None:
+                MATCHES.inc("0")
+                return Match(PAIRED, waiter.user_id)
+            # Claimed by another user while this /next was under way
+            if self.pairings.get(user_id):
+                return Match(ALREADY_CHATTING, None)
+
+            buckets = [bucket for level in levels for bucket in level if bucket != ANY_BUCKET]
+            await self.queue.enqueue(user_id, buckets, fields)
+            if self.pairings.get(user_id):
+                # Paired while being queued; the claimer takes the entry out too
+                await self.queue.remove(user_id)
+                return Match(ALREADY_CHATTING, None)
+            return Match(WAITING, None)
+
+    def last_partner(self, user_id):
+        """user_id's partner, or if they've left the chat, whoever they were
+        last paired with in the past RECENT_PARTNER_SECONDS; None otherwise."""
+        partner_id = self.pairings.partner_of(user_id)
+        if partner_id is None:
+            recent = self.recent.of(user_id)
+            partner_id = recent[0] if recent else None
+        return partner_id
+
+    async def cancel(self, user_id):
+        """Take user_id out of the waiting queue; False if they weren't waiting."""
+        async with self._locks.hold(user_id):
+            return await self.queue.remove(user_id)
+
+    async def _put_back(self, waiter):
+        """Return a claimed user to their old place in the queue.
+
+        Not if they're chatting by now, or if a /next or relax of theirs is
+        under way: that decides where they go, and an entry put back behind
+        its back could outlive the pair it makes. The lock is only taken
+        when free, so this never waits on another user.
+        """
+        if self.pairings.get(waiter.user_id) or self._locks.locked(waiter.user_id):
+            return
+        async with self._locks.hold(waiter.user_id):
+            await self.queue.enqueue(waiter.user_id, waiter.buckets, waiter.fields, waiter.enqueued_at)
+
+    async def expire(self, before, limit):
+        """Drop up to limit users who joined the queue no later than before; returns their Waiters.
+
+        Each removal is for the exact queue entry seen, so it needs no lock.
+        """
+        return await self.queue.expire(before, limit)
+
+    async def _relax_waiter(self, waiter, level, enqueued_before):
+        if self.is_banned and self.is_banned(waiter.user_id):
+            return None
+        buckets = level_buckets(waiter.buckets, level)
+        if not buckets:
+            return None
+        partner = await self.queue.claim(waiter.user_id, buckets, enqueued_before, self.recent.of(waiter.user_id))
+        if partner is None:
+            return None
+        # Two entries can't be claimed atomically, so the partner went first
+        if not await self.queue.remove(waiter.user_id):
+            await self._put_back(partner)
+            return None
+        # The chat starts now, not when they queued
+        fields = {key: value for key, value in (waiter.fields or {}).items() if key != "start_time"}
+        partner = await self._claim(waiter.user_id, buckets, enqueued_before, fields, partner)
+        if partner is None:
+            # Every partner claimed was stale; back in line where they were
+            await self.queue.enqueue(waiter.user_id, waiter.buckets, waiter.fields, waiter.enqueued_at)
+            return None
+        MATCH_WAIT_SECONDS.observe((datetime.now(timezone.utc) - waiter.enqueued_at).total_seconds())
+        MATCHES.inc(str(level))
+        return partner
+
+    async def relax(self):
+        """Pair users who have just waited long enough to accept a looser match.
+
+        Each run looks at the users who crossed a relaxation step since the
+        previous one, oldest first, and tries their bucket at the new level
+        among users who have waited at least as long. Returns the pairs made
+        as (user_id, partner_id).
+        """
+        now = datetime.now(timezone.utc)
+        since = self._relaxed_until or now
+        pairs = []
+        for level, delay in enumerate(self.relax_after, 1):
+            delay = timedelta(seconds=delay)
+            for waiter in await self.queue.waiting_between(since - delay, now - delay):
+                # Another shard relaxes its own users
+                if not self.pairings.owns(waiter.user_id):
+                    continue
+                async with self._locks.hold(waiter.user_id):
+                    partner = await self._relax_waiter(waiter, level, now - delay)
+                if partner is not None:
+                    pairs.append((waiter.user_id, partner.user_id))
+        self._relaxed_until = now
+        return pairs
+
+    async def _relax_forever(self, on_match):
+        while True:
+            await asyncio.sleep(MATCH_RELAX_INTERVAL)
+            try:
+                pairs = await self.relax()
+            except Exception:
+                logger.exception("Relaxing waiting users' preferences failed")
+                continue
+            for user_id, partner_id in pairs:
+                try:
+                    await on_match(user_id, partner_id)
+                except Exception:
+                    logger.exception("Announcing the match of %s and %s failed", user_id, partner_id)
+
+    def start(self, on_match):
+        """Start relaxing preferences in the background; on_match(user_id, partner_id) announces pairs."""
+        if self.preferences and self._relaxer is None:
+            self._relaxed_until = datetime.now(timezone.utc)
+            self._relaxer = asyncio.create_task(self._relax_forever(on_match))
+
+    def stop(self):
+        if self._relaxer:
+            self._relaxer.cancel()
+            self._relaxer = None
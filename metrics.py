@@ -0,0 +1,261 @@
+"""Process metrics in the Prometheus text format.
+
+Recording is a dict lookup and an add on the bot's event loop, so it can sit
+on every handler call and Bot API request. The shared hooks are:
+
+- BotApplication times every handler callback and counts the Mongo
+  round-trips each update makes;
+- SendScheduler counts Bot API calls and errors per method;
+- storage counts Mongo round-trips per operation (@mongo_call);
+- Matchmaker records how long a user waited before being matched, and at
+  which preference relaxation level.
+
+Gauges are read when scraped. Webhook entry points serve /metrics on their
+Flask app; polling ones start an exporter on METRICS_PORT with start_exporter().
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Port of the standalone exporter for the polling bots; 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WAIT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16)
+
+_registry = {}
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _registry[name] = self
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    async def render(self):
+        lines = self._header()
+        for labels, value in list(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            # Per-bucket (not cumulative) counts, then sum and count
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    async def render(self):
+        lines = self._header()
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {series[-1]}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Value read from a callback (sync or async) at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        super().__init__(name, help)
+        self.read = read
+
+    async def render(self):
+        value = self.read()
+        if inspect.isawaitable(value):
+            value = await value
+        return self._header() + [f"{self.name} {value}"]
+
+
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Time spent in each handler callback.", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler callbacks that raised.", ("handler",))
+BOT_API_CALLS = Counter("bot_api_calls_total", "Bot API requests made, by method.", ("method",))
+BOT_API_ERRORS = Counter("bot_api_errors_total", "Bot API requests that failed, by method and error.",
+                         ("method", "error"))
+MONGO_CALLS = Counter("mongo_round_trips_total", "MongoDB round-trips, by operation.", ("operation",))
+MONGO_PER_UPDATE = Histogram("mongo_round_trips_per_update", "MongoDB round-trips made while handling one update.",
+                             buckets=COUNT_BUCKETS)
+MATCHES = Counter("matches_total", "Chats started, by preference relaxation level (0 = exact match).", ("level",))
+MATCH_WAIT_SECONDS = Histogram("match_wait_seconds", "Time users spent in the waiting queue before being matched.",
+                               buckets=WAIT_BUCKETS)
+FLOOD_DROPS = Counter("flood_dropped_updates_total", "Updates dropped by per-user flood control, by kind.",
+                      ("kind",))
+CIRCUIT_TRANSITIONS = Counter("circuit_breaker_transitions_total", "Circuit breaker state changes, by dependency and new state.",
+                              ("dependency", "state"))
+DEPENDENCY_RETRIES = Counter("dependency_retries_total", "Calls retried after a transient failure, by dependency.",
+                             ("dependency",))
+NOTIFICATIONS_BUFFERED = Counter("bot_notifications_buffered_total",
+                                 "Notifications held back while the Bot API was failing, by what became of them.",
+                                 ("outcome",))
+DEDUP_CHECKS = Counter("bot_dedup_checks_total",
+                       "Updates checked by the deduplicator, by outcome (duplicate, new, or unchecked if the store failed).",
+                       ("outcome",))
+DEDUP_FORGOTTEN = Counter("bot_dedup_forgotten_total",
+                          "update_ids dropped from the deduplicator's cache, by reason (expired or evicted when full).",
+                          ("reason",))
+REAPED = Counter("reaped_total", "Waiting users and chat participants expired for inactivity.", ("kind",))
+
+# Round-trips of the update being processed in the current task
+_update_round_trips = contextvars.ContextVar("update_round_trips", default=None)
+
+
+def mongo_call(func):
+    """Count each call of an async storage method as one Mongo round-trip."""
+    operation = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        MONGO_CALLS.inc(operation)
+        counter = _update_round_trips.get()
+        if counter is not None:
+            counter[0] += 1
+        with span("db", operation):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def start_update():
+    """Start counting Mongo round-trips for the update handled by the current task."""
+    return _update_round_trips.set([0])
+
+
+def finish_update(token):
+    MONGO_PER_UPDATE.observe(_update_round_trips.get()[0])
+    _update_round_trips.reset(token)
+
+
+def timed_callback(callback):
+    """Wrap a handler callback so its duration and failures are recorded."""
+    name = getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+
+def register_gauges(waiting=None, pairings=None, sender=None, flood=None, dedup=None):
+    """Expose the waiting queue, the pairing table, the send queue, the flood-control table and the
+    deduplicator's cache as gauges."""
+    if waiting is not None:
+        Gauge("bot_waiting_users", "Users waiting for a partner.", waiting.count)
+    if pairings is not None:
+        Gauge("bot_active_chats", "Chats in progress (this process's view).", lambda: len(pairings))
+    if sender is not None:
+        Gauge("bot_send_queue_depth", "Bot API requests queued by the send scheduler.",
+              lambda: sender.stats()["queue_depth"])
+        Gauge("bot_notifications_held", "Notifications held back until the Bot API recovers.",
+              lambda: sender.stats()["held"])
+    if flood is not None:
+        Gauge("bot_flood_buckets", "Per-user flood-control buckets held in memory.", lambda: len(flood))
+    if dedup is not None:
+        Gauge("bot_dedup_cache_size", "update_ids held in the deduplicator's local cache.", lambda: len(dedup))
+
+
+async def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(_registry.values()):
+        try:
+            lines.extend(await metric.render())
+        except Exception:
+            logger.exception("Reading metric %s failed", metric.name)
+    return "\n".join(lines) + "\n"
+
+
+def start_exporter(loop, port=METRICS_PORT):
+    """Serve /metrics on port from a background thread, reading metrics on loop.
+
+    For the polling bots, which have no web server; call it from post_init.
+    Does nothing when port is 0.
+    """
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = asyncio.run_coroutine_threadsafe(render(), loop).result(timeout=10).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    logger.info("Serving metrics on :%d/metrics", port)
+    return server
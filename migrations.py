@@ -0,0 +1,244 @@
+"""Index bootstrap and schema checks for the anonymous_chat_bot database.
+
+Runs automatically when the bot starts (MongoStorage.bootstrap), and can be
+run by hand:
+
+    python migrations.py            migrate legacy data and create any missing indexes
+    python migrations.py --check    exit non-zero if an index is missing
+    python migrations.py --explain  show the plan and index usage of the handler queries
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING, DeleteMany, IndexModel, ReplaceOne
+from dedup import DEDUP_TTL_SECONDS
+from pairings import new_session, session_id
+
+logger = logging.getLogger(__name__)
+
+# Abandoned waiters are dropped by Mongo itself after this long
+WAITING_TTL_SECONDS = int(os.getenv("WAITING_TTL_SECONDS", 24 * 60 * 60))
+
+INDEXES = {
+    "waiting_users": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("enqueued_at", ASCENDING)], expireAfterSeconds=WAITING_TTL_SECONDS, name="enqueued_at_ttl"),
+        # Multikey: one entry per preference bucket, oldest waiter first
+        IndexModel([("buckets", ASCENDING), ("enqueued_at", ASCENDING)], name="buckets_enqueued_at"),
+    ],
+    "active_chats": [
+        # Multikey: either participant finds the session, and no user can
+        # be in two sessions at once
+        IndexModel([("users", ASCENDING)], unique=True, name="users_unique"),
+    ],
+    "reports": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)], name="user_id_timestamp"),
+        IndexModel([("reported_user_id", ASCENDING), ("timestamp", DESCENDING)], name="reported_user_id_timestamp"),
+        IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+    ],
+    "processed_updates": [
+        IndexModel([("seen_at", ASCENDING)], expireAfterSeconds=DEDUP_TTL_SECONDS, name="seen_at_ttl"),
+    ],
+}
+
+# Indexes from earlier schemas that must go before INDEXES can be built
+LEGACY_INDEXES = {
+    "active_chats": ["user_id_unique"],
+}
+
+# Stand-in for the times the relax queries compare against
+_SAMPLE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# The queries the handlers actually issue, as (collection, filter, sort)
+HANDLER_QUERIES = {
+    "matchmaker.next: queued check": ("waiting_users", {"user_id": 0}, None),
+    "matchmaker.next: claim": ("waiting_users", {"user_id": {"$ne": 0}, "buckets": {"$in": ["0:en:-:music", "0:en:-:art"]}},
+                               {"enqueued_at": 1}),
+    "matchmaker.relax: newly relaxed": ("waiting_users", {"enqueued_at": {"$gt": _SAMPLE_TIME, "$lte": _SAMPLE_TIME}},
+                                        {"enqueued_at": 1}),
+    "matchmaker.relax: claim": ("waiting_users", {"user_id": {"$ne": 0}, "buckets": {"$in": ["2:en"]},
+                                                  "enqueued_at": {"$lte": _SAMPLE_TIME}}, {"enqueued_at": 1}),
+    "stop_chat: cancel waiting": ("waiting_users", {"user_id": 0}, None),
+    "storage.find_active_chat": ("active_chats", {"users": 0}, None),
+    "pairings: end chat": ("active_chats", {"_id": "0:1"}, None),
+    "reports: by user": ("reports", {"user_id": 0}, {"timestamp": -1}),
+    "reports: against user": ("reports", {"reported_user_id": 0}, {"timestamp": -1}),
+}
+
+
+async def migrate_active_chats(db):
+    """Fold legacy two-row chats into single session documents.
+
+    The old layout stored each chat twice, as {user_id, partner_id, nickname,
+    start_time} with the ids swapped. Returns the number of sessions written.
+    """
+    legacy = await db.active_chats.find({"user_id": {"$exists": True}}).sort("start_time", DESCENDING).to_list(None)
+    if not legacy:
+        return 0
+
+    sessions = {}
+    seen = set()
+    for row in legacy:
+        user_id, partner_id = row["user_id"], row.get("partner_id")
+        if partner_id is None or session_id(user_id, partner_id) in sessions:
+            continue
+        # Old races could leave a user in two chats; keep only the newest
+        if user_id in seen or partner_id in seen:
+            continue
+        fields = {key: row[key] for key in ("nickname", "start_time") if key in row}
+        session = new_session(user_id, partner_id, **fields)
+        session["last_activity"] = session["start_time"]
+        sessions[session["_id"]] = session
+        seen.update((user_id, partner_id))
+
+    requests = [ReplaceOne({"_id": sid}, session, upsert=True) for sid, session in sessions.items()]
+    requests.append(DeleteMany({"user_id": {"$exists": True}}))
+    await db.active_chats.bulk_write(requests, ordered=True)
+    logger.info("Migrated %d legacy active_chats rows into %d sessions", len(legacy), len(sessions))
+    return len(sessions)
+
+
+async def migrate_waiting_users(db):
+    """Backfill enqueued_at and buckets on legacy waiting_users rows.
+
+    The old layout stored only {user_id}, which no claim, relax or expiry
+    query (nor the TTL index) matches, so those users would wait forever.
+    They predate preferences, so they get the buckets of a user who set
+    none, and the time their row was inserted as enqueued_at to keep their
+    place. Returns the number of rows migrated.
+    """
+    # storage imports this module, so these can't be imported at the top
+    from preferences import Preferences, bucket_keys
+    from storage import ANY_BUCKET
+
+    buckets = [bucket for level in bucket_keys(Preferences()) for bucket in level if bucket != ANY_BUCKET]
+    result = await db.waiting_users.update_many(
+        {"$or": [{"enqueued_at": {"$exists": False}}, {"buckets": {"$exists": False}}]},
+        [{"$set": {
+            "enqueued_at": {"$ifNull": ["$enqueued_at", {"$convert": {"input": "$_id", "to": "date",
+                                                                       "onError": "$$NOW", "onNull": "$$NOW"}}]},
+            "buckets": {"$ifNull": ["$buckets", buckets]},
+        }}],
+    )
+    if result.modified_count:
+        logger.info("Migrated %d legacy waiting_users rows", result.modified_count)
+    return result.modified_count
+
+
+async def drop_legacy_indexes(db):
+    for collection, names in LEGACY_INDEXES.items():
+        existing = await db[collection].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection].drop_index(name)
+                logger.info("Dropped legacy index %s.%s", collection, name)
+
+
+async def bootstrap(db):
+    """Bring the database up to the current schema: drop legacy indexes,
+    migrate data, then create indexes.
+
+    The legacy indexes must go first: the old unique active_chats.user_id
+    index sees every migrated session (which has no user_id) as null, so it
+    would reject the second one.
+    """
+    await drop_legacy_indexes(db)
+    await migrate_active_chats(db)
+    await migrate_waiting_users(db)
+    await ensure_indexes(db)
+
+
+async def ensure_indexes(db):
+    """Create every index in INDEXES; existing identical indexes are left alone.
+
+    Collections are done concurrently, so a cold start pays for one round-trip
+    rather than one per collection."""
+    async def ensure(collection, indexes):
+        names = await db[collection].create_indexes(indexes)
+        logger.info("%s indexes: %s", collection, ", ".join(names))
+
+    await asyncio.gather(*(ensure(collection, indexes) for collection, indexes in INDEXES.items()))
+
+
+async def missing_indexes(db):
+    """Return (collection, index name) for each index in INDEXES that doesn't exist."""
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = await db[collection].index_information()
+        missing.extend((collection, index.document["name"]) for index in indexes
+                       if index.document["name"] not in existing)
+    return missing
+
+
+def _winning_stages(plan):
+    # Flatten the winning plan into "STAGE(index)" strings, outermost first
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if "indexName" in plan:
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages
+
+
+async def explain_queries(db):
+    """Return {query name: [plan stages]} for HANDLER_QUERIES."""
+    plans = {}
+    for name, (collection, query, sort) in HANDLER_QUERIES.items():
+        command = {"find": collection, "filter": query, "limit": 1}
+        if sort:
+            command["sort"] = sort
+        result = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        plans[name] = _winning_stages(result["queryPlanner"]["winningPlan"])
+    return plans
+
+
+async def index_usage(db):
+    """Return {collection: {index name: ops}} from $indexStats since the server started."""
+    usage = {}
+    for collection in INDEXES:
+        stats = await db[collection].aggregate([{"$indexStats": {}}]).to_list(None)
+        usage[collection] = {stat["name"]: stat["accesses"]["ops"] for stat in stats}
+    return usage
+
+
+async def _main(args):
+    from storage import MongoStorage
+
+    storage = MongoStorage(os.getenv("MONGO_URI"))
+    db = storage.db
+    try:
+        if args.check:
+            missing = await missing_indexes(db)
+            for collection, name in missing:
+                print(f"missing: {collection}.{name}")
+            return 1 if missing else 0
+
+        if args.explain:
+            for name, stages in (await explain_queries(db)).items():
+                flag = "  <-- collection scan" if "COLLSCAN" in stages else ""
+                print(f"{name}: {' <- '.join(stages)}{flag}")
+            for collection, indexes in (await index_usage(db)).items():
+                for index, ops in indexes.items():
+                    print(f"{collection}.{index}: {ops} ops")
+            return 0
+
+        await bootstrap(db)
+        print("✅ Schema and indexes are up to date.")
+        return 0
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="only verify that every index exists")
+    parser.add_argument("--explain", action="store_true", help="explain the handler queries and show index usage")
+    raise SystemExit(asyncio.run(_main(parser.parse_args())))
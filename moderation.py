@@ -0,0 +1,106 @@
+"""Report counters, automatic bans and the in-memory ban list.
+
+Stored reports are counted per reported user in report_counts, one count
+per distinct reporter, so a single user spamming /report can't get their
+partner banned. Reaching BAN_THRESHOLD reporters bans the user. Handlers
+check bans against an in-memory set, refreshed from the bans collection
+every BAN_REFRESH_INTERVAL seconds so bans made by other processes (or by
+hand) take effect everywhere.
+
+    python moderation.py list              show banned users
+    python moderation.py ban USER_ID       ban by hand
+    python moderation.py unban USER_ID     lift a ban and reset the user's report count
+"""
+import argparse
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Distinct reporters that get a user banned
+BAN_THRESHOLD = int(os.getenv("BAN_THRESHOLD", 5))
+BAN_REFRESH_INTERVAL = float(os.getenv("BAN_REFRESH_INTERVAL", 60))
+
+
+class Moderation:
+    def __init__(self, storage, threshold=BAN_THRESHOLD, refresh_interval=BAN_REFRESH_INTERVAL):
+        self.storage = storage
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self._banned = set()
+        self._refresher = None
+
+    def __len__(self):
+        return len(self._banned)
+
+    def is_banned(self, user_id):
+        return user_id in self._banned
+
+    async def record(self, reports):
+        """Count stored reports and ban whoever crossed the threshold; returns the newly banned."""
+        pairs = [(report["reported_user_id"], report["user_id"]) for report in reports
+                 if report.get("reported_user_id") is not None]
+        if not pairs:
+            return []
+        counts = await self.storage.count_reports(pairs)
+        banned = [user_id for user_id, count in counts.items()
+                  if count >= self.threshold and user_id not in self._banned]
+        if banned:
+            await self.storage.add_bans(banned, reason=f"reported by {self.threshold}+ users")
+            self._banned.update(banned)
+            logger.warning("Auto-banned %d users: %s", len(banned), banned)
+        return banned
+
+    async def refresh(self):
+        self._banned = await self.storage.load_bans()
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Refreshing the ban list failed")
+
+    async def start(self):
+        await self.refresh()
+        self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._refresher:
+            self._refresher.cancel()
+            self._refresher = None
+
+
+async def _main(args):
+    from storage import create_storage
+
+    storage = create_storage(os.getenv("MONGO_URI"))
+    try:
+        if args.command == "ban":
+            await storage.add_bans([args.user_id], reason="banned by hand")
+            print(f"🚫 Banned {args.user_id}; running bots pick it up within {BAN_REFRESH_INTERVAL:.0f}s.")
+        elif args.command == "unban":
+            removed = await storage.remove_ban(args.user_id)
+            print(f"✅ Unbanned {args.user_id}." if removed else f"{args.user_id} wasn't banned.")
+        else:
+            for user_id in sorted(await storage.load_bans()):
+                print(user_id)
+        return 0
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("list", "ban", "unban"))
+    parser.add_argument("user_id", type=int, nargs="?")
+    args = parser.parse_args()
+    if args.command != "list" and args.user_id is None:
+        parser.error(f"{args.command} needs a USER_ID")
+    raise SystemExit(asyncio.run(_main(args)))
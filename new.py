@@ -1,24 +1,73 @@
+import asyncio
+import functools
 import os
 import random
 import time
 from dotenv import load_dotenv
-from pymongo import MongoClient
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
+from storage import create_storage
+from pairings import PairingTable
+from matchmaking import Matchmaker, PAIRED, ALREADY_CHATTING
+from outbound import SendScheduler, PRIORITY_NOTIFY, PRIORITY_RELAY
+from typing_indicator import TypingIndicator
+from relay import copy_to_partner
+from dedup import create_deduplicator
+from flood import FloodControl
+from reports import ReportSink
+from moderation import Moderation
+from preferences import PreferenceStore, describe
+from reaper import Reaper
+from startup import Startup
+from metrics import register_gauges, start_exporter
+from application import BotApplication, CONCURRENT_UPDATES
 from threading import Timer
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Times the cold start, phase by phase
+startup = Startup()
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Override to point the bot at a local stand-in, e.g. for load tests
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
 MONGO_URI = os.getenv("MONGO_URI")
 
 # Connect to MongoDB
-mongo_client = MongoClient(MONGO_URI)
-db = mongo_client["anonymous_chat_bot"]
-waiting_users_collection = db["waiting_users"]
-active_chats_collection = db["active_chats"]
-reports_collection = db["reports"]
+storage = create_storage(MONGO_URI)
+pairings = PairingTable(storage)
+# Banned users get no chats; reports feed the auto-ban counters
+moderation = Moderation(storage)
+# Language, age bracket and interests to match on
+preferences = PreferenceStore(storage)
+matchmaker = Matchmaker(pairings, storage.waiting, is_banned=moderation.is_banned, preferences=preferences)
+reaper = Reaper(matchmaker, pairings)
+
+# Drops webhook redeliveries and updates replayed after a restart
+deduplicator = create_deduplicator(storage)
+
+# Drops updates from users sending faster than FLOOD_LIMITS allows
+flood_control = FloodControl()
+
+# Paces all Bot API calls; partner notifications go ahead of relays
+sender = SendScheduler()
+
+# At most one "typing..." per partner every few seconds (TYPING_INDICATOR=0 disables it)
+typing_indicator = TypingIndicator()
+
+# /report submissions, journaled to disk and stored in batches
+report_sink = ReportSink(storage, on_stored=moderation.record)
+
+# Waiting users, active chats and queued sends for /metrics
+register_gauges(waiting=storage.waiting, pairings=pairings, sender=sender, flood=flood_control,
+                dedup=deduplicator)
+
+# Loaded while the bot initializes; chats wait for the schema migration
+startup.add("schema", storage.bootstrap)
+startup.add("chats", pairings.start, after=["schema"])
+startup.add("bans", moderation.start)
+startup.add("reports", report_sink.start)
 
 # Generate random nickname
 def generate_random_name():
@@ -42,51 +91,45 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/next - Find a new partner\n"
         "/stop - Stop chatting\n"
         "/report <reason> - Report bad behavior\n"
+        "/language <code> - Prefer partners who speak a language\n"
+        "/age <bracket> - Prefer partners in an age bracket\n"
+        "/interests <a, b> - Prefer partners who share an interest\n"
         "/help - Show this help message"
     )
 
 # /next command
 async def next_partner(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.chat_id
-
-    if active_chats_collection.find_one({"user_id": user_id}):
-        await update.message.reply_text("❌ You are already chatting! Use /stop first.")
+    if moderation.is_banned(user_id):
+        await update.message.reply_text("🚫 You are banned from chatting.")
         return
 
-    waiting_user = waiting_users_collection.find_one()
-
-    if waiting_user:
-        partner_id = waiting_user['user_id']
-        random_name = generate_random_name()
+    random_name = generate_random_name()
+    match = await matchmaker.next(user_id, nickname=random_name, start_time=time.time())
 
-        # Connect users
-        active_chats_collection.insert_many([
-            {"user_id": user_id, "partner_id": partner_id, "nickname": random_name, "start_time": time.time()},
-            {"user_id": partner_id, "partner_id": user_id, "nickname": random_name, "start_time": time.time()}
-        ])
+    if match.status == ALREADY_CHATTING:
+        await update.message.reply_text("❌ You are already chatting! Use /stop first.")
+        return
 
-        waiting_users_collection.delete_one({"user_id": partner_id})
+    if match.status == PAIRED:
+        partner_id = match.partner_id
 
-        await context.bot.send_message(chat_id=user_id, text=f"✅ Connected! You are now chatting with {random_name}.")
-        await context.bot.send_message(chat_id=partner_id, text=f"✅ Connected! You are now chatting with {random_name}.")
+        await context.bot.send_message(chat_id=user_id, text=f"✅ Connected! You are now chatting with {random_name}.", rate_limit_args=PRIORITY_NOTIFY)
+        await context.bot.send_message(chat_id=partner_id, text=f"✅ Connected! You are now chatting with {random_name}.", rate_limit_args=PRIORITY_NOTIFY)
 
     else:
-        waiting_users_collection.insert_one({"user_id": user_id})
         await update.message.reply_text("⏳ Waiting for a partner...")
 
 # /stop command
 async def stop_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.chat_id
-    active_chat = active_chats_collection.find_one({"user_id": user_id})
-
-    if active_chat:
-        partner_id = active_chat['partner_id']
+    partner_id = pairings.unpair(user_id)
 
-        await context.bot.send_message(chat_id=partner_id, text="⚠️ Your partner has left the chat.")
-        active_chats_collection.delete_many({"user_id": {"$in": [user_id, partner_id]}})
+    if partner_id is not None:
+        await context.bot.send_message(chat_id=partner_id, text="⚠️ Your partner has left the chat.", rate_limit_args=PRIORITY_NOTIFY)
         await update.message.reply_text("✅ You left the chat.")
     else:
-        waiting_users_collection.delete_one({"user_id": user_id})
+        await matchmaker.cancel(user_id)
         await update.message.reply_text("❌ You are not chatting with anyone.")
 
 # /report command
@@ -96,29 +139,62 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     report_message = text.split("/report", 1)[1].strip() if len(text.split("/report", 1)) > 1 else "No reason given."
 
-    reports_collection.insert_one({
+    await report_sink.add({
         "user_id": user_id,
+        "reported_user_id": matchmaker.last_partner(user_id),
+        "nickname": pairings.nickname_of(user_id),
         "report": report_message,
         "timestamp": time.time()
     })
 
     await update.message.reply_text("✅ Report received. Thank you for helping us keep the community safe!")
 
+# /language, /age and /interests commands
+async def set_preference(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.chat_id
+
+    try:
+        choice = await preferences.set_from_command(user_id, update.message.text)
+    except ValueError as exc:
+        await update.message.reply_text(f"❌ {exc}")
+        return
+
+    await update.message.reply_text(f"✅ Matching on {describe(choice)}. This applies from your next /next.")
+
 # Message relay between users
 async def relay_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.chat_id
+    if moderation.is_banned(user_id):
+        await update.message.reply_text("🚫 You are banned from chatting.")
+        return
+
     text = update.message.text
 
-    active_chat = active_chats_collection.find_one({"user_id": user_id})
+    partner_id = pairings.partner_of(user_id)
 
-    if active_chat:
-        partner_id = active_chat['partner_id']
+    if partner_id is not None:
+        pairings.touch(user_id)
 
         # Typing simulation
-        await context.bot.send_chat_action(chat_id=partner_id, action="typing")
+        typing_indicator.notify(context.bot, partner_id)
 
         # Forward message
-        await context.bot.send_message(chat_id=partner_id, text=text)
+        await context.bot.send_message(chat_id=partner_id, text=text, rate_limit_args=PRIORITY_RELAY)
+    else:
+        await update.message.reply_text("❗ You are not chatting with anyone. Use /next.")
+
+# Media relay between users
+async def relay_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.chat_id
+    if moderation.is_banned(user_id):
+        await update.message.reply_text("🚫 You are banned from chatting.")
+        return
+
+    partner_id = pairings.partner_of(user_id)
+
+    if partner_id is not None:
+        pairings.touch(user_id)
+        await copy_to_partner(context.bot, update.message, partner_id)
     else:
         await update.message.reply_text("❗ You are not chatting with anyone. Use /next.")
 
@@ -126,19 +202,56 @@ async def relay_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Unknown command.")
 
-# Main bot function
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+# Pairs made by relaxing preferences while both users were waiting
+async def announce_match(bot, user_id, partner_id):
+    nickname = pairings.nickname_of(user_id)
+    for chat_id in (user_id, partner_id):
+        await bot.send_message(chat_id=chat_id, text=f"✅ Connected! You are now chatting with {nickname}.", rate_limit_args=PRIORITY_NOTIFY)
+
+# Start matching relaxed preferences and reaping stale waiters and chats
+async def on_startup(application):
+    matchmaker.start(functools.partial(announce_match, application.bot))
+    reaper.start(application.bot)
+    # Serves /metrics when METRICS_PORT is set
+    start_exporter(asyncio.get_running_loop())
+
+# Flush pending pairing changes and reports before exiting
+async def on_shutdown(application):
+    reaper.stop()
+    matchmaker.stop()
+    await pairings.stop()
+    await report_sink.stop()
+    await moderation.stop()
+
+# Build the bot application (load tests drive it without run_polling)
+def build_application():
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .application_class(BotApplication, kwargs={"deduplicator": deduplicator, "pair_key": pairings.pair_key,
+                                                   "startup": startup, "flood_control": flood_control})
+        .rate_limiter(sender)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("next", next_partner))
     app.add_handler(CommandHandler("stop", stop_chat))
     app.add_handler(CommandHandler("report", report))
+    app.add_handler(CommandHandler(["language", "age", "interests"], set_preference))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), relay_message))
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & ~filters.TEXT & ~filters.StatusUpdate.ALL, relay_media))
     app.add_handler(MessageHandler(filters.COMMAND, unknown))
 
-    app.run_polling()
+    return app
+
+def main():
+    build_application().run_polling()
 
 if __name__ == "__main__":
     main()
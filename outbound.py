@@ -0,0 +1,305 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+import httpx
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+from metrics import BOT_API_CALLS, BOT_API_ERRORS, NOTIFICATIONS_BUFFERED
+from resilience import Dependency, DependencyUnavailable
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Priorities for rate_limit_args; lower goes first. They start at 1 because
+# PTB silently drops a falsy rate_limit_args, which would make 0 a reply
+PRIORITY_NOTIFY = 1
+PRIORITY_REPLY = 2
+PRIORITY_RELAY = 3
+# Housekeeping notices (e.g. from the reaper) that can wait for everything else
+PRIORITY_BACKGROUND = 4
+
+# Telegram's documented limits: ~30 messages/s overall, about one message/s
+# per private chat (short bursts are tolerated) and 20 messages/minute per group
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", 3))
+GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", 20 / 60))
+
+# Notifications held back while the Bot API is failing, and how often sending them is retried
+NOTIFY_BUFFER_SIZE = int(os.getenv("NOTIFY_BUFFER_SIZE", 1000))
+NOTIFY_DRAIN_INTERVAL = float(os.getenv("NOTIFY_DRAIN_INTERVAL", 1))
+HELD_PRIORITIES = (PRIORITY_NOTIFY, PRIORITY_BACKGROUND)
+
+
+def is_transient(exc):
+    # BadRequest is a NetworkError too, but sending the same request again won't help
+    return isinstance(exc, NetworkError) and not isinstance(exc, BadRequest)
+
+
+def posts_message(endpoint):
+    # Sending one of these again after Telegram got it posts the message twice
+    return endpoint in ("copyMessage", "forwardMessage") or endpoint.startswith("send") and endpoint != "sendChatAction"
+
+
+def never_sent(exc):
+    """True if a failed request didn't reach Telegram, or Telegram answered that it failed.
+
+    PTB raises HTTP error answers without a cause and chains transport
+    errors; of those, only a connection that was never made is safe. A read
+    timeout (TimedOut) or a dropped connection may come after Telegram
+    accepted the request.
+    """
+    cause = exc.__cause__
+    return cause is None or isinstance(cause, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def resendable(endpoint, exc):
+    """True if a request to endpoint that failed with exc can be sent again."""
+    if isinstance(exc, DependencyUnavailable):
+        return True
+    return is_transient(exc) and (not posts_message(endpoint) or never_sent(exc))
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of refusing.
+
+    reserve() always takes a token, letting the balance go negative, and
+    returns how long the caller has to wait for it; callers that sleep for
+    that long go out in reservation order at the bucket's rate.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendScheduler(BaseRateLimiter):
+    """Paces every Bot API call made through telegram_app.bot.
+
+    Install with ApplicationBuilder().rate_limiter(...). A request first
+    waits for its chat's token bucket, then joins a global priority queue
+    that a single dispatcher drains at GLOBAL_RATE, so partner notifications
+    (rate_limit_args=PRIORITY_NOTIFY) overtake queued relays. RetryAfter
+    pauses the whole queue for the requested time and the call is retried.
+
+    Every call goes through the bot_api Dependency, which retries network
+    errors with jittered backoff and stops calling a failing Bot API for a
+    while. Calls that post a message are retried only if they can't have
+    reached Telegram (see never_sent), so a read timeout can't deliver a
+    message twice. Notifications (PRIORITY_NOTIFY and PRIORITY_BACKGROUND) that
+    still can't be sent are held, up to NOTIFY_BUFFER_SIZE, oldest dropped
+    first, and sent in order once the Bot API answers again; their
+    send_message() returns None. Later notifications queue behind them.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 group_rate=GROUP_RATE, max_retries=3, log_interval=60, bot_api=None,
+                 buffer_size=NOTIFY_BUFFER_SIZE, drain_interval=NOTIFY_DRAIN_INTERVAL):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.log_interval = log_interval
+        self.bot_api = Dependency("bot_api", is_transient) if bot_api is None else bot_api
+        self.buffer_size = buffer_size
+        self.drain_interval = drain_interval
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._ready = None
+        self._paused_until = 0.0
+        self._dispatcher = None
+        self._drainer = None
+        # Notifications waiting for the Bot API to recover, oldest first
+        self._held = deque()
+        # Counters, see stats()
+        self.sent = 0
+        self.retried = 0
+        self.delayed_seconds = 0.0
+        self.max_delay = 0.0
+
+    async def initialize(self):
+        # The application and its updater both initialize the bot
+        if self._dispatcher:
+            return
+        self._ready = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        self._drainer = asyncio.create_task(self._drain_forever())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        if self._drainer:
+            self._drainer.cancel()
+            self._drainer = None
+        if self._held:
+            logger.warning("Dropping %d held notifications on shutdown", len(self._held))
+        for _, _, waiter in self._queue:
+            waiter.cancel()
+        self._queue.clear()
+
+    def stats(self):
+        return {
+            "queue_depth": len(self._queue),
+            "held": len(self._held),
+            "sent": self.sent,
+            "retried": self.retried,
+            "avg_delay": self.delayed_seconds / self.sent if self.sent else 0.0,
+            "max_delay": self.max_delay,
+        }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels, which have a much lower limit
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, priority):
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve(time.monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+        self._ready.set()
+        await waiter
+
+    async def _dispatch(self):
+        last_log = last_prune = time.monotonic()
+        while True:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            delay = self._global.reserve(now)
+            if delay:
+                await asyncio.sleep(delay)
+
+            # Skip waiters whose request was cancelled while queued
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+
+            now = time.monotonic()
+            if now - last_prune > 60:
+                self._chats = {chat_id: bucket for chat_id, bucket in self._chats.items() if not bucket.idle(now)}
+                last_prune = now
+            if self.log_interval and now - last_log > self.log_interval:
+                logger.info("Send queue: %(queue_depth)d queued, %(sent)d sent, %(retried)d retried, "
+                            "avg delay %(avg_delay).3fs, max delay %(max_delay).3fs", self.stats())
+                last_log = now
+
+    def _hold(self, request):
+        if not self._held:
+            logger.warning("Bot API unavailable, holding notifications until it recovers")
+        if len(self._held) >= self.buffer_size:
+            self._held.popleft()
+            NOTIFICATIONS_BUFFERED.inc("dropped")
+        self._held.append(request)
+        NOTIFICATIONS_BUFFERED.inc("held")
+
+    async def _drain_forever(self):
+        while True:
+            await asyncio.sleep(self.drain_interval)
+            while self._held and self.bot_api.available():
+                request = self._held[0]
+                try:
+                    await self._call(request)
+                    outcome = "delivered"
+                except Exception as exc:
+                    if resendable(request[3], exc):
+                        break
+                    # e.g. the user blocked the bot meanwhile, or a timeout left it maybe sent
+                    logger.warning("Dropping held %s to %s: %s", request[3], request[4], exc)
+                    outcome = "failed"
+                # An overflowing buffer may have dropped it already
+                if self._held and self._held[0] is request:
+                    self._held.popleft()
+                NOTIFICATIONS_BUFFERED.inc(outcome)
+                if not self._held:
+                    logger.info("Bot API recovered, held notifications sent")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_REPLY if rate_limit_args is None else rate_limit_args
+        # Chat actions don't count against the per-chat message allowance
+        chat_id = None if endpoint == "sendChatAction" else data.get("chat_id")
+        request = (callback, args, kwargs, endpoint, chat_id, priority)
+        if priority not in HELD_PRIORITIES:
+            return await self._call(request)
+
+        # Keep notifications in order behind any that are held
+        if self._held:
+            self._hold(request)
+            return None
+        try:
+            return await self._call(request)
+        except (DependencyUnavailable, NetworkError) as exc:
+            if not resendable(endpoint, exc):
+                raise
+            self._hold(request)
+            return None
+
+    async def _call(self, request):
+        endpoint = request[3]
+        return await self.bot_api.call(self._send, *request, retry_if=functools.partial(resendable, endpoint))
+
+    async def _send(self, callback, args, kwargs, endpoint, chat_id, priority):
+        for attempt in range(self.max_retries + 1):
+            queued = time.monotonic()
+            with span("send_wait", endpoint):
+                await self._acquire(chat_id, priority)
+            delay = time.monotonic() - queued
+            self.delayed_seconds += delay
+            self.max_delay = max(self.max_delay, delay)
+            BOT_API_CALLS.inc(endpoint)
+            try:
+                with span("send", endpoint):
+                    result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as exc:
+                BOT_API_ERRORS.inc(endpoint, "RetryAfter")
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + exc.retry_after)
+                logger.warning("Flood limit hit on %s, pausing sends for %ss", endpoint, exc.retry_after)
+            except TelegramError as exc:
+                BOT_API_ERRORS.inc(endpoint, type(exc).__name__)
+                raise
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from resilience import DependencyUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+def session_id(user_id, partner_id):
+    """Stable _id of the chat session between two users."""
+    low, high = sorted((user_id, partner_id))
+    return f"{low}:{high}"
+
+
+def new_session(user_id, partner_id, **fields):
+    """The single active_chats document describing one chat."""
+    now = time.time()
+    return {
+        "_id": session_id(user_id, partner_id),
+        "users": [user_id, partner_id],
+        "start_time": now,
+        "last_activity": now,
+        **fields
+    }
+
+
+class PairingTable:
+    """Authoritative in-process map of who is chatting with whom.
+
+    Handlers read and change pairings synchronously, so lookups on the relay
+    path never touch the database and a pair/unpair can't interleave with
+    another handler. Changes are queued and written to active_chats in
+    batches by a background task (write-behind); on startup the table is
+    loaded back from storage.
+
+    Each chat is one session dict shared by both participants' entries, so
+    ending it is a single delete and last_activity is tracked once per chat.
+    Sessions are also kept in order of last activity, which lets idle()
+    find inactive chats without scanning the table.
+    """
+
+    def __init__(self, storage, flush_interval=0.05, batch_size=500):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._chats = {}
+        # session _id -> session, least recently active first
+        self._sessions = OrderedDict()
+        self._pending = []
+        self._touched = {}
+        self._wakeup = None
+        self._flusher = None
+        # One flush at a time, so batches reach storage in queue order
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._chats) // 2
+
+    def owns(self, user_id):
+        """Whether this process handles user_id's updates; always, unless sharded."""
+        return True
+
+    def get(self, user_id):
+        """Return the chat session user_id is in, or None if they aren't chatting."""
+        return self._chats.get(user_id)
+
+    def partner_of(self, user_id):
+        session = self._chats.get(user_id)
+        if session is None:
+            return None
+        first, second = session["users"]
+        return second if first == user_id else first
+
+    def nickname_of(self, user_id):
+        """Nickname of user_id's current chat, or None."""
+        session = self._chats.get(user_id)
+        return session.get("nickname") if session else None
+
+    def pair_key(self, user_id):
+        """Id of user_id's current chat session, or None; used to order a pair's updates."""
+        session = self._chats.get(user_id)
+        return session["_id"] if session else None
+
+    def pair(self, user_id, partner_id, **fields):
+        session = new_session(user_id, partner_id, **fields)
+        self._chats[user_id] = self._chats[partner_id] = session
+        self._sessions[session["_id"]] = session
+        self._queue(("create", session))
+
+    async def pair_claimed(self, user_id, partner_id, **fields):
+        """Pair user_id with partner_id, just claimed off the waiting queue.
+
+        Returns False, leaving both unpaired, if partner_id turned out to be
+        chatting already (a stale queue entry).
+        """
+        if self.get(partner_id):
+            return False
+        self.pair(user_id, partner_id, **fields)
+        return True
+
+    def unpair(self, user_id):
+        """End user_id's chat and return the former partner's id, or None."""
+        partner_id = self.partner_of(user_id)
+        if partner_id is None:
+            return None
+        session = self._chats.pop(user_id)
+        self._chats.pop(partner_id, None)
+        self._sessions.pop(session["_id"], None)
+        self._touched.pop(session["_id"], None)
+        self._queue(("end", session["_id"]))
+        return partner_id
+
+    def touch(self, user_id):
+        """Record activity in user_id's chat; persisted once per flush, not per call."""
+        session = self._chats.get(user_id)
+        if session is not None:
+            session["last_activity"] = time.time()
+            self._touched[session["_id"]] = session
+            if session["_id"] in self._sessions:
+                self._sessions.move_to_end(session["_id"])
+
+    def idle(self, before, limit):
+        """Up to limit sessions with no activity since before (a time.time()), least active first."""
+        idle = []
+        for session in self._sessions.values():
+            if session.get("last_activity", 0) >= before or len(idle) >= limit:
+                break
+            idle.append(session)
+        return idle
+
+    def _queue(self, op):
+        self._pending.append(op)
+        if self._wakeup and len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def load(self):
+        self._chats = {}
+        sessions = sorted(await self.storage.load_active_chats(), key=lambda session: session.get("last_activity", 0))
+        for session in sessions:
+            for user_id in session["users"]:
+                self._chats[user_id] = session
+        self._sessions = OrderedDict((session["_id"], session) for session in sessions)
+        logger.info("Loaded %d active chats", len(self))
+
+    async def flush(self):
+        async with self._flush_lock:
+            for session in self._touched.values():
+                self._pending.append(("touch", session["_id"], session["last_activity"]))
+            self._touched.clear()
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:len(batch)]
+                try:
+                    await self.storage.apply_chat_writes(batch)
+                except Exception:
+                    # Keep the batch in front of anything queued meanwhile and retry later
+                    self._pending[:0] = batch
+                    raise
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except DependencyUnavailable:
+                # Mongo is down and the circuit breaker has said so already
+                pass
+            except Exception:
+                logger.exception("Persisting %d pairing changes failed, will retry", len(self._pending))
+
+    async def start(self):
+        await self.load()
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
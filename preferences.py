@@ -0,0 +1,155 @@
+"""Matching preferences and the waiting-queue buckets derived from them.
+
+Users set a language, an age bracket and a few interests with /language,
+/age and /interests. Each waiting user is filed under one bucket per
+relaxation level, strictest first:
+
+    0  same language, same age bracket and a shared interest
+    1  same language and age bracket
+    2  same language
+    3  anyone
+
+An unset preference is its own value ("-"), so people who set nothing are
+matched with each other at level 0, just like before preferences existed.
+A newcomer only takes a level-0 match; after MATCH_RELAX_AFTER seconds
+(one value per level from 1 on) a waiting user also accepts matches at the
+next level, provided the other side has waited that long too.
+"""
+import functools
+import os
+import re
+from collections import OrderedDict, namedtuple
+from storage import ANY_BUCKET
+
+# Seconds of waiting before levels 1, 2 and 3 are accepted
+MATCH_RELAX_AFTER = tuple(float(delay) for delay in os.getenv("MATCH_RELAX_AFTER", "15,30,60").split(","))
+# Preferences kept in memory; the rest are read from storage on demand
+PREFERENCE_CACHE_SIZE = int(os.getenv("PREFERENCE_CACHE_SIZE", 100_000))
+
+AGE_BRACKETS = ("13-17", "18-24", "25-34", "35-44", "45+")
+MAX_INTERESTS = 5
+UNSET = "-"
+
+_LANGUAGE = re.compile(r"^[a-z]{2,3}$")
+_INTEREST = re.compile(r"^[a-z0-9_]{2,24}$")
+
+Preferences = namedtuple("Preferences", ["language", "age", "interests"], defaults=(None, None, ()))
+
+if len(MATCH_RELAX_AFTER) != 3:
+    raise ValueError("MATCH_RELAX_AFTER needs three delays, for levels 1, 2 and 3")
+
+
+# Few distinct combinations are popular, so /next rarely builds the keys
+@functools.lru_cache(maxsize=4096)
+def bucket_keys(preferences):
+    """Buckets for preferences, as one tuple of keys per level; the last is ANY_BUCKET."""
+    language = preferences.language or UNSET
+    age = preferences.age or UNSET
+    interests = preferences.interests or (UNSET,)
+    return (
+        tuple(f"0:{language}:{age}:{interest}" for interest in interests),
+        (f"1:{language}:{age}",),
+        (f"2:{language}",),
+        (ANY_BUCKET,),
+    )
+
+
+def level_buckets(buckets, level):
+    """The keys in a waiter's stored buckets that belong to level."""
+    if level == len(MATCH_RELAX_AFTER):
+        return (ANY_BUCKET,)
+    prefix = f"{level}:"
+    return tuple(bucket for bucket in buckets if bucket.startswith(prefix))
+
+
+def describe(preferences):
+    interests = ", ".join(preferences.interests) or "any"
+    return (f"language: {preferences.language or 'any'}, age: {preferences.age or 'any'}, "
+            f"interests: {interests}")
+
+
+def _parse_language(args):
+    if len(args) != 1:
+        raise ValueError("Usage: /language <code>, e.g. /language en (/language any to clear)")
+    value = args[0].lower()
+    if value == "any":
+        return None
+    if not _LANGUAGE.match(value):
+        raise ValueError("Use a two- or three-letter language code, e.g. en, hi or es.")
+    return value
+
+
+def _parse_age(args):
+    if len(args) != 1:
+        raise ValueError(f"Usage: /age <bracket>, one of {', '.join(AGE_BRACKETS)} (/age any to clear)")
+    value = args[0].lower()
+    if value == "any":
+        return None
+    if value not in AGE_BRACKETS:
+        raise ValueError(f"Pick one of {', '.join(AGE_BRACKETS)}.")
+    return value
+
+
+def _parse_interests(args):
+    if not args:
+        raise ValueError("Usage: /interests music, movies, travel (/interests any to clear)")
+    values = [value.strip("#").lower() for value in re.split(r"[,\s]+", " ".join(args)) if value]
+    if values == ["any"]:
+        return ()
+    if len(values) > MAX_INTERESTS:
+        raise ValueError(f"At most {MAX_INTERESTS} interests, please.")
+    invalid = [value for value in values if not _INTEREST.match(value)]
+    if invalid:
+        raise ValueError(f"Interests are single words (letters, digits, _): {', '.join(invalid)}")
+    return tuple(sorted(set(values)))
+
+
+# Command name -> (Preferences field, parser of the command's arguments)
+COMMANDS = {
+    "language": ("language", _parse_language),
+    "age": ("age", _parse_age),
+    "interests": ("interests", _parse_interests),
+}
+
+
+class PreferenceStore:
+    """Users' preferences, read through an LRU cache over storage.
+
+    Matchmaker.next() looks preferences up on every /next, so they are
+    cached; a change is written to storage and the cache at once.
+    """
+
+    def __init__(self, storage, cache_size=PREFERENCE_CACHE_SIZE):
+        self.storage = storage
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _remember(self, user_id, preferences):
+        self._cache[user_id] = preferences
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id):
+        preferences = self._cache.get(user_id)
+        if preferences is not None:
+            self._cache.move_to_end(user_id)
+            return preferences
+        doc = await self.storage.load_preferences(user_id)
+        preferences = Preferences() if doc is None else Preferences(
+            doc.get("language"), doc.get("age"), tuple(doc.get("interests", ())))
+        self._remember(user_id, preferences)
+        return preferences
+
+    async def buckets(self, user_id):
+        return bucket_keys(await self.get(user_id))
+
+    async def set_from_command(self, user_id, text):
+        """Apply a /language, /age or /interests message; raises ValueError with a reply for bad input."""
+        words = text.split()
+        name = words[0].lstrip("/").split("@")[0].lower()
+        field, parse = COMMANDS[name]
+        preferences = (await self.get(user_id))._replace(**{field: parse(words[1:])})
+        await self.storage.save_preferences(user_id, preferences._asdict())
+        self._remember(user_id, preferences)
+        return preferences
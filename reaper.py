@@ -0,0 +1,134 @@
+"""Background expiry of abandoned waiters and idle chats.
+
+Every REAP_INTERVAL seconds the reaper takes users who have been waiting
+for more than WAITING_TIMEOUT_SECONDS off the queue, and ends chats with no
+message for CHAT_IDLE_SECONDS (by the session's last_activity). Both are
+done in batches of REAP_BATCH. The users concerned are told, REAP_NOTIFY_BATCH
+messages at a time with a REAP_NOTIFY_PAUSE between batches, at the lowest
+send priority so the notices never hold up live chats. Each run logs what it
+reclaimed and adds it to the reaped_total metric.
+
+Mongo's TTL index on waiting_users (WAITING_TTL_SECONDS) stays in place as
+a backstop for when no bot is running.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from metrics import REAPED
+from outbound import PRIORITY_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+WAITING_TIMEOUT = float(os.getenv("WAITING_TIMEOUT_SECONDS", 30 * 60))
+CHAT_IDLE_TIMEOUT = float(os.getenv("CHAT_IDLE_SECONDS", 60 * 60))
+REAP_INTERVAL = float(os.getenv("REAP_INTERVAL", 60))
+REAP_BATCH = int(os.getenv("REAP_BATCH", 500))
+REAP_NOTIFY_BATCH = int(os.getenv("REAP_NOTIFY_BATCH", 25))
+REAP_NOTIFY_PAUSE = float(os.getenv("REAP_NOTIFY_PAUSE", 1))
+
+WAITER_EXPIRED_TEXT = "⌛ Nobody turned up for a while, so you've left the waiting list. Send /next to try again."
+CHAT_EXPIRED_TEXT = "⌛ Your chat ended after a long silence. Send /next to meet someone new."
+
+# What one run reclaimed
+ReapStats = namedtuple("ReapStats", ["waiters", "chat_users", "notified", "failed", "seconds"])
+
+
+class Reaper:
+    def __init__(self, matchmaker, pairings, waiting_timeout=WAITING_TIMEOUT, idle_timeout=CHAT_IDLE_TIMEOUT,
+                 interval=REAP_INTERVAL, batch_size=REAP_BATCH, notify_batch=REAP_NOTIFY_BATCH,
+                 notify_pause=REAP_NOTIFY_PAUSE):
+        self.matchmaker = matchmaker
+        self.pairings = pairings
+        self.waiting_timeout = waiting_timeout
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.batch_size = batch_size
+        self.notify_batch = notify_batch
+        self.notify_pause = notify_pause
+        self.last_run = None
+        self._bot = None
+        self._reaper = None
+
+    async def _expire_waiters(self):
+        before = datetime.now(timezone.utc) - timedelta(seconds=self.waiting_timeout)
+        expired = []
+        while True:
+            batch = await self.matchmaker.expire(before, self.batch_size)
+            expired.extend(waiter.user_id for waiter in batch)
+            if len(batch) < self.batch_size:
+                return expired
+            # Let handlers in between batches
+            await asyncio.sleep(0)
+
+    async def _end_idle_chats(self):
+        before = time.time() - self.idle_timeout
+        ended = []
+        while True:
+            batch = self.pairings.idle(before, self.batch_size)
+            for session in batch:
+                # A sharded table also holds chats with users on other shards;
+                # end them through our own user so the other shard hears of it
+                user_id = next(user for user in session["users"] if self.pairings.owns(user))
+                partner_id = self.pairings.unpair(user_id)
+                ended.extend(user for user in (user_id, partner_id) if user is not None and self.pairings.owns(user))
+            if len(batch) < self.batch_size:
+                return ended
+            await asyncio.sleep(0)
+
+    async def _notify(self, notices):
+        notified = failed = 0
+        for start in range(0, len(notices), self.notify_batch):
+            if start:
+                await asyncio.sleep(self.notify_pause)
+            results = await asyncio.gather(*(
+                self._bot.send_message(chat_id=user_id, text=text, rate_limit_args=PRIORITY_BACKGROUND)
+                for user_id, text in notices[start:start + self.notify_batch]
+            ), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    failed += 1
+                else:
+                    notified += 1
+        return notified, failed
+
+    async def run_once(self):
+        """Expire stale waiters and idle chats, notify the users, and return a ReapStats."""
+        started = time.perf_counter()
+        waiters = await self._expire_waiters()
+        chat_users = await self._end_idle_chats()
+        REAPED.inc("waiter", amount=len(waiters))
+        REAPED.inc("chat", amount=len(chat_users))
+
+        # Someone may have found a partner since; the queue entry is gone either way
+        notices = [(user_id, WAITER_EXPIRED_TEXT) for user_id in waiters if not self.pairings.get(user_id)]
+        notices += [(user_id, CHAT_EXPIRED_TEXT) for user_id in chat_users]
+        notified, failed = await self._notify(notices) if self._bot else (0, 0)
+
+        stats = ReapStats(len(waiters), len(chat_users), notified, failed, time.perf_counter() - started)
+        self.last_run = stats
+        if waiters or chat_users:
+            logger.info("Reaped %d waiters and %d users' idle chats in %.2fs; notified %d users (%d failed)",
+                        stats.waiters, stats.chat_users, stats.seconds, stats.notified, stats.failed)
+        return stats
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Reaping stale waiters and idle chats failed")
+
+    def start(self, bot):
+        """Start reaping in the background, notifying users through bot."""
+        self._bot = bot
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_forever())
+
+    def stop(self):
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
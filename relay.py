@@ -0,0 +1,34 @@
+from telegram import MessageEntity
+from outbound import PRIORITY_RELAY
+
+
+def anonymous_caption(message):
+    """Return (caption, caption_entities) for copying message without identifying its sender.
+
+    Forwarded messages lose their caption, which usually credits whoever
+    it was forwarded from; otherwise text_mention entities, which link to
+    a Telegram account, are dropped and the caption text is kept.
+    """
+    if message.forward_date is not None:
+        return "", None
+    entities = [entity for entity in message.caption_entities if entity.type != MessageEntity.TEXT_MENTION]
+    return message.caption, entities
+
+
+async def copy_to_partner(bot, message, partner_id):
+    """Relay any kind of message to partner_id with copy_message.
+
+    Telegram copies the content server-side by file_id, so photos, videos,
+    voice notes and stickers never pass through this host, and the copy
+    carries no "Forwarded from" header.
+    """
+    kwargs = {}
+    if message.caption is not None:
+        kwargs["caption"], kwargs["caption_entities"] = anonymous_caption(message)
+    await bot.copy_message(
+        chat_id=partner_id,
+        from_chat_id=message.chat_id,
+        message_id=message.message_id,
+        rate_limit_args=PRIORITY_RELAY,
+        **kwargs
+    )
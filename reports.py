@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import os
+from bson import ObjectId
+from resilience import DependencyUnavailable
+
+logger = logging.getLogger(__name__)
+
+# A batch goes out once this many reports are pending, or after the interval
+REPORT_BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", 100))
+REPORT_FLUSH_INTERVAL = float(os.getenv("REPORT_FLUSH_INTERVAL", 2))
+REPORT_JOURNAL = os.getenv("REPORT_JOURNAL", "reports_journal.jsonl")
+
+
+class ReportSink:
+    """Buffers /report submissions and stores them with one insert_many per batch.
+
+    add() appends the report to a journal file before returning, so a
+    report the user was thanked for survives a crash: on start the journal
+    is replayed into the buffer. Each report gets its _id up front, which
+    makes a replayed insert of an already stored report a no-op. The
+    journal is cut back to what is still pending after every flush.
+    on_stored, if given, is awaited with each batch once it is stored.
+    """
+
+    def __init__(self, storage, batch_size=REPORT_BATCH_SIZE, flush_interval=REPORT_FLUSH_INTERVAL,
+                 journal_path=REPORT_JOURNAL, on_stored=None):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self.on_stored = on_stored
+        self._pending = []
+        self._journal = None
+        self._wakeup = None
+        self._flusher = None
+        self._flush_lock = asyncio.Lock()
+        self.stored = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _open_journal(self):
+        if self._journal is None and self.journal_path:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        return self._journal
+
+    async def add(self, report):
+        report = dict(report, _id=ObjectId())
+        journal = self._open_journal()
+        if journal:
+            journal.write(json.dumps(dict(report, _id=str(report["_id"]))) + "\n")
+            journal.flush()
+        self._pending.append(report)
+        if self._wakeup and len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _replay_journal(self):
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    report = json.loads(line)
+                except ValueError:
+                    # A line cut short by the crash; everything before it is intact
+                    continue
+                report["_id"] = ObjectId(report["_id"])
+                self._pending.append(report)
+        if self._pending:
+            logger.info("Recovered %d unsaved reports from %s", len(self._pending), self.journal_path)
+
+    def _rewrite_journal(self):
+        if not self.journal_path:
+            return
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as journal:
+            for report in self._pending:
+                journal.write(json.dumps(dict(report, _id=str(report["_id"]))) + "\n")
+        os.replace(tmp_path, self.journal_path)
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                await self.storage.add_reports(batch)
+                del self._pending[:len(batch)]
+                self.stored += len(batch)
+                if self.on_stored:
+                    try:
+                        await self.on_stored(batch)
+                    except Exception:
+                        # The batch is stored; don't insert it again over a failed follow-up
+                        logger.exception("Processing %d stored reports failed", len(batch))
+            self._rewrite_journal()
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            try:
+                await self.flush()
+            except DependencyUnavailable:
+                # Mongo is down and the circuit breaker has said so already; the journal keeps the reports
+                pass
+            except Exception:
+                logger.exception("Storing %d reports failed, will retry", len(self._pending))
+
+    async def start(self):
+        self._replay_journal()
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        try:
+            await self.flush()
+        finally:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
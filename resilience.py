@@ -0,0 +1,145 @@
+"""Retries and circuit breakers for the bot's dependencies.
+
+A Dependency wraps calls to one external service (the Bot API, Mongo).
+A call that fails with a transient error, as judged by the dependency's
+is_transient, is retried up to RETRY_ATTEMPTS times in all, after a
+random delay of up to RETRY_BASE_DELAY * 2**attempt, capped at
+RETRY_MAX_DELAY ("full jitter", so many callers failing together don't
+retry in lockstep).
+
+Each dependency also has a CircuitBreaker. After BREAKER_FAILURES
+transient failures in a row it opens, and calls fail at once with
+DependencyUnavailable instead of piling up behind timeouts. After
+BREAKER_RESET_SECONDS it lets calls through again as trials: the first
+success closes it, the first failure opens it for another round. Any other
+error counts as a success, since the service did answer. State changes are
+logged and counted in circuit_breaker_transitions_total, and retries in
+dependency_retries_total.
+"""
+import asyncio
+import functools
+import logging
+import os
+import random
+import time
+from metrics import CIRCUIT_TRANSITIONS, DEPENDENCY_RETRIES
+
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 0.2))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 2))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 30))
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DependencyUnavailable(Exception):
+    """Raised instead of calling a dependency whose circuit is open."""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} is unavailable; retrying in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+
+    def _move(self, state):
+        if state != self.state:
+            self.state = state
+            CIRCUIT_TRANSITIONS.inc(self.name, state)
+            log = logger.warning if state == OPEN else logger.info
+            log("Circuit for %s is now %s", self.name, state.replace("_", "-"))
+
+    def retry_in(self):
+        """Seconds until calls are let through again; 0 if they are now."""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def check(self):
+        """Raise DependencyUnavailable if calls aren't let through right now."""
+        if self.state == OPEN:
+            retry_in = self.retry_in()
+            if retry_in:
+                raise DependencyUnavailable(self.name, retry_in)
+            self._move(HALF_OPEN)
+
+    def success(self):
+        self.failures = 0
+        self._move(CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._move(OPEN)
+
+
+class Dependency:
+    """Retry policy and circuit breaker for one external service."""
+
+    def __init__(self, name, is_transient, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, breaker=None):
+        self.name = name
+        self.is_transient = is_transient
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(name) if breaker is None else breaker
+
+    def available(self):
+        return not self.breaker.retry_in()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, func, *args, retry_if=None, **kwargs):
+        """Await func(*args, **kwargs), retrying transient failures.
+
+        retry_if(exc) narrows which transient failures are retried, for calls
+        that mustn't be repeated if the first attempt may have taken effect.
+        """
+        return await self._call(func, args, kwargs, self.attempts, retry_if)
+
+    async def _call(self, func, args, kwargs, attempts, retry_if=None):
+        for attempt in range(attempts):
+            self.breaker.check()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as exc:
+                if not self.is_transient(exc):
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                if attempt == attempts - 1 or retry_if is not None and not retry_if(exc):
+                    raise
+                DEPENDENCY_RETRIES.inc(self.name)
+                logger.debug("%s call failed (%s), retrying", self.name, exc)
+                await asyncio.sleep(self.backoff(attempt))
+            else:
+                self.breaker.success()
+                return result
+
+    def guard(self, func, retry=True):
+        """Decorate an async function so every call goes through call(); with
+        retry=False it gets the circuit breaker but only one attempt."""
+        attempts = self.attempts if retry else 1
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self._call(func, args, kwargs, attempts)
+
+        return wrapper
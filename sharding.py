@@ -0,0 +1,331 @@
+"""Sharded deployment: several bot workers, each owning a hash range of chat ids.
+
+Telegram delivers every update to one webhook URL, so a router sits in
+front of the shards and forwards each update to the worker owning its
+chat. Every shard runs a normal webhook entry point (ss.py, app.py, ...)
+with:
+
+    SHARD_URLS   comma-separated base URLs of all shards, in shard order
+    SHARD_INDEX  this worker's position in SHARD_URLS
+    SHARD_SECRET shared secret for the shard-to-shard /shard/pairing route
+
+Shards started by hand from one directory also need their own
+REPORT_JOURNAL and WEBHOOK_SPILL_PATH; --launch sets them per shard.
+
+All shards share one MongoDB. The waiting queue is waiting_users, whose
+claim is atomic, so users on different shards are matched with each other.
+Each shard keeps pairings for its own users only; when it pairs one of
+them with a user owned by another shard it confirms the pair with that
+shard first, and /stop tells the other shard. Relays need no hop at all:
+the Bot API accepts a send to any chat from any worker, so the shard that
+received a message copies it to the partner directly.
+
+To try it locally against one mongod:
+
+    MONGO_URI=mongodb://localhost:27017 python sharding.py --launch 3 --entry ss
+    python sharding.py              run just the router, for shards started elsewhere
+"""
+import argparse
+import asyncio
+import hmac
+import logging
+import os
+import subprocess
+import sys
+import zlib
+import httpx
+from flask import Flask, request
+from pairings import PairingTable, new_session
+from storage import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+SHARD_URLS = [url.strip().rstrip("/") for url in os.getenv("SHARD_URLS", "").split(",") if url.strip()]
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", 0))
+SHARD_SECRET = os.getenv("SHARD_SECRET", "")
+# Seconds a shard waits on another before giving up on a pairing
+PEER_TIMEOUT = float(os.getenv("SHARD_PEER_TIMEOUT", 3))
+
+# Update fields whose object carries the chat, and those that only carry a user
+CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+               "my_chat_member", "chat_member", "chat_join_request")
+USER_FIELDS = ("callback_query", "inline_query", "chosen_inline_result",
+               "shipping_query", "pre_checkout_query", "poll_answer")
+
+
+def shard_of(chat_id, shard_count):
+    """Shard owning chat_id: shards split the 32-bit hash space into equal ranges."""
+    return zlib.crc32(str(chat_id).encode()) * shard_count >> 32
+
+
+def update_chat_id(data):
+    """Chat id an undecoded webhook update belongs to, or None."""
+    for field in CHAT_FIELDS:
+        if field in data:
+            return data[field].get("chat", {}).get("id")
+    for field in USER_FIELDS:
+        if field in data:
+            return data[field].get("from", data[field].get("user", {})).get("id")
+    return None
+
+
+class ShardedPairingTable(PairingTable):
+    """PairingTable for one shard of a sharded deployment.
+
+    Only chats with at least one of this shard's users are kept. A chat
+    between two shards is created by the shard of the user who sent /next
+    (its "home", session["users"][0]): it writes the session to Mongo, then
+    offers it to the partner's shard, which accepts unless the partner got
+    paired meanwhile. Either side can end the chat; both delete the session,
+    which is idempotent, so a lost /stop notice can't leave it in the database.
+
+    If the session can't be written, or the partner's shard doesn't give a
+    clear answer (unreachable, busy), pair_claimed ends the chat on both
+    sides and raises, and the Matchmaker puts the partner back in the queue.
+    """
+
+    def __init__(self, storage, shard_index, shard_urls, secret=SHARD_SECRET, **kwargs):
+        super().__init__(storage, **kwargs)
+        self.shard_index = shard_index
+        self.shard_urls = shard_urls
+        self.secret = secret
+        # The application's per-chat locks; set by add_peer_routes
+        self.locks = None
+        self._client = None
+        self._notices = set()
+
+    def owns(self, user_id):
+        return shard_of(user_id, len(self.shard_urls)) == self.shard_index
+
+    def _adopt(self, session):
+        for user_id in session["users"]:
+            self._chats[user_id] = session
+        self._sessions[session["_id"]] = session
+
+    def _drop(self, session):
+        for user_id in session["users"]:
+            if self._chats.get(user_id) is session:
+                del self._chats[user_id]
+        self._sessions.pop(session["_id"], None)
+        self._touched.pop(session["_id"], None)
+
+    async def load(self):
+        await super().load()
+        self._chats = {user_id: session for user_id, session in self._chats.items()
+                       if any(self.owns(user) for user in session["users"])}
+        for session_id, session in list(self._sessions.items()):
+            if not any(self.owns(user) for user in session["users"]):
+                del self._sessions[session_id]
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=PEER_TIMEOUT, headers={"X-Shard-Secret": self.secret})
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+        for notice in list(self._notices):
+            notice.cancel()
+        if self._client:
+            await self._client.aclose()
+
+    async def _send(self, user_id, event):
+        url = self.shard_urls[shard_of(user_id, len(self.shard_urls))] + "/shard/pairing"
+        response = await self._client.post(url, json=event)
+        if response.status_code not in (200, 409):
+            response.raise_for_status()
+        return response.status_code == 200
+
+    async def pair_claimed(self, user_id, partner_id, **fields):
+        if self.owns(partner_id) or self.get(partner_id):
+            return await super().pair_claimed(user_id, partner_id, **fields)
+
+        session = new_session(user_id, partner_id, **fields)
+        # Persist before offering: once the partner's shard accepts, the
+        # partner may /stop right away and that delete must come second
+        self._queue(("create", session))
+        offered = False
+        try:
+            await self.flush()
+            offered = True
+            accepted = await self._send(partner_id, {"op": "pair", "session": session})
+        except Exception as exc:
+            # A create left queued by a failed flush is followed by this end
+            self._queue(("end", session["_id"]))
+            if offered:
+                # The partner's shard may have taken the chat before failing to answer
+                logger.warning("Shard of %s didn't answer a pairing offer: %r", partner_id, exc)
+                self._notify_end(partner_id, session)
+            raise
+        if not accepted:
+            self._queue(("end", session["_id"]))
+            return False
+        self._adopt(session)
+        return True
+
+    def unpair(self, user_id):
+        session = self.get(user_id)
+        partner_id = super().unpair(user_id)
+        if partner_id is not None and not self.owns(partner_id):
+            self._notify_end(partner_id, session)
+        return partner_id
+
+    def _notify_end(self, user_id, session):
+        # Tell user_id's shard in the background that session is over
+        event = {"op": "unpair", "session_id": session["_id"], "start_time": session["start_time"]}
+        notice = asyncio.create_task(self._notify(user_id, event))
+        self._notices.add(notice)
+        notice.add_done_callback(self._notices.discard)
+
+    async def _notify(self, user_id, event, attempts=3):
+        for attempt in range(attempts):
+            try:
+                await self._send(user_id, event)
+                return
+            except httpx.HTTPError as exc:
+                if attempt == attempts - 1:
+                    logger.warning("Couldn't tell the shard of %s that their chat ended: %r", user_id, exc)
+                    return
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def apply_peer_event(self, event):
+        """Apply an event from another shard; False rejects a pairing offer."""
+        return await asyncio.wait_for(self._apply(event), PEER_TIMEOUT * 2 / 3)
+
+    async def _apply(self, event):
+        if event["op"] == "pair":
+            session = event["session"]
+            partner_id = session["users"][1]
+            # Under the partner's chat lock, so none of their updates is mid-handler
+            async with self.locks.hold(partner_id):
+                if self.get(partner_id):
+                    return False
+                # They may have sent /next again after being claimed
+                await self.storage.waiting.remove(partner_id)
+                self._adopt(session)
+                return True
+
+        for user_id in event["session_id"].split(":"):
+            user_id = int(user_id)
+            if not self.owns(user_id):
+                continue
+            async with self.locks.hold(user_id):
+                session = self.get(user_id)
+                # Ignore a late notice about an earlier chat between the same two users
+                if session and session["_id"] == event["session_id"] and session["start_time"] == event["start_time"]:
+                    self._drop(session)
+                    self._queue(("end", session["_id"]))
+        return True
+
+
+def create_pairing_table(storage):
+    """PairingTable for this process: sharded when SHARD_URLS lists more than one shard."""
+    if len(SHARD_URLS) <= 1:
+        return PairingTable(storage)
+    if isinstance(storage, MemoryStorage):
+        raise ValueError("Sharding needs a shared MongoDB; MONGO_URI=memory:// keeps state in one process")
+    if not 0 <= SHARD_INDEX < len(SHARD_URLS):
+        raise ValueError(f"SHARD_INDEX {SHARD_INDEX} is out of range for {len(SHARD_URLS)} shards")
+    if not SHARD_SECRET:
+        raise ValueError("SHARD_SECRET must be set when sharding")
+    return ShardedPairingTable(storage, SHARD_INDEX, SHARD_URLS)
+
+
+def add_peer_routes(app, server, pairings):
+    """Serve /shard/pairing, through which other shards offer and end chats."""
+    pairings.locks = server.telegram_app.chat_locks
+
+    @app.route('/shard/pairing', methods=['POST'])
+    def shard_pairing():
+        if not hmac.compare_digest(request.headers.get("X-Shard-Secret", ""), pairings.secret):
+            return "forbidden", 403
+        event = request.get_json(force=True, silent=True)
+        if not isinstance(event, dict) or event.get("op") not in ("pair", "unpair"):
+            return "bad event", 400
+        try:
+            accepted = server.run(pairings.apply_peer_event(event))
+        except asyncio.TimeoutError:
+            # Not a conflict: the offering shard puts the partner back in the queue
+            return "busy", 503
+        return ("ok", 200) if accepted else ("conflict", 409)
+
+
+def create_router(shard_urls):
+    """Flask app that takes Telegram's webhook and forwards each update to its shard."""
+    # One pooled client, so forwarding reuses keep-alive connections to the shards
+    client = httpx.Client(timeout=10)
+    app = Flask(__name__)
+
+    @app.route('/')
+    def home():
+        return f'Router for {len(shard_urls)} shards is running!'
+
+    @app.route('/webhook', methods=['POST'])
+    def webhook():
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return "bad update", 400
+        chat_id = update_chat_id(data)
+        shard = 0 if chat_id is None else shard_of(chat_id, len(shard_urls))
+        try:
+            response = client.post(shard_urls[shard] + "/webhook", content=request.get_data(),
+                                   headers={"Content-Type": "application/json"})
+        except httpx.HTTPError as exc:
+            logger.warning("Shard %d unreachable: %r", shard, exc)
+            # Telegram redelivers after a non-2xx answer
+            return "shard unavailable", 503
+        return response.text, response.status_code
+
+    return app
+
+
+def shard_path(path, index):
+    """path with the shard index before its extension: reports.jsonl -> reports.shard1.jsonl."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def launch(count, entry, base_port):
+    """Start count local shards running entry.py on base_port+1, base_port+2, ...
+
+    They share a working directory, so each gets its own report journal and
+    webhook spill file: a shard rewrites its journal to what it still has
+    pending, and replays whatever is in its spill file as its own.
+    """
+    # webhook imports this module
+    from reports import REPORT_JOURNAL
+    from webhook import WEBHOOK_SPILL_PATH
+
+    urls = [f"http://127.0.0.1:{base_port + 1 + index}" for index in range(count)]
+    processes = []
+    for index in range(count):
+        env = dict(os.environ, SHARD_INDEX=str(index), SHARD_URLS=",".join(urls),
+                   PORT=str(base_port + 1 + index), REPORT_JOURNAL=shard_path(REPORT_JOURNAL, index),
+                   WEBHOOK_SPILL_PATH=shard_path(WEBHOOK_SPILL_PATH, index))
+        processes.append(subprocess.Popen([sys.executable, f"{entry}.py"], env=env))
+    return urls, processes
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--launch", type=int, metavar="N", help="also start N local shards")
+    parser.add_argument("--entry", default="ss", help="entry point the launched shards run (default: ss)")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 5000)), help="router port")
+    args = parser.parse_args()
+
+    processes = []
+    shard_urls = SHARD_URLS
+    if args.launch:
+        if not os.getenv("SHARD_SECRET"):
+            os.environ["SHARD_SECRET"] = os.urandom(16).hex()
+        shard_urls, processes = launch(args.launch, args.entry, args.port)
+    if not shard_urls:
+        parser.error("set SHARD_URLS or use --launch")
+    try:
+        create_router(shard_urls).run(host='0.0.0.0', port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
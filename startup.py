@@ -0,0 +1,120 @@
+"""Cold-start timing and concurrent warm-up.
+
+An entry point creates a Startup right after its imports and registers the
+work that has to happen before the first update (migrating the schema,
+loading chats and bans, replaying the reports journal) with add().
+BotApplication.initialize() then runs all of it concurrently with the
+bot's own initialization (getMe), each phase as soon as the phases it
+depends on are done, instead of one round-trip after another.
+
+Once the bot is ready, the time since the process started is logged with a
+per-phase breakdown:
+
+    imports  interpreter start-up and module imports (Linux only)
+    setup    building storage, the application and the handlers
+    warm-up  the concurrent phases, each also listed on its own
+    start    post_init and starting the application
+
+and compared against COLD_START_TARGET; benchmarks/bench_startup.py
+measures the same thing from the outside, up to the first reply.
+"""
+import asyncio
+import logging
+import os
+import time
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# Seconds from process start to ready that a cold start should stay within
+COLD_START_TARGET = float(os.getenv("COLD_START_TARGET", 2))
+
+
+def process_age():
+    """Seconds since this process started, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/stat") as stat:
+            # Fields after the command name, which may itself contain spaces
+            fields = stat.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as uptime:
+            booted_for = float(uptime.read().split()[0])
+        return booted_for - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Startup:
+    """The phases of one cold start, run concurrently where they can be."""
+
+    def __init__(self, target=COLD_START_TARGET):
+        self.target = target
+        self.phases = {}
+        self.ready_in = None
+        self._warmers = []
+        self._created = time.perf_counter()
+        imports = process_age()
+        if imports is not None:
+            self.phases["imports"] = imports
+        self._process_started = self._created - (imports or 0)
+        self._warmed = None
+        Gauge("bot_startup_seconds", "Seconds from process start until the bot was ready for updates.",
+              lambda: self.ready_in or 0)
+
+    def add(self, name, start, after=()):
+        """Run start() during warm-up, once the phases named in after have finished."""
+        known = {"bot"} | {warmer[0] for warmer in self._warmers}
+        unknown = set(after) - known
+        if unknown:
+            raise ValueError(f"Startup phase {name!r} waits for unknown phases: {', '.join(sorted(unknown))}")
+        self._warmers.append((name, start, tuple(after)))
+
+    async def _timed(self, name, coro):
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    async def warm_up(self, initialize):
+        """Await initialize (the bot's own initialization, phase "bot") and every added phase."""
+        started = time.perf_counter()
+        self.phases["setup"] = started - self._created
+        tasks = {}
+
+        async def run(name, start, after):
+            await asyncio.gather(*(tasks[other] for other in after))
+            await self._timed(name, start())
+
+        tasks["bot"] = asyncio.ensure_future(self._timed("bot", initialize))
+        for name, start, after in self._warmers:
+            tasks[name] = asyncio.ensure_future(run(name, start, after))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        self._warmed = time.perf_counter()
+        self.phases["warm-up"] = self._warmed - started
+
+    def ready(self):
+        """Record that updates can now be handled, and log the breakdown."""
+        now = time.perf_counter()
+        if self._warmed is not None:
+            self.phases["start"] = now - self._warmed
+        self.ready_in = now - self._process_started
+        log = logger.warning if self.ready_in > self.target else logger.info
+        log("Ready in %.2fs (target %.2fs): %s", self.ready_in, self.target, self.breakdown())
+
+    def breakdown(self):
+        parts = []
+        for name in ("imports", "setup", "warm-up", "start"):
+            if name not in self.phases:
+                continue
+            part = f"{name} {self.phases[name]:.2f}s"
+            if name == "warm-up":
+                concurrent = ["bot", *(warmer[0] for warmer in self._warmers)]
+                part += " (" + ", ".join(f"{phase} {self.phases[phase]:.2f}s"
+                                         for phase in concurrent if phase in self.phases) + ")"
+            parts.append(part)
+        return ", ".join(parts)
@@ -0,0 +1,472 @@
+import asyncio
+import functools
+import logging
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError
+from metrics import mongo_call as count_round_trip
+from migrations import bootstrap
+from resilience import Dependency
+
+logger = logging.getLogger(__name__)
+
+# Lost connections, timeouts and primary step-downs are worth retrying
+MONGO = Dependency("mongo", lambda exc: isinstance(exc, ConnectionFailure))
+
+
+def mongo_call(func=None, *, retry=True):
+    """Count each attempt at an async storage method as a Mongo round-trip, and
+    make the calls through MONGO.
+
+    Use retry=False where running an operation twice isn't safe in case the
+    failed attempt was applied after all (claims, inserts); pymongo's own
+    retryable writes still cover those.
+    """
+    if func is None:
+        return functools.partial(mongo_call, retry=retry)
+    return MONGO.guard(count_round_trip(func), retry=retry)
+
+DB_NAME = "anonymous_chat_bot"
+
+# Bucket every waiting user is in; claiming from it takes the longest-waiting user
+ANY_BUCKET = "*"
+
+# A waiting user: when they joined the queue (aware UTC datetime), the
+# preference buckets they're filed under and the fields for their chat record
+Waiter = namedtuple("Waiter", ["user_id", "enqueued_at", "buckets", "fields"], defaults=((), None))
+
+
+class MongoWaitingQueue:
+    """Users waiting for a partner, kept in waiting_users.
+
+    Each document lists the user's preference buckets; claims filter on
+    them through the (buckets, enqueued_at) index, oldest first. claim() is
+    a single find_one_and_delete, so a waiting user can be handed to at most
+    one caller even with several processes sharing the collection.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @mongo_call
+    async def enqueue(self, user_id, buckets=(), fields=None, enqueued_at=None):
+        """Add user_id to the queue; False if they were already in it.
+
+        enqueued_at puts a user who was taken off by mistake back in their old place.
+        """
+        doc = {"user_id": user_id, "enqueued_at": enqueued_at or datetime.now(timezone.utc), "buckets": list(buckets)}
+        if fields:
+            doc["fields"] = fields
+        result = await self.collection.update_one({"user_id": user_id}, {"$setOnInsert": doc}, upsert=True)
+        return result.upserted_id is not None
+
+    @staticmethod
+    def _waiter(doc):
+        # Stored naive unless the client is tz_aware; either way it's UTC
+        return Waiter(doc["user_id"], doc["enqueued_at"].replace(tzinfo=timezone.utc),
+                      tuple(doc.get("buckets", ())), doc.get("fields"))
+
+    @mongo_call(retry=False)
+    async def claim(self, user_id, buckets=(ANY_BUCKET,), enqueued_before=None, exclude=()):
+        """Atomically take the longest-waiting user other than user_id in any of
+        buckets (and queued no later than enqueued_before) off the queue,
+        passing over the few users in exclude.
+
+        Returns a Waiter, or None if nobody suitable is waiting.
+        """
+        query = {"user_id": {"$nin": [user_id, *exclude]} if exclude else {"$ne": user_id}}
+        if tuple(buckets) != (ANY_BUCKET,):
+            query["buckets"] = {"$in": list(buckets)}
+        if enqueued_before is not None:
+            query["enqueued_at"] = {"$lte": enqueued_before}
+        doc = await self.collection.find_one_and_delete(query, sort=[("enqueued_at", 1)])
+        return None if doc is None else self._waiter(doc)
+
+    @mongo_call
+    async def remove(self, user_id):
+        result = await self.collection.delete_one({"user_id": user_id})
+        return result.deleted_count > 0
+
+    @mongo_call
+    async def _expire_one(self, waiter):
+        result = await self.collection.delete_one({"user_id": waiter.user_id, "enqueued_at": waiter.enqueued_at})
+        return result.deleted_count > 0
+
+    async def expire(self, before, limit):
+        """Remove up to limit users queued no later than before; returns the removed Waiters.
+
+        The deletes go out together, but each is for one document, so a user
+        claimed (or expired by another process) in the meantime is left out.
+        """
+        docs = await self._expired(before, limit)
+        waiters = [self._waiter(doc) for doc in docs]
+        removed = await asyncio.gather(*(self._expire_one(waiter) for waiter in waiters))
+        return [waiter for waiter, gone in zip(waiters, removed) if gone]
+
+    @mongo_call
+    async def _expired(self, before, limit):
+        return await self.collection.find({"enqueued_at": {"$lte": before}}).sort("enqueued_at", 1).to_list(limit)
+
+    @mongo_call
+    async def waiting_between(self, after, before):
+        """Waiters who joined after `after` (None: any time) and no later than before, oldest first."""
+        query = {"$lte": before}
+        if after is not None:
+            query["$gt"] = after
+        docs = await self.collection.find({"enqueued_at": query}).sort("enqueued_at", 1).to_list(None)
+        return [self._waiter(doc) for doc in docs]
+
+    @mongo_call
+    async def contains(self, user_id):
+        return await self.collection.find_one({"user_id": user_id}, {"_id": 1}) is not None
+
+    @mongo_call
+    async def count(self):
+        return await self.collection.estimated_document_count()
+
+
+class MemoryWaitingQueue:
+    """In-process waiting queue with O(1) enqueue, claim and removal.
+
+    Besides the global FIFO, every preference bucket is a FIFO of its own,
+    so a claim only looks at the head of each bucket it may take from. A
+    user put back with their old enqueued_at goes back to their old place,
+    ahead of everyone who joined after them, as with MongoWaitingQueue.
+    """
+
+    def __init__(self):
+        # user_id -> Waiter, oldest first
+        self._users = OrderedDict()
+        # bucket -> OrderedDict of the user_ids in it, oldest first
+        self._buckets = {}
+        # (enqueued_at, user_id) sorted by time for waiting_between; entries
+        # of users who left are skipped and compacted away now and then
+        self._timeline = []
+
+    def __len__(self):
+        return len(self._users)
+
+    async def enqueue(self, user_id, buckets=(), fields=None, enqueued_at=None):
+        if user_id in self._users:
+            return False
+        waiter = Waiter(user_id, enqueued_at or datetime.now(timezone.utc), tuple(buckets), fields)
+        self._place(self._users, waiter, waiter)
+        for bucket in waiter.buckets:
+            self._place(self._buckets.setdefault(bucket, OrderedDict()), waiter, None)
+        if len(self._timeline) > 2 * len(self._users) + 1000:
+            self._timeline = sorted((other.enqueued_at, other.user_id) for other in self._users.values())
+        entry = (waiter.enqueued_at, user_id)
+        if enqueued_at is None:
+            self._timeline.append(entry)
+        else:
+            # A user put back in their old place may still have their old entry
+            index = bisect_left(self._timeline, entry)
+            if index == len(self._timeline) or self._timeline[index] != entry:
+                self._timeline.insert(index, entry)
+        return True
+
+    def _place(self, users, waiter, value):
+        # Newcomers go to the back at once; a put-back moves the users who
+        # joined after them behind it
+        later = []
+        for other_id in reversed(users):
+            if self._users[other_id].enqueued_at <= waiter.enqueued_at:
+                break
+            later.append(other_id)
+        users[waiter.user_id] = value
+        for other_id in reversed(later):
+            users.move_to_end(other_id)
+
+    def _head(self, bucket, user_id, exclude):
+        users = self._users if bucket == ANY_BUCKET else self._buckets.get(bucket, ())
+        # user_id and the excluded users appear at most once each, so this
+        # looks at no more than len(exclude) + 2 entries
+        for partner_id in users:
+            if partner_id != user_id and partner_id not in exclude:
+                return self._users[partner_id]
+        return None
+
+    def _pop(self, user_id):
+        waiter = self._users.pop(user_id)
+        for bucket in waiter.buckets:
+            users = self._buckets[bucket]
+            del users[user_id]
+            if not users:
+                del self._buckets[bucket]
+        return waiter
+
+    async def claim(self, user_id, buckets=(ANY_BUCKET,), enqueued_before=None, exclude=()):
+        oldest = None
+        for bucket in buckets:
+            waiter = self._head(bucket, user_id, exclude)
+            if waiter is not None and (oldest is None or waiter.enqueued_at < oldest.enqueued_at):
+                oldest = waiter
+        if oldest is None or (enqueued_before is not None and oldest.enqueued_at > enqueued_before):
+            return None
+        return self._pop(oldest.user_id)
+
+    async def remove(self, user_id):
+        if user_id not in self._users:
+            return False
+        self._pop(user_id)
+        return True
+
+    async def expire(self, before, limit):
+        expired = []
+        for enqueued_at, user_id in self._timeline:
+            if enqueued_at > before or len(expired) >= limit:
+                break
+            waiter = self._users.get(user_id)
+            if waiter is not None and waiter.enqueued_at == enqueued_at:
+                expired.append(self._pop(user_id))
+        return expired
+
+    async def waiting_between(self, after, before):
+        start = 0 if after is None else bisect_right(self._timeline, after, key=lambda entry: entry[0])
+        end = bisect_right(self._timeline, before, key=lambda entry: entry[0])
+        waiters = []
+        for enqueued_at, user_id in self._timeline[start:end]:
+            waiter = self._users.get(user_id)
+            if waiter is not None and waiter.enqueued_at == enqueued_at:
+                waiters.append(waiter)
+        return waiters
+
+    async def contains(self, user_id):
+        return user_id in self._users
+
+    async def count(self):
+        return len(self._users)
+
+
+class MongoSeenUpdates:
+    """Shared record of processed update_ids in processed_updates (TTL-indexed)."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @mongo_call(retry=False)
+    async def add(self, update_id):
+        """Record update_id; False if some instance had already recorded it."""
+        try:
+            await self.collection.insert_one({"_id": update_id, "seen_at": datetime.now(timezone.utc)})
+            return True
+        except DuplicateKeyError:
+            return False
+
+
+class MemorySeenUpdates:
+    def __init__(self):
+        self._seen = set()
+
+    async def add(self, update_id):
+        if update_id in self._seen:
+            return False
+        self._seen.add(update_id)
+        return True
+
+
+class MongoStorage:
+    """Async repository over the waiting_users, active_chats and reports collections.
+
+    Backed by motor, so every round-trip yields to the event loop instead
+    of blocking it while Mongo answers.
+    """
+
+    def __init__(self, uri, db_name=DB_NAME):
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        self.client = AsyncIOMotorClient(uri)
+        self.db = self.client[db_name]
+        self.waiting_users = self.db["waiting_users"]
+        self.active_chats = self.db["active_chats"]
+        self.reports = self.db["reports"]
+        self.processed_updates = self.db["processed_updates"]
+        self.report_counts = self.db["report_counts"]
+        self.bans = self.db["bans"]
+        self.preferences = self.db["preferences"]
+        self.waiting = MongoWaitingQueue(self.waiting_users)
+        self.seen_updates = MongoSeenUpdates(self.processed_updates)
+
+    async def bootstrap(self):
+        """Migrate legacy data and create missing indexes. A failure (e.g. duplicate
+        rows blocking a unique index) is logged rather than keeping the bot from starting."""
+        try:
+            await bootstrap(self.db)
+        except Exception:
+            logger.exception("Index bootstrap failed; run `python migrations.py --check`")
+
+    # active_chats, one session document per chat
+    @mongo_call
+    async def find_active_chat(self, user_id):
+        return await self.active_chats.find_one({"users": user_id})
+
+    @mongo_call
+    async def load_active_chats(self):
+        return await self.active_chats.find({"users": {"$exists": True}}).to_list(None)
+
+    @mongo_call(retry=False)
+    async def apply_chat_writes(self, ops):
+        # Replays queued ("create", session), ("end", session_id) and
+        # ("touch", session_id, last_activity) ops as one ordered bulk write.
+        # Every op is idempotent, so a failed batch can safely be replayed.
+        requests = []
+        for op in ops:
+            if op[0] == "create":
+                requests.append(InsertOne(dict(op[1])))
+            elif op[0] == "end":
+                requests.append(DeleteOne({"_id": op[1]}))
+            else:
+                requests.append(UpdateOne({"_id": op[1]}, {"$set": {"last_activity": op[2]}}))
+
+        while requests:
+            try:
+                await self.active_chats.bulk_write(requests, ordered=True)
+                return
+            except BulkWriteError as exc:
+                error = exc.details["writeErrors"][0]
+                if error["code"] != 11000:
+                    raise
+                # The session (or a session for one of its users) already
+                # exists; skip it and carry on after it
+                logger.warning("Skipping duplicate chat session: %s", error.get("errmsg"))
+                requests = requests[error["index"] + 1:]
+
+    # reports
+    @mongo_call(retry=False)
+    async def add_reports(self, reports):
+        # Reports carry their own _id, so a batch replayed after a crash
+        # only inserts the ones that hadn't made it
+        try:
+            await self.reports.insert_many(reports, ordered=False)
+        except BulkWriteError as exc:
+            if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+                raise
+
+    # moderation
+    @mongo_call
+    async def count_reports(self, pairs):
+        """Count each distinct reporter once per reported user; pairs are
+        (reported_user_id, reporter_id). Returns {reported_user_id: count}."""
+        now = datetime.now(timezone.utc)
+        requests = [
+            # Matches only if this reporter isn't counted yet; otherwise the
+            # upsert collides with the existing _id and is skipped
+            UpdateOne({"_id": reported, "reporters": {"$ne": reporter}},
+                      {"$inc": {"count": 1}, "$push": {"reporters": reporter}, "$set": {"last_report_at": now}},
+                      upsert=True)
+            for reported, reporter in pairs
+        ]
+        try:
+            await self.report_counts.bulk_write(requests, ordered=False)
+        except BulkWriteError as exc:
+            if any(error["code"] != 11000 for error in exc.details["writeErrors"]):
+                raise
+        reported = list({reported for reported, _ in pairs})
+        docs = await self.report_counts.find({"_id": {"$in": reported}}, {"count": 1}).to_list(None)
+        return {doc["_id"]: doc["count"] for doc in docs}
+
+    @mongo_call
+    async def add_bans(self, user_ids, reason):
+        now = datetime.now(timezone.utc)
+        await self.bans.bulk_write([
+            UpdateOne({"_id": user_id}, {"$setOnInsert": {"reason": reason, "banned_at": now}}, upsert=True)
+            for user_id in user_ids
+        ])
+
+    @mongo_call
+    async def remove_ban(self, user_id):
+        await self.report_counts.delete_one({"_id": user_id})
+        result = await self.bans.delete_one({"_id": user_id})
+        return result.deleted_count > 0
+
+    @mongo_call
+    async def load_bans(self):
+        return {doc["_id"] async for doc in self.bans.find({}, {"_id": 1})}
+
+    # matching preferences, one document per user
+    @mongo_call
+    async def load_preferences(self, user_id):
+        return await self.preferences.find_one({"_id": user_id})
+
+    @mongo_call
+    async def save_preferences(self, user_id, preferences):
+        await self.preferences.replace_one({"_id": user_id}, dict(preferences, _id=user_id), upsert=True)
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryStorage:
+    """In-process stand-in for MongoStorage, used by tests and benchmarks."""
+
+    def __init__(self):
+        self.waiting = MemoryWaitingQueue()
+        self.seen_updates = MemorySeenUpdates()
+        self.active_chats = {}
+        self.reports = []
+        self.report_counts = {}
+        self.bans = {}
+        self.preferences = {}
+
+    async def bootstrap(self):
+        pass
+
+    # active_chats, keyed by session _id
+    async def find_active_chat(self, user_id):
+        for session in self.active_chats.values():
+            if user_id in session["users"]:
+                return session
+        return None
+
+    async def load_active_chats(self):
+        return [dict(session) for session in self.active_chats.values()]
+
+    async def apply_chat_writes(self, ops):
+        for op in ops:
+            if op[0] == "create":
+                self.active_chats.setdefault(op[1]["_id"], dict(op[1]))
+            elif op[0] == "end":
+                self.active_chats.pop(op[1], None)
+            elif op[1] in self.active_chats:
+                self.active_chats[op[1]]["last_activity"] = op[2]
+
+    # reports
+    async def add_reports(self, reports):
+        stored = {report["_id"] for report in self.reports}
+        self.reports.extend(dict(report) for report in reports if report["_id"] not in stored)
+
+    # moderation, report_counts maps a reported user to their reporters
+    async def count_reports(self, pairs):
+        for reported, reporter in pairs:
+            self.report_counts.setdefault(reported, set()).add(reporter)
+        return {reported: len(self.report_counts[reported]) for reported, _ in pairs}
+
+    async def add_bans(self, user_ids, reason):
+        for user_id in user_ids:
+            self.bans.setdefault(user_id, {"reason": reason, "banned_at": datetime.now(timezone.utc)})
+
+    async def remove_ban(self, user_id):
+        self.report_counts.pop(user_id, None)
+        return self.bans.pop(user_id, None) is not None
+
+    async def load_bans(self):
+        return set(self.bans)
+
+    # matching preferences
+    async def load_preferences(self, user_id):
+        return self.preferences.get(user_id)
+
+    async def save_preferences(self, user_id, preferences):
+        self.preferences[user_id] = dict(preferences)
+
+    def close(self):
+        pass
+
+
+def create_storage(uri):
+    """Pick a storage backend from MONGO_URI; "memory://" selects the in-process one."""
+    if uri and uri.startswith("memory://"):
+        return MemoryStorage()
+    return MongoStorage(uri)
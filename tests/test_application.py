@@ -0,0 +1,134 @@
+import asyncio
+import random
+
+from telegram import Chat, Message, Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from application import BotApplication
+from dedup import UpdateDeduplicator
+from resilience import DependencyUnavailable
+
+_update_ids = iter(range(1, 1_000_000))
+
+
+def message(chat_id, text):
+    chat = Chat(chat_id, Chat.PRIVATE)
+    return Update(next(_update_ids), message=Message(0, None, chat, text=text))
+
+
+def build(handler, concurrent_updates=4, **kwargs):
+    app = (
+        ApplicationBuilder()
+        .token("0:test")
+        .application_class(BotApplication, kwargs=kwargs)
+        .concurrent_updates(concurrent_updates)
+        .build()
+    )
+    # Skip initialize(), which would call getMe on the real Bot API
+    app._initialized = True
+    app.add_handler(TypeHandler(Update, handler))
+    return app
+
+
+async def run_polling(app, updates, timeout=5):
+    """Feed updates through the application's update queue, as run_polling does."""
+    await app.start()
+    try:
+        for update in updates:
+            await app.update_queue.put(update)
+        async with asyncio.timeout(timeout):
+            while not app.update_queue.empty() or app.pending():
+                await asyncio.sleep(0.01)
+    finally:
+        await app.stop()
+
+
+def test_busy_chat_does_not_delay_other_chats():
+    handled = []
+
+    async def handler(update, context):
+        if update.effective_chat.id == 1:
+            await asyncio.sleep(0.2)
+        handled.append(update.effective_chat.id)
+
+    app = build(handler, concurrent_updates=4)
+    updates = [message(1, str(seq)) for seq in range(6)] + [message(2, "hi")]
+    asyncio.run(run_polling(app, updates))
+
+    # Chat 1's backlog holds no polling slot, so chat 2 goes first
+    assert handled == [2] + [1] * 6
+
+
+
+def test_concurrent_updates_caps_handlers_across_chats():
+    running = []
+    most = 0
+
+    async def handler(update, context):
+        nonlocal most
+        running.append(update)
+        most = max(most, len(running))
+        await asyncio.sleep(0.01)
+        running.remove(update)
+
+    app = build(handler, concurrent_updates=3)
+    asyncio.run(run_polling(app, [message(chat_id, "hi") for chat_id in range(20)]))
+
+    assert most == 3
+
+def test_chat_order_kept_with_slow_shared_dedup_store():
+    class SlowStore:
+        def __init__(self):
+            self.ids = set()
+
+        async def add(self, update_id):
+            await asyncio.sleep(random.uniform(0, 0.01))
+            if update_id in self.ids:
+                return False
+            self.ids.add(update_id)
+            return True
+
+    handled = []
+
+    async def handler(update, context):
+        handled.append(int(update.message.text))
+
+    app = build(handler, concurrent_updates=64, deduplicator=UpdateDeduplicator(store=SlowStore()))
+    asyncio.run(run_polling(app, [message(1, str(seq)) for seq in range(50)]))
+
+    assert handled == list(range(50))
+
+
+def test_redelivered_update_is_handled_once():
+    handled = []
+
+    async def handler(update, context):
+        handled.append(update.update_id)
+
+    app = build(handler, deduplicator=UpdateDeduplicator())
+    update = message(1, "hello")
+    asyncio.run(run_polling(app, [update, update, message(1, "again")]))
+
+    assert handled == [update.update_id, update.update_id + 1]
+
+
+def test_updates_handled_while_shared_dedup_store_is_down():
+    class DownStore:
+        def __init__(self):
+            self.calls = 0
+
+        async def add(self, update_id):
+            self.calls += 1
+            if self.calls == 1:
+                raise ConnectionError("mongo is down")
+            raise DependencyUnavailable("mongo", 30)
+
+    handled = []
+
+    async def handler(update, context):
+        handled.append(update.message.text)
+
+    app = build(handler, deduplicator=UpdateDeduplicator(store=DownStore()))
+    asyncio.run(run_polling(app, [message(1, "one"), message(1, "two")]))
+
+    assert handled == ["one", "two"]
@@ -0,0 +1,68 @@
+import asyncio
+
+import dedup
+from dedup import UpdateDeduplicator
+from metrics import DEDUP_CHECKS, DEDUP_FORGOTTEN
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_duplicates_within_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dedup.time, "monotonic", clock)
+    deduplicator = UpdateDeduplicator(max_size=10, ttl=60)
+    duplicates = DEDUP_CHECKS.value("duplicate")
+
+    assert not deduplicator.seen(1)
+    assert deduplicator.seen(1)
+    clock.now += 61
+    # Forgotten once the TTL is up
+    assert not deduplicator.seen(1)
+    assert deduplicator.stats() == {"size": 1, "hits": 1, "misses": 2, "expired": 1, "evictions": 0}
+    assert DEDUP_CHECKS.value("duplicate") == duplicates + 1
+
+
+def test_eviction_counted_apart_from_expiry(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dedup.time, "monotonic", clock)
+    deduplicator = UpdateDeduplicator(max_size=3, ttl=60)
+    evicted = DEDUP_FORGOTTEN.value("evicted")
+    expired = DEDUP_FORGOTTEN.value("expired")
+
+    for update_id in range(5):
+        deduplicator.seen(update_id)
+    assert len(deduplicator) == 3
+    assert deduplicator.evictions == 2 and deduplicator.expired == 0
+    clock.now += 61
+    deduplicator.seen(5)
+    assert deduplicator.evictions == 2 and deduplicator.expired == 3
+    assert DEDUP_FORGOTTEN.value("evicted") == evicted + 2
+    assert DEDUP_FORGOTTEN.value("expired") == expired + 3
+
+
+def test_shared_store_catches_other_instances_updates():
+    class Store:
+        def __init__(self):
+            self.ids = set()
+
+        async def add(self, update_id):
+            if update_id in self.ids:
+                return False
+            self.ids.add(update_id)
+            return True
+
+    store = Store()
+    first, restarted = UpdateDeduplicator(store=store), UpdateDeduplicator(store=store)
+
+    async def run():
+        return await first.is_duplicate(7), await restarted.is_duplicate(7), await restarted.is_duplicate(7)
+
+    assert asyncio.run(run()) == (False, True, True)
+    # The second repeat is answered by the local cache
+    assert restarted.hits == 2 and restarted.misses == 0
@@ -0,0 +1,118 @@
+import asyncio
+import random
+
+from matchmaking import ALREADY_WAITING, PAIRED, WAITING, Matchmaker
+from pairings import PairingTable
+from storage import MemoryStorage, MemoryWaitingQueue
+
+
+class SlowQueue(MemoryWaitingQueue):
+    """MemoryWaitingQueue that yields around every call, like a Mongo round-trip."""
+
+    def __init__(self, rng):
+        super().__init__()
+        self.rng = rng
+
+    async def _pause(self):
+        await asyncio.sleep(self.rng.uniform(0, 0.002))
+
+    async def enqueue(self, *args, **kwargs):
+        await self._pause()
+        return await super().enqueue(*args, **kwargs)
+
+    async def claim(self, *args, **kwargs):
+        await self._pause()
+        result = await super().claim(*args, **kwargs)
+        await self._pause()
+        return result
+
+    async def remove(self, user_id):
+        await self._pause()
+        return await super().remove(user_id)
+
+    async def contains(self, user_id):
+        await self._pause()
+        result = await super().contains(user_id)
+        await self._pause()
+        return result
+
+
+def test_next_never_pairs_a_user_with_themselves():
+    storage = MemoryStorage()
+    pairings = PairingTable(storage)
+    matchmaker = Matchmaker(pairings, storage.waiting)
+
+    async def run():
+        return await asyncio.gather(*(matchmaker.next(1) for _ in range(3)))
+
+    statuses = sorted(match.status for match in asyncio.run(run()))
+    assert statuses == sorted([WAITING, ALREADY_WAITING, ALREADY_WAITING])
+    assert pairings.get(1) is None
+
+
+def test_concurrent_next_never_pairs_anyone_twice():
+    rng = random.Random(4)
+    queue = SlowQueue(rng)
+    pairings = PairingTable(MemoryStorage())
+    matchmaker = Matchmaker(pairings, queue)
+
+    async def user(user_id):
+        for _ in range(3):
+            await matchmaker.next(user_id)
+            if rng.random() < 0.3 and pairings.get(user_id):
+                pairings.unpair(user_id)
+
+    async def run():
+        await asyncio.gather(*(user(user_id) for user_id in range(1, 201)))
+        return [(user_id, await queue.contains(user_id)) for user_id in range(1, 201)]
+
+    waiting = dict(asyncio.run(run()))
+    for user_id in range(1, 201):
+        partner_id = pairings.partner_of(user_id)
+        if partner_id is not None:
+            assert partner_id != user_id
+            assert pairings.partner_of(partner_id) == user_id
+            assert not waiting[user_id], f"{user_id} is chatting and waiting"
+
+
+def test_slow_pairing_does_not_hold_up_other_users():
+    class SlowPairings(PairingTable):
+        async def pair_claimed(self, user_id, partner_id, **fields):
+            if user_id == 1:
+                await asyncio.sleep(0.5)
+            return await super().pair_claimed(user_id, partner_id, **fields)
+
+    storage = MemoryStorage()
+    matchmaker = Matchmaker(SlowPairings(storage), storage.waiting)
+    finished = []
+
+    async def next_(user_id):
+        match = await matchmaker.next(user_id)
+        finished.append((user_id, match))
+
+    async def run():
+        await storage.waiting.enqueue(10)
+        await storage.waiting.enqueue(11)
+        await asyncio.gather(next_(1), next_(2))
+
+    asyncio.run(run())
+    assert [user_id for user_id, _ in finished] == [2, 1]
+    assert all(match.status == PAIRED for _, match in finished)
+
+
+def test_last_partner_outlives_the_chat():
+    storage = MemoryStorage()
+    pairings = PairingTable(storage)
+    matchmaker = Matchmaker(pairings, storage.waiting)
+
+    async def run():
+        await matchmaker.next(1)
+        await matchmaker.next(2)
+
+    asyncio.run(run())
+    assert matchmaker.last_partner(1) == 2
+    # Reported after /stop, as most reports are
+    pairings.unpair(1)
+    assert matchmaker.last_partner(1) == 2
+    assert matchmaker.last_partner(2) == 1
+    assert matchmaker.last_partner(3) is None
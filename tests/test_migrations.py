@@ -0,0 +1,118 @@
+import asyncio
+
+from pymongo import DeleteMany, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from migrations import INDEXES, bootstrap
+
+
+class FakeCollection:
+    """The slice of a motor collection bootstrap() uses, with unique indexes
+    enforced the way Mongo does: a document missing the key is indexed as null."""
+
+    def __init__(self, docs=(), indexes=None):
+        self.docs = [dict(doc) for doc in docs]
+        self.indexes = {"_id_": {"key": [("_id", 1)], "unique": True}, **(indexes or {})}
+
+    @staticmethod
+    def _matches(doc, query):
+        for field, condition in query.items():
+            if isinstance(condition, dict) and "$exists" in condition:
+                if (field in doc) != condition["$exists"]:
+                    return False
+            elif doc.get(field) != condition:
+                return False
+        return True
+
+    def _check_unique(self, docs):
+        for name, index in self.indexes.items():
+            if not index.get("unique"):
+                continue
+            field = index["key"][0][0]
+            seen = set()
+            for doc in docs:
+                value = doc.get(field)
+                for key in value if isinstance(value, list) else [value]:
+                    if key in seen:
+                        return {"code": 11000, "errmsg": f"E11000 duplicate key error index: {name}"}
+                    seen.add(key)
+        return None
+
+    def find(self, query):
+        docs = [dict(doc) for doc in self.docs if self._matches(doc, query)]
+
+        class Cursor:
+            def sort(self, *args):
+                return self
+
+            async def to_list(self, length):
+                return docs
+
+        return Cursor()
+
+    async def bulk_write(self, requests, ordered=True):
+        for index, request in enumerate(requests):
+            if isinstance(request, ReplaceOne):
+                others = [doc for doc in self.docs if not self._matches(doc, request._filter)]
+                docs = others + [dict(request._doc, **request._filter)]
+            else:
+                assert isinstance(request, DeleteMany)
+                docs = [doc for doc in self.docs if not self._matches(doc, request._filter)]
+            error = self._check_unique(docs)
+            if error:
+                raise BulkWriteError({"writeErrors": [dict(error, index=index)]})
+            self.docs = docs
+
+    async def update_many(self, query, update):
+        # Only reached with collections that have nothing to migrate
+        assert not self.docs
+
+        class Result:
+            modified_count = 0
+
+        return Result()
+
+    async def index_information(self):
+        return dict(self.indexes)
+
+    async def drop_index(self, name):
+        del self.indexes[name]
+
+    async def create_indexes(self, models):
+        for model in models:
+            document = model.document
+            index = {"key": list(document["key"].items()), "unique": document.get("unique", False)}
+            previous, self.indexes[document["name"]] = self.indexes.get(document["name"]), index
+            if self._check_unique(self.docs):
+                self.indexes[document["name"]] = previous
+                raise BulkWriteError({"writeErrors": [{"code": 11000}]})
+        return [model.document["name"] for model in models]
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+def test_bootstrap_migrates_legacy_chats_under_the_old_unique_index():
+    legacy = [
+        {"_id": 1, "user_id": 10, "partner_id": 11, "start_time": 1.0},
+        {"_id": 2, "user_id": 11, "partner_id": 10, "start_time": 1.0},
+        {"_id": 3, "user_id": 20, "partner_id": 21, "start_time": 2.0},
+        {"_id": 4, "user_id": 21, "partner_id": 20, "start_time": 2.0},
+        {"_id": 5, "user_id": 30, "partner_id": 31, "start_time": 3.0},
+        {"_id": 6, "user_id": 31, "partner_id": 30, "start_time": 3.0},
+    ]
+    db = FakeDatabase()
+    db["active_chats"] = FakeCollection(legacy, {"user_id_unique": {"key": [("user_id", 1)], "unique": True}})
+
+    asyncio.run(bootstrap(db))
+
+    chats = db["active_chats"]
+    assert sorted(doc["_id"] for doc in chats.docs) == ["10:11", "20:21", "30:31"]
+    assert "user_id_unique" not in chats.indexes
+    assert set(chats.indexes) == {"_id_"} | {index.document["name"] for index in INDEXES["active_chats"]}
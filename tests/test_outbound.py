@@ -0,0 +1,83 @@
+import asyncio
+
+import httpx
+import pytest
+from telegram.error import BadRequest, NetworkError, TimedOut
+
+from outbound import PRIORITY_NOTIFY, PRIORITY_RELAY, SendScheduler, is_transient, resendable
+from resilience import CircuitBreaker, Dependency
+
+
+def chained(error, cause):
+    try:
+        raise error from cause
+    except NetworkError as exc:
+        return exc
+
+
+def test_resendable():
+    read_timeout = chained(TimedOut(), httpx.ReadTimeout("read"))
+    refused = chained(NetworkError("httpx.ConnectError"), httpx.ConnectError("refused"))
+    dropped = chained(NetworkError("httpx.ReadError"), httpx.ReadError("reset"))
+    bad_gateway = NetworkError("Bad Gateway")
+
+    assert not resendable("sendMessage", read_timeout)
+    assert not resendable("copyMessage", dropped)
+    assert resendable("sendMessage", refused)
+    assert resendable("sendMessage", bad_gateway)
+    assert resendable("sendChatAction", read_timeout)
+    assert resendable("getMe", dropped)
+    assert not resendable("sendChatAction", BadRequest("Chat not found"))
+
+
+def scheduler():
+    bot_api = Dependency("test_api", is_transient, base_delay=0, breaker=CircuitBreaker("test_api", 100, 60))
+    return SendScheduler(global_rate=1e9, chat_rate=1e9, chat_burst=1e9, log_interval=0, bot_api=bot_api)
+
+
+def send(limiter, callback, endpoint, priority):
+    async def run():
+        await limiter.initialize()
+        try:
+            return await limiter.process_request(callback, (), {}, endpoint, {"chat_id": 1}, priority)
+        finally:
+            await limiter.shutdown()
+
+    return asyncio.run(run())
+
+
+def failing(error, calls):
+    async def callback():
+        calls.append(1)
+        raise error
+
+    return callback
+
+
+def test_send_not_retried_after_read_timeout():
+    calls = []
+    error = chained(TimedOut(), httpx.ReadTimeout("read"))
+    limiter = scheduler()
+    with pytest.raises(TimedOut):
+        send(limiter, failing(error, calls), "sendMessage", PRIORITY_NOTIFY)
+    # Neither retried nor held for a resend
+    assert calls == [1]
+    assert limiter.stats()["held"] == 0
+
+
+def test_chat_action_retried_after_read_timeout():
+    calls = []
+    error = chained(TimedOut(), httpx.ReadTimeout("read"))
+    limiter = scheduler()
+    with pytest.raises(TimedOut):
+        send(limiter, failing(error, calls), "sendChatAction", PRIORITY_RELAY)
+    assert len(calls) == limiter.bot_api.attempts
+
+
+def test_notification_held_when_never_sent():
+    calls = []
+    error = chained(NetworkError("httpx.ConnectError"), httpx.ConnectError("refused"))
+    limiter = scheduler()
+    assert send(limiter, failing(error, calls), "sendMessage", PRIORITY_NOTIFY) is None
+    assert len(calls) == limiter.bot_api.attempts
+    assert limiter.stats()["held"] == 1
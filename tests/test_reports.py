@@ -0,0 +1,30 @@
+import asyncio
+
+from reports import ReportSink
+from storage import MemoryStorage
+
+
+def test_journal_is_replayed_after_a_crash(tmp_path):
+    journal = tmp_path / "reports.jsonl"
+    storage = MemoryStorage()
+
+    async def crash():
+        sink = ReportSink(storage, journal_path=str(journal))
+        for reporter in range(3):
+            await sink.add({"reporter": reporter, "reported": 99})
+        # One batch made it to Mongo before the crash, the journal wasn't cut back yet
+        await storage.add_reports(sink._pending[:1])
+        # and the last write was cut short
+        with open(journal, "a", encoding="utf-8") as file:
+            file.write('{"reporter": 3, "rep')
+
+    async def restart():
+        sink = ReportSink(storage, journal_path=str(journal))
+        await sink.start()
+        assert len(sink) == 3
+        await sink.stop()
+
+    asyncio.run(crash())
+    asyncio.run(restart())
+    assert sorted(report["reporter"] for report in storage.reports) == [0, 1, 2]
+    assert journal.read_text() == ""
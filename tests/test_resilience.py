@@ -0,0 +1,43 @@
+import pytest
+
+import resilience
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, DependencyUnavailable
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_breaker_transitions(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+    breaker.failure()
+    breaker.failure()
+    breaker.check()
+    assert breaker.state == CLOSED
+
+    breaker.failure()
+    assert breaker.state == OPEN
+    with pytest.raises(DependencyUnavailable):
+        breaker.check()
+
+    clock[0] += 10
+    breaker.check()
+    assert breaker.state == HALF_OPEN
+    # A single failed trial call opens it again for another reset_timeout
+    breaker.failure()
+    assert breaker.state == OPEN
+    clock[0] += 5
+    with pytest.raises(DependencyUnavailable) as raised:
+        breaker.check()
+    assert raised.value.retry_in == 5
+
+    clock[0] += 5
+    breaker.check()
+    breaker.success()
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+    breaker.failure()
+    assert breaker.state == CLOSED
@@ -0,0 +1,115 @@
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+
+from matchmaking import WAITING, Matchmaker
+import reports
+import sharding
+from sharding import ShardedPairingTable, shard_of
+from storage import MemoryStorage
+
+URLS = ["http://shard-0", "http://shard-1"]
+
+
+def owned_by(shard, count):
+    return [user_id for user_id in range(1, 1000) if shard_of(user_id, len(URLS)) == shard][:count]
+
+
+class FlakyStorage(MemoryStorage):
+    def __init__(self, failed_writes=0):
+        super().__init__()
+        self.failed_writes = failed_writes
+
+    async def apply_chat_writes(self, ops):
+        if self.failed_writes:
+            self.failed_writes -= 1
+            raise ConnectionError("mongo is down")
+        await super().apply_chat_writes(ops)
+
+
+class Shard0(ShardedPairingTable):
+    """Shard 0 of two, with the other shard answering offers through answer()."""
+
+    def __init__(self, storage, answer):
+        super().__init__(storage, 0, URLS, secret="test")
+        self.answer = answer
+        self.events = []
+
+    async def _send(self, user_id, event):
+        self.events.append(event["op"])
+        return self.answer(event)
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+def refuse(event):
+    if event["op"] == "pair":
+        raise httpx.ConnectError("connection refused")
+    return True
+
+
+async def pair_across_shards(pairings, storage):
+    caller, = owned_by(0, 1)
+    partner, = owned_by(1, 1)
+    matchmaker = Matchmaker(pairings, storage.waiting)
+    await storage.waiting.enqueue(partner)
+    queued, = await storage.waiting.waiting_between(None, now())
+
+    match = await matchmaker.next(caller)
+    await asyncio.gather(*pairings._notices)
+    await pairings.flush()
+    return caller, partner, queued, match
+
+
+def test_unreachable_shard_puts_partner_back():
+    storage = MemoryStorage()
+    pairings = Shard0(storage, refuse)
+    caller, partner, queued, match = asyncio.run(pair_across_shards(pairings, storage))
+
+    assert match.status == WAITING
+    assert not pairings.get(caller) and not storage.active_chats
+    # The offer may have landed, so the other shard is told the chat is off
+    assert pairings.events == ["pair", "unpair"]
+    # The partner is back in their old place, ahead of the caller
+    waiting = asyncio.run(storage.waiting.waiting_between(None, now()))
+    assert [(waiter.user_id, waiter.enqueued_at) for waiter in waiting] == [(partner, queued.enqueued_at),
+                                                                           (caller, waiting[1].enqueued_at)]
+
+
+def test_conflict_drops_stale_partner():
+    storage = MemoryStorage()
+    pairings = Shard0(storage, lambda event: False)
+    caller, partner, queued, match = asyncio.run(pair_across_shards(pairings, storage))
+
+    assert match.status == WAITING
+    assert not storage.active_chats
+    waiting = asyncio.run(storage.waiting.waiting_between(None, now()))
+    assert [waiter.user_id for waiter in waiting] == [caller]
+
+
+def test_failed_flush_leaves_no_session_behind():
+    storage = FlakyStorage(failed_writes=1)
+    pairings = Shard0(storage, lambda event: True)
+    caller, partner, queued, match = asyncio.run(pair_across_shards(pairings, storage))
+
+    assert match.status == WAITING
+    # Never offered, and the queued create is cancelled by an end once Mongo is back
+    assert pairings.events == []
+    assert not pairings.get(caller) and not storage.active_chats
+    waiting = asyncio.run(storage.waiting.waiting_between(None, now()))
+    assert waiting[0].user_id == partner and waiting[0].enqueued_at == queued.enqueued_at
+
+
+def test_launched_shards_get_their_own_journal_and_spill_file(monkeypatch):
+    envs = []
+    monkeypatch.setattr(sharding.subprocess, "Popen", lambda args, env: envs.append(env))
+    monkeypatch.setattr(reports, "REPORT_JOURNAL", "reports.jsonl")
+
+    sharding.launch(3, "ss", 5000)
+
+    assert len({env["REPORT_JOURNAL"] for env in envs}) == 3
+    assert len({env["WEBHOOK_SPILL_PATH"] for env in envs}) == 3
+    assert envs[1]["REPORT_JOURNAL"] == "reports.shard1.jsonl"
@@ -0,0 +1,25 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from storage import MemoryWaitingQueue
+
+
+def test_put_back_user_keeps_their_place():
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    async def run():
+        queue = MemoryWaitingQueue()
+        for user_id in range(1, 5):
+            await queue.enqueue(user_id, ["0:en"], enqueued_at=start + timedelta(seconds=user_id))
+        first = await queue.claim(0, ["0:en"])
+        assert first.user_id == 1
+        await queue.enqueue(first.user_id, first.buckets, first.fields, first.enqueued_at)
+
+        # Back at the head of both the queue and their bucket
+        assert (await queue.claim(0)).user_id == 1
+        await queue.enqueue(first.user_id, first.buckets, first.fields, first.enqueued_at)
+        assert (await queue.claim(0, ["0:en"], enqueued_before=start + timedelta(seconds=1))).user_id == 1
+        await queue.enqueue(first.user_id, first.buckets, first.fields, first.enqueued_at)
+        return [(await queue.claim(0, ["0:en"])).user_id for _ in range(4)]
+
+    assert asyncio.run(run()) == [1, 2, 3, 4]
@@ -0,0 +1,39 @@
+import asyncio
+import json
+import types
+
+from webhook import WebhookServer
+
+
+def test_spill_is_replayed_in_chunks_that_fit_the_queue(tmp_path):
+    spill_path = tmp_path / "spill.jsonl"
+    with open(spill_path, "w", encoding="utf-8") as spill:
+        for update_id in range(1, 6):
+            spill.write(json.dumps({"update_id": update_id}) + "\n")
+        spill.write('{"update_id": 6, "mess')
+    server = WebhookServer(types.SimpleNamespace(bot=None), queue_size=4, overflow="spill",
+                           spill_path=str(spill_path))
+
+    async def drain():
+        update_ids = []
+        while not server._queue.empty():
+            update_ids.append(server._queue.get_nowait().update_id)
+            server._handled()
+        return update_ids
+
+    async def run():
+        replay = asyncio.create_task(server._replay_spill())
+        chunks = []
+        try:
+            for _ in range(3):
+                await asyncio.sleep(1.05)
+                assert server._depth <= 2
+                chunks.append(await drain())
+        finally:
+            replay.cancel()
+        return chunks
+
+    assert asyncio.run(run()) == [[1, 2], [3, 4], [5]]
+    assert server._depth == 0
+    assert list(tmp_path.iterdir()) == []
+    server.loop.close()
@@ -0,0 +1,184 @@
+"""Opt-in per-update tracing and sampled profiling.
+
+With TRACE_SLOW_MS or TRACE_PROFILE_EVERY set, BotApplication wraps each
+update in a Trace that collects spans: the webhook's Update.de_json
+("parse"), every Mongo round-trip ("db"), and for each Bot API request the
+time queued in the send scheduler ("send_wait") and the call itself
+("send"). Whatever the spans don't cover (handler code, lock waits) is
+reported as "other".
+
+    TRACE_SLOW_MS        log updates slower than this, with their breakdown,
+                         and append them to TRACE_DIR/slow-updates.jsonl
+    TRACE_PROFILE_EVERY  run cProfile over 1 in N updates and save the stats to
+                         TRACE_DIR/update-<id>.prof (open with snakeviz or
+                         flameprof for a flame graph)
+    TRACE_DIR            where trace files go (default: traces)
+
+cProfile sees the whole event-loop thread, so a profile also covers other
+updates interleaved with the sampled one. Webhook apps serve the files on
+/admin/traces when ADMIN_TOKEN is set. With neither setting, tracing costs
+one attribute check per update.
+"""
+import contextlib
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 0))
+TRACE_PROFILE_EVERY = int(os.getenv("TRACE_PROFILE_EVERY", 0))
+TRACE_DIR = os.getenv("TRACE_DIR", "traces")
+# Profiles kept on disk; older ones are deleted
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", 100))
+SLOW_LOG_MAX_BYTES = 10 * 1024 * 1024
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+_no_span = contextlib.nullcontext()
+
+
+class Trace:
+    """Spans recorded while one update is processed."""
+
+    __slots__ = ("update_id", "started", "spans")
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, kind, name, duration):
+        self.spans.append((kind, name, duration))
+
+    @contextlib.contextmanager
+    def span(self, kind, name=""):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((kind, name, time.perf_counter() - started))
+
+    def breakdown(self, total):
+        """[(kind, name, seconds, count)], largest first, plus the uncovered "other" time."""
+        totals = {}
+        for kind, name, duration in self.spans:
+            entry = totals.setdefault((kind, name), [0.0, 0])
+            entry[0] += duration
+            entry[1] += 1
+        rows = sorted(((kind, name, seconds, count) for (kind, name), (seconds, count) in totals.items()),
+                      key=lambda row: -row[2])
+        # "parse" happens before processing starts, so it isn't part of total
+        covered = sum(seconds for kind, _, seconds, _ in rows if kind != "parse")
+        rows.append(("other", "", max(total - covered, 0.0), 1))
+        return rows
+
+
+def span(kind, name=""):
+    """Context manager recording a span on the current update's trace, if any."""
+    trace = current_trace.get()
+    return _no_span if trace is None else trace.span(kind, name)
+
+
+class Tracer:
+    def __init__(self, slow_ms=TRACE_SLOW_MS, profile_every=TRACE_PROFILE_EVERY, directory=TRACE_DIR,
+                 keep=TRACE_KEEP):
+        self.slow_ms = slow_ms
+        self.profile_every = profile_every
+        self.directory = directory
+        self.keep = keep
+        self.enabled = bool(slow_ms or profile_every)
+        self._parse_times = {}
+        self._count = 0
+        self._profiling = False
+        self.slow = 0
+        self.profiles = 0
+
+    def record_parse(self, update_id, seconds):
+        """Note how long decoding update_id took; called from webhook threads."""
+        if not self.enabled:
+            return
+        if len(self._parse_times) > 10_000:
+            # Updates that never got processed (shed, rejected); don't let them pile up
+            self._parse_times.clear()
+        self._parse_times[update_id] = seconds
+
+    @contextlib.asynccontextmanager
+    async def trace(self, update_id):
+        if not self.enabled:
+            yield None
+            return
+
+        trace = Trace(update_id)
+        parse = self._parse_times.pop(update_id, None)
+        if parse is not None:
+            trace.add("parse", "de_json", parse)
+        token = current_trace.set(trace)
+
+        profile = None
+        self._count += 1
+        if self.profile_every and self._count % self.profile_every == 0 and not self._profiling:
+            self._profiling = True
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield trace
+        finally:
+            total = time.perf_counter() - trace.started
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+                self._save_profile(profile, update_id)
+            current_trace.reset(token)
+            if self.slow_ms and total * 1000 >= self.slow_ms:
+                self._record_slow(trace, total)
+
+    def _path(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, name)
+
+    def _record_slow(self, trace, total):
+        self.slow += 1
+        rows = trace.breakdown(total)
+        logger.warning("Slow update %s took %.1f ms: %s", trace.update_id, total * 1000, ", ".join(
+            f"{kind} {name + ' ' if name else ''}{seconds * 1000:.1f}ms" + (f" ({count}x)" if count > 1 else "")
+            for kind, name, seconds, count in rows
+        ))
+        try:
+            path = self._path("slow-updates.jsonl")
+            if os.path.exists(path) and os.path.getsize(path) > SLOW_LOG_MAX_BYTES:
+                os.replace(path, path + ".1")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({
+                    "update_id": trace.update_id,
+                    "at": time.time(),
+                    "total_ms": total * 1000,
+                    "spans": [{"kind": kind, "name": name, "ms": seconds * 1000, "count": count}
+                              for kind, name, seconds, count in rows],
+                }) + "\n")
+        except OSError:
+            logger.exception("Writing slow update trace failed")
+
+    def _save_profile(self, profile, update_id):
+        self.profiles += 1
+        try:
+            profile.dump_stats(self._path(f"update-{update_id}-{int(time.time())}.prof"))
+            profiles = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".prof")),
+                              key=lambda entry: entry.stat().st_mtime)
+            for entry in profiles[:-self.keep]:
+                os.remove(entry.path)
+        except OSError:
+            logger.exception("Saving profile of update %s failed", update_id)
+
+    def files(self):
+        """Trace files available for download, newest first, as (name, size)."""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = sorted(os.scandir(self.directory), key=lambda entry: -entry.stat().st_mtime)
+        return [(entry.name, entry.stat().st_size) for entry in entries if entry.is_file()]
+
+
+# Shared by BotApplication, the webhook server and storage/outbound spans
+tracer = Tracer()
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import os
+import time
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
+from outbound import PRIORITY_RELAY
+
+logger = logging.getLogger(__name__)
+
+# Set TYPING_INDICATOR=0 to stop sending chat actions altogether
+TYPING_INDICATOR = os.getenv("TYPING_INDICATOR", "1") != "0"
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", 5))
+
+
+class TypingIndicator:
+    """Shows "typing..." to a partner at most once per interval.
+
+    Telegram keeps a chat action visible for about five seconds, so one
+    action per interval is enough for a whole burst of messages. notify()
+    never waits: the action is sent from a background task alongside the
+    real message instead of a full round-trip in front of it.
+    """
+
+    def __init__(self, enabled=TYPING_INDICATOR, interval=TYPING_INTERVAL, max_chats=100_000):
+        self.enabled = enabled
+        self.interval = interval
+        self.max_chats = max_chats
+        self._last_sent = {}
+        self._tasks = set()
+        self.sent = 0
+        self.skipped = 0
+
+    def notify(self, bot, chat_id):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        last = self._last_sent.get(chat_id)
+        if last is not None and now - last < self.interval:
+            self.skipped += 1
+            return
+
+        if len(self._last_sent) >= self.max_chats:
+            self._prune(now)
+        self._last_sent[chat_id] = now
+        task = asyncio.create_task(self._send(bot, chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _prune(self, now):
+        self._last_sent = {chat_id: last for chat_id, last in self._last_sent.items() if now - last < self.interval}
+
+    async def _send(self, bot, chat_id):
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING, rate_limit_args=PRIORITY_RELAY)
+            self.sent += 1
+        except TelegramError as exc:
+            # Cosmetic only; never let it fail the relay
+            logger.debug("Typing indicator for %s failed: %s", chat_id, exc)
@@ -0,0 +1,286 @@
+import atexit
+import asyncio
+import concurrent.futures
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from flask import Flask, Response, abort, jsonify, request, send_from_directory
+from telegram import Update
+import metrics
+from tracing import tracer
+from sharding import ShardedPairingTable, add_peer_routes
+
+logger = logging.getLogger(__name__)
+
+# Bounded hand-off between Flask threads and the bot loop
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 64))
+# What to do with an update when the queue is full:
+#   reject - answer 503 so Telegram redelivers it later
+#   shed   - answer 200 and drop it
+#   spill  - answer 200 and append it to WEBHOOK_SPILL_PATH, replayed once the queue drains
+WEBHOOK_OVERFLOW = os.getenv("WEBHOOK_OVERFLOW", "reject")
+WEBHOOK_SPILL_PATH = os.getenv("WEBHOOK_SPILL_PATH", "webhook_spill.jsonl")
+OVERFLOW_POLICIES = ("reject", "shed", "spill")
+# Answer webhooks as soon as Flask is up instead of after the bot has started;
+# updates that arrive meanwhile wait in the queue until it is ready
+WEBHOOK_LAZY_START = os.getenv("WEBHOOK_LAZY_START", "0") == "1"
+# Bearer token for the /admin routes; they are disabled without one
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+ACCEPTED, REJECTED, SHED, SPILLED = "accepted", "rejected", "shed", "spilled"
+
+
+class WebhookServer:
+    """Keeps one telegram Application running on a long-lived event loop.
+
+    The loop lives in a background thread. Flask request threads only
+    validate the update and push it onto a bounded queue, so /webhook
+    answers before any handler or Bot API send runs; a pool of async
+    workers on the bot loop drains the queue into BotApplication's per-chat
+    queues, so updates from different chats are handled side by side and a
+    busy chat ties up no worker. An update counts against queue_size until
+    it has been handled. When the queue is full, overflow decides whether
+    the update is rejected, shed or spilled to disk. Spilled updates are
+    fed back in chunks while the queue is under half full, reading no
+    more of the spill file than fits.
+
+    With lazy_start, start() returns while the bot is still starting, so
+    the first webhook is answered without waiting for the warm-up; if
+    starting fails, further updates are rejected for Telegram to redeliver
+    to a healthy instance.
+    """
+
+    def __init__(self, telegram_app, queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS,
+                 overflow=WEBHOOK_OVERFLOW, spill_path=WEBHOOK_SPILL_PATH, lazy_start=WEBHOOK_LAZY_START):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown webhook overflow policy: {overflow!r}")
+        self.telegram_app = telegram_app
+        self.queue_size = queue_size
+        self.workers = workers
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.lazy_start = lazy_start
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="telegram-loop", daemon=True)
+        # Created up front so updates can be queued before the workers start
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._starting = None
+        self._failed = False
+        self._stopped = False
+        # Depth is tracked here rather than with a bounded asyncio.Queue, so
+        # Flask threads can decide synchronously whether an update fits
+        self._lock = threading.Lock()
+        self._depth = 0
+        self.counts = {ACCEPTED: 0, REJECTED: 0, SHED: 0, SPILLED: 0}
+
+    def start(self):
+        self._thread.start()
+        if self.lazy_start:
+            self._starting = asyncio.run_coroutine_threadsafe(self._start_bot(), self.loop)
+            self._starting.add_done_callback(self._started)
+        else:
+            self.run(self._start_bot())
+        atexit.register(self.stop)
+
+    def _started(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        self._failed = True
+        logger.critical("Starting the bot failed; rejecting updates", exc_info=future.exception())
+
+    def stop(self):
+        if self._stopped or not self.loop.is_running():
+            return
+        self._stopped = True
+        if self._starting is not None:
+            # Let a lazy start finish (or fail) before shutting down
+            concurrent.futures.wait([self._starting])
+        self.run(self._stop_bot())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coro):
+        # Run a coroutine on the bot loop from any thread and wait for it
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _start_bot(self):
+        await self.telegram_app.initialize()
+        if self.telegram_app.post_init:
+            await self.telegram_app.post_init(self.telegram_app)
+        await self.telegram_app.start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.overflow == "spill":
+            self._tasks.append(asyncio.create_task(self._replay_spill()))
+        print("✅ Bot started and listening for updates!")
+
+    async def _stop_bot(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.telegram_app.running:
+            await self.telegram_app.stop()
+        await self.telegram_app.shutdown()
+        if self.telegram_app.post_shutdown:
+            await self.telegram_app.post_shutdown(self.telegram_app)
+        # Let cancelled background tasks (flushers, dispatchers) unwind before the loop stops
+        leftovers = asyncio.all_tasks() - {asyncio.current_task()}
+        if leftovers:
+            await asyncio.wait(leftovers, timeout=1)
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            done = None
+            try:
+                done = await self.telegram_app.enqueue_update(update)
+            except Exception:
+                logger.exception("Processing update %s failed", update.update_id)
+            finally:
+                # An update counts against the queue until its chat's task has handled it
+                if done is None:
+                    self._handled()
+                else:
+                    done.add_done_callback(self._handled)
+
+    def _handled(self, done=None):
+        with self._lock:
+            self._depth -= 1
+
+    def stats(self):
+        return {"queue_depth": self._depth, "queue_size": self.queue_size, **self.counts}
+
+    def submit(self, data):
+        """Queue one decoded webhook payload; returns ACCEPTED, REJECTED, SHED or SPILLED."""
+        started = time.perf_counter()
+        update = Update.de_json(data, self.telegram_app.bot)
+        tracer.record_parse(update.update_id, time.perf_counter() - started)
+        with self._lock:
+            if self._failed:
+                outcome = REJECTED
+            elif self._depth < self.queue_size:
+                self._depth += 1
+                outcome = ACCEPTED
+            else:
+                outcome = {"reject": REJECTED, "shed": SHED, "spill": SPILLED}[self.overflow]
+            self.counts[outcome] += 1
+            if outcome == SPILLED:
+                with open(self.spill_path, "a", encoding="utf-8") as spill:
+                    spill.write(json.dumps(data) + "\n")
+
+        if outcome == ACCEPTED:
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, update)
+        return outcome
+
+    async def _replay_spill(self):
+        # Feed spilled updates back in a chunk at a time, while the queue is
+        # under half full; the rest stays on disk, and how far the replay got
+        # is kept next to it so a restarted bot carries on from there
+        replaying = self.spill_path + ".replaying"
+        position_path = replaying + ".position"
+        while True:
+            await asyncio.sleep(1)
+            with self._lock:
+                if self._depth >= self.queue_size // 2:
+                    continue
+                if not os.path.exists(replaying):
+                    if not os.path.exists(self.spill_path):
+                        continue
+                    os.replace(self.spill_path, replaying)
+
+            replayed = 0
+            finished = False
+            with open(replaying, "rb") as spill:
+                spill.seek(self._spill_position(position_path))
+                while True:
+                    # Take the update's place in the queue before reading it,
+                    # so webhooks arriving meanwhile can't push it past its size
+                    with self._lock:
+                        if self._depth >= self.queue_size // 2:
+                            break
+                        self._depth += 1
+                    line = spill.readline()
+                    try:
+                        update = Update.de_json(json.loads(line), self.telegram_app.bot)
+                    except ValueError:
+                        # The end of the file, or a line cut short by a crash while spilling
+                        self._handled()
+                        if not line:
+                            finished = True
+                            break
+                        continue
+                    self._queue.put_nowait(update)
+                    replayed += 1
+                position = spill.tell()
+            if finished:
+                os.remove(replaying)
+                if os.path.exists(position_path):
+                    os.remove(position_path)
+            else:
+                with open(position_path, "w", encoding="utf-8") as file:
+                    file.write(str(position))
+            logger.info("Replayed %d spilled updates", replayed)
+
+    @staticmethod
+    def _spill_position(position_path):
+        try:
+            with open(position_path, encoding="utf-8") as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return 0
+
+
+def create_app(telegram_app, pairings=None):
+    """Start telegram_app on its own loop and return the Flask app serving it.
+
+    Pass the bot's PairingTable so a sharded worker also serves /shard/pairing.
+    """
+    server = WebhookServer(telegram_app)
+    server.start()
+
+    app = Flask(__name__)
+    app.extensions["webhook_server"] = server
+    metrics.Gauge("webhook_queue_depth", "Updates accepted by /webhook and not yet processed.",
+                  lambda: server.stats()["queue_depth"])
+
+    @app.route('/')
+    def home():
+        return 'Bot is running!'
+
+    @app.route('/webhook', methods=['POST'])
+    def webhook():
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return "bad update", 400
+        if server.submit(data) == REJECTED:
+            return "busy", 503
+        return "ok"
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(server.run(metrics.render()), content_type=metrics.CONTENT_TYPE)
+
+    def require_admin():
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ") or request.args.get("token", "")
+        if not ADMIN_TOKEN:
+            abort(404)
+        if not hmac.compare_digest(supplied, ADMIN_TOKEN):
+            abort(403)
+
+    @app.route('/admin/traces')
+    def list_traces():
+        require_admin()
+        return jsonify(slow_updates=tracer.slow, profiles=tracer.profiles,
+                       files=[{"name": name, "bytes": size} for name, size in tracer.files()])
+
+    @app.route('/admin/traces/<name>')
+    def download_trace(name):
+        require_admin()
+        return send_from_directory(os.path.abspath(tracer.directory), name, as_attachment=True)
+
+    if isinstance(pairings, ShardedPairingTable):
+        add_peer_routes(app, server, pairings)
+
+    return app